@@ -0,0 +1,478 @@
+# Индекс базы данных в памяти: серийник -> год и признак "на складе"
+import contextlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from .excel_logic import (
+    RETURN_SHEET,
+    YEAR_MISSING,
+    _read_sheet_safe,
+    auto_detect_columns,
+    dates_to_years,
+    encode_serials,
+    get_sheet_names,
+    join_base_years,
+    normalize_serials,
+)
+
+
+# Файл изменений: столбец с операцией и значения, означающие удаление строки.
+# Остальные значения ("добавить", "изменить", пусто) — добавление/замена.
+DELTA_OP_COLUMN = "Операция"
+DELTA_REMOVE_OPS = {"удалить", "удалено", "delete", "deleted", "remove", "removed"}
+
+# Лист "Возврат" длиннее STOCK_FILTER_MIN_ROWS строк хранится не признаком у
+# каждого ключа, а фильтром Блума размером не больше STOCK_FILTER_BYTES
+# с точной проверкой положительных ответов по хешам склада на диске.
+STOCK_FILTER_MIN_ROWS = int(os.environ.get("EXCEL_STOCK_FILTER_MIN_ROWS", 5_000_000))
+STOCK_FILTER_BYTES = int(os.environ.get("EXCEL_STOCK_FILTER_MB", 64)) * 1024 * 1024
+# Ложные срабатывания фильтра: exact — отсекаются проверкой по диску,
+# approximate — принимаются (быстрее, доля ошибок — в stats["stock_filter"])
+STOCK_CHECKS = ("exact", "approximate")
+
+
+def _pick_column(columns, preferred: str, kind: str) -> str:
+    """Выбранный пользователем столбец, а если его нет — автоопределённый."""
+    if preferred and preferred in columns:
+        return preferred
+    return auto_detect_columns(list(columns))[kind]
+
+
+def _hash_keys(normalized: pd.Series) -> np.ndarray:
+    """64-битные хеши нормализованных серийников (пустые значения тоже хешируются,
+    их отсекает вызывающий код по маске).
+    """
+    return pd.util.hash_array(np.asarray(normalized, dtype=object), categorize=False)
+
+
+class StockFilter:
+    """Фильтр Блума по серийникам листа "Возврат" с точной проверкой.
+
+    bits  — битовый массив фильтра, hashes — число хеш-функций,
+    exact — отсортированные хеши всех серийников склада (на диске, через mmap):
+    к нему обращаются только за положительными ответами фильтра, поэтому в
+    памяти остаются фильтр и прочитанные страницы, а не весь список.
+    Изменения склада хранятся небольшими массивами added / removed.
+    """
+
+    def __init__(self, bits, hashes: int, exact, stats=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.exact = exact
+        self.added = np.empty(0, dtype=np.uint64)
+        self.removed = np.empty(0, dtype=np.uint64)
+        self.stats = stats or {}
+
+    @classmethod
+    def build(cls, keys: np.ndarray, max_bytes: int = STOCK_FILTER_BYTES):
+        """Фильтр по хешам серийников склада (keys — уникальные, отсортированные)."""
+        n = max(len(keys), 1)
+        # Размер — степень двойки (позиция бита берётся маской): от 16 бит на
+        # ключ (доля ложных срабатываний ~0.05%), но не больше бюджета
+        m_bits = min(1 << (n * 16 - 1).bit_length(), 1 << (max_bytes * 8).bit_length() - 1)
+        m_bits = max(m_bits, 64)
+        k = int(np.clip(round(m_bits / n * np.log(2)), 1, 12))
+        self = cls(np.zeros(m_bits // 8, dtype=np.uint8), k, keys)
+        self._set(keys)
+        self.stats = {
+            "rows": len(keys),
+            "bytes": int(self.bits.nbytes),
+            "hashes": k,
+            "fp_rate": float((1 - np.exp(-k * len(keys) / m_bits)) ** k),
+        }
+        return self
+
+    def _bit_positions(self, hashes: np.ndarray):
+        """Позиции битов для каждой хеш-функции (двойное хеширование)."""
+        mask = np.uint64(len(self.bits) * 8 - 1)
+        step = (hashes >> np.uint64(32)) | np.uint64(1)
+        for i in range(self.hashes):
+            yield (hashes + np.uint64(i) * step) & mask
+
+    def _set(self, hashes: np.ndarray):
+        if not self.bits.flags.writeable:
+            self.bits = self.bits.copy()
+        for bit in self._bit_positions(hashes):
+            np.bitwise_or.at(self.bits, bit >> np.uint64(3), np.left_shift(1, bit & np.uint64(7)).astype(np.uint8))
+
+    def maybe_contains(self, hashes: np.ndarray) -> np.ndarray:
+        """Ответ фильтра: False — точно нет на складе, True — вероятно есть."""
+        result = np.ones(len(hashes), dtype=bool)
+        for bit in self._bit_positions(hashes):
+            result &= (self.bits[bit >> np.uint64(3)] >> (bit & np.uint64(7)).astype(np.uint8)) & 1 == 1
+        return result
+
+    def contains(self, hashes: np.ndarray, stock_check: str = "exact", stats: dict = None) -> np.ndarray:
+        """Признак "на складе" для хешей серийников."""
+        result = self.maybe_contains(hashes)
+        if stock_check == "exact":
+            candidates = np.flatnonzero(result)
+            found = _sorted_isin(hashes[candidates], self.exact) | np.isin(hashes[candidates], self.added)
+            result[candidates[~found]] = False
+            if stats is not None:
+                stats["stock_false_positives"] = int((~found).sum())
+        if len(self.removed):
+            result &= ~np.isin(hashes, self.removed)
+        return result
+
+    def copy(self) -> "StockFilter":
+        """Копия для изменения (битовый массив на mmap копируется при записи)."""
+        bits = self.bits.copy() if self.bits.flags.writeable else self.bits
+        other = StockFilter(bits, self.hashes, self.exact, self.stats)
+        other.added, other.removed = self.added, self.removed
+        return other
+
+    def add(self, hashes: np.ndarray):
+        self._set(hashes)
+        self.added = np.union1d(self.added, hashes)
+        self.removed = np.setdiff1d(self.removed, hashes)
+
+    def remove(self, hashes: np.ndarray):
+        self.removed = np.union1d(self.removed, hashes)
+        self.added = np.setdiff1d(self.added, hashes)
+
+
+def _sorted_positions(keys: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Позиции values в отсортированном keys (-1 — нет)."""
+    if not len(keys):
+        return np.full(len(values), -1, dtype=np.int64)
+    # Бинарный поиск по отсортированным запросам идёт по ключам почти
+    # последовательно — в разы меньше промахов кеша, чем в случайном порядке
+    order = np.argsort(values, kind="stable")
+    pos = np.empty(len(values), dtype=np.int64)
+    pos[order] = np.searchsorted(keys, values[order])
+    pos = pos.clip(max=len(keys) - 1)
+    return np.where(keys[pos] == values, pos, -1)
+
+
+def _sorted_isin(values: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """values in keys для отсортированного keys."""
+    return _sorted_positions(keys, values) >= 0
+
+
+class BaseIndex:
+    """Индекс базы данных для сверки и техрефреша.
+
+    keys     — отсортированные 64-битные хеши нормализованных серийников
+               (базы и листа "Возврат"),
+    years    — год из базы для каждого ключа (None, если даты в базе нет),
+    on_stock — признак наличия на листе "Возврат" (None, если листа нет
+               или он хранится фильтром stock_filter, см. StockFilter),
+    version  — число применённых файлов изменений (позиция в журнале).
+    Серийники файла обработки переводятся в позиции ключей бинарным поиском.
+    Массивы фиксированной ширины сохраняются на диск (save) и открываются
+    через np.load(mmap_mode="r") (load), поэтому все процессы читают одну
+    копию из страничного кеша ОС; изменения базы копируют массив при записи.
+    """
+
+    def __init__(self, keys, years, on_stock, serial_col="", date_col="", stats=None, stock_filter=None):
+        self.keys = keys
+        self.years = years
+        self.on_stock = on_stock
+        self.stock_filter = stock_filter
+        self.serial_col = serial_col
+        self.date_col = date_col
+        self.stats = stats or {}
+        self.version = 0
+
+    @classmethod
+    def build(cls, base_serials=None, base_dates=None, stock_serials=None,
+              policy: str = "last", serial_col: str = "", date_col: str = ""):
+        """Строит индекс по столбцам базы и листа "Возврат"."""
+        stock_filter = None
+        if stock_serials is not None and len(stock_serials) >= STOCK_FILTER_MIN_ROWS:
+            # Огромный склад не попадает в словарь ключей: только фильтр + хеши
+            stock_filter = StockFilter.build(np.unique(_hash_keys(normalize_serials(stock_serials).dropna())))
+            stock_serials = None
+
+        columns = [base_serials if base_serials is not None else pd.Series([], dtype=object)]
+        if stock_serials is not None:
+            columns.append(stock_serials)
+        codes, uniques = encode_serials(*columns)
+
+        years, stats = None, {}
+        if base_serials is not None and base_dates is not None:
+            years, stats = join_base_years(codes[0], dates_to_years(base_dates), len(uniques), policy)
+
+        on_stock = None
+        if stock_serials is not None:
+            on_stock = np.zeros(len(uniques), dtype=bool)
+            on_stock[codes[1][codes[1] >= 0]] = True
+
+        # Словарь кодов -> отсортированные хеши (те же позиции в years/on_stock)
+        hashes = _hash_keys(uniques)
+        order = np.argsort(hashes, kind="stable")
+        keys = hashes[order]
+        years = years[order] if years is not None else None
+        on_stock = on_stock[order] if on_stock is not None else None
+        if stock_filter is not None:
+            stats["stock_filter"] = stock_filter.stats
+        return cls(keys, years, on_stock, serial_col, date_col, stats, stock_filter)
+
+    @property
+    def has_stock(self) -> bool:
+        """Есть ли данные листа "Возврат"."""
+        return self.on_stock is not None or self.stock_filter is not None
+
+    def save(self, path: str):
+        """Сохраняет массивы индекса в папку path (.npy + meta.json).
+
+        Папка собирается рядом и переименовывается целиком, поэтому другие
+        процессы видят либо готовый индекс, либо никакого.
+        """
+        import json
+        import shutil
+        import tempfile
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent, suffix=".tmp")
+        np.save(os.path.join(tmp, "keys.npy"), self.keys)
+        if self.years is not None:
+            np.save(os.path.join(tmp, "years.npy"), self.years)
+        if self.on_stock is not None:
+            np.save(os.path.join(tmp, "on_stock.npy"), self.on_stock)
+        meta = {"serial_col": self.serial_col, "date_col": self.date_col, "stats": self.stats}
+        if self.stock_filter is not None:
+            np.save(os.path.join(tmp, "stock_bits.npy"), self.stock_filter.bits)
+            np.save(os.path.join(tmp, "stock_keys.npy"), self.stock_filter.exact)
+            meta["stock_filter"] = {"hashes": self.stock_filter.hashes, "stats": self.stock_filter.stats}
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Другой процесс успел сохранить тот же индекс
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str):
+        """Открывает сохранённый индекс через mmap или возвращает None, если его нет."""
+        import json
+        try:
+            with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+            keys = np.load(os.path.join(path, "keys.npy"), mmap_mode="r")
+        except (FileNotFoundError, NotADirectoryError, ValueError):
+            return None
+
+        def optional(name):
+            file = os.path.join(path, name)
+            return np.load(file, mmap_mode="r") if os.path.exists(file) else None
+
+        stock_filter = None
+        if meta.get("stock_filter"):
+            stock_filter = StockFilter(optional("stock_bits.npy"), meta["stock_filter"]["hashes"],
+                                       optional("stock_keys.npy"), meta["stock_filter"]["stats"])
+        with contextlib.suppress(OSError):
+            os.utime(os.path.join(path, "meta.json"))  # Отметка использования (shared_store.evict_cache)
+        return cls(keys, optional("years.npy"), optional("on_stock.npy"),
+                   meta["serial_col"], meta["date_col"], meta["stats"], stock_filter)
+
+    def _lookup(self, normalized: pd.Series, hashes: np.ndarray = None) -> np.ndarray:
+        """Позиции нормализованных серийников среди ключей (-1 — нет)."""
+        if hashes is None:
+            hashes = _hash_keys(normalized)
+        pos = _sorted_positions(self.keys, hashes)
+        return np.where(normalized.notna().to_numpy(), pos, -1)
+
+    def locate(self, serials) -> np.ndarray:
+        """Позиции серийников в индексе (-1 — нет в базе)."""
+        return self._lookup(normalize_serials(serials))
+
+    def lookup(self, serials, with_stock: bool = True, stock_check: str = "exact",
+               stats: dict = None) -> tuple:
+        """Позиции серийников (см. locate) и признак "на складе"
+        (None, если with_stock=False или листа "Возврат" нет).
+        stock_check — обработка ложных срабатываний фильтра склада (STOCK_CHECKS).
+        """
+        if stock_check not in STOCK_CHECKS:
+            raise ValueError(f"Неизвестный режим проверки склада: {stock_check}")
+        normalized = normalize_serials(serials)
+        hashes = _hash_keys(normalized)
+        pos = self._lookup(normalized, hashes)
+        matched = None
+        if with_stock and self.stock_filter is not None:
+            matched = normalized.notna().to_numpy() & self.stock_filter.contains(hashes, stock_check, stats)
+        elif with_stock and self.on_stock is not None:
+            matched = (pos >= 0) & self.on_stock[pos] if len(self.keys) else np.zeros(len(pos), dtype=bool)
+        return pos, matched
+
+    def years_at(self, pos: np.ndarray) -> np.ndarray:
+        """Годы по позициям из locate()."""
+        if not len(self.keys):
+            return np.full(len(pos), YEAR_MISSING, dtype="int16")
+        return np.where(pos >= 0, self.years[pos], YEAR_MISSING).astype("int16")
+
+    def _ensure_keys(self, normalized: pd.Series) -> np.ndarray:
+        """Позиции серийников, добавляя в индекс отсутствующие (с сохранением порядка ключей)."""
+        pos = self._lookup(normalized)
+        missing = (pos < 0) & normalized.notna().to_numpy()
+        if missing.any():
+            new_keys = np.unique(_hash_keys(normalized[missing]))
+            keys = np.union1d(self.keys, new_keys)
+            old_pos = np.searchsorted(keys, self.keys)
+            if self.years is not None:
+                years = np.full(len(keys), YEAR_MISSING, dtype="int16")
+                years[old_pos] = self.years
+                self.years = years
+            if self.on_stock is not None:
+                on_stock = np.zeros(len(keys), dtype=bool)
+                on_stock[old_pos] = self.on_stock
+                self.on_stock = on_stock
+            self.keys = keys
+            pos = self._lookup(normalized)
+        return pos
+
+    def copy(self) -> "BaseIndex":
+        """Копия для apply_delta: массивы общие (apply_delta заменяет их
+        новыми, а не меняет на месте), фильтр склада — свой."""
+        import copy
+        index = copy.copy(self)
+        if self.stock_filter is not None:
+            index.stock_filter = self.stock_filter.copy()
+        return index
+
+    def apply_delta(self, delta: dict) -> dict:
+        """Применяет изменения (см. read_delta) к индексу на месте; индекс,
+        который могут читать другие потоки, меняется через copy().
+
+        Добавленные и изменённые строки базы заменяют год серийника,
+        удалённые — сбрасывают его. Строки "Возврат" ставят/снимают
+        признак наличия на складе. Возвращает счётчики изменений.
+        """
+        counts = {"base_upserted": 0, "base_removed": 0, "stock_added": 0, "stock_removed": 0}
+
+        base = delta.get("base")
+        if base is not None and self.years is not None:
+            serial_col = _pick_column(base.columns, self.serial_col, "serial")
+            date_col = _pick_column(base.columns, self.date_col, "date")
+            if serial_col:
+                upserts, removed = _split_ops(base)
+                if date_col and len(upserts):
+                    upserts = upserts.assign(_key=normalize_serials(upserts[serial_col]).to_numpy())
+                    upserts = upserts.dropna(subset=["_key"]).drop_duplicates("_key", keep="last")
+                    pos = self._ensure_keys(upserts["_key"])
+                    self.years = self.years.copy()
+                    self.years[pos] = dates_to_years(upserts[date_col])
+                    counts["base_upserted"] = len(upserts)
+                if len(removed):
+                    pos = self.locate(removed[serial_col])
+                    pos = pos[pos >= 0]
+                    self.years = self.years.copy()
+                    self.years[pos] = YEAR_MISSING
+                    counts["base_removed"] = len(pos)
+
+        stock = delta.get("stock")
+        if stock is not None and self.stock_filter is not None:
+            serial_col = _pick_column(stock.columns, self.serial_col, "serial")
+            if serial_col:
+                upserts, removed = _split_ops(stock)
+                added = normalize_serials(upserts[serial_col]).dropna()
+                removed = normalize_serials(removed[serial_col]).dropna()
+                if len(added):
+                    self.stock_filter.add(_hash_keys(added))
+                    counts["stock_added"] = len(added)
+                if len(removed):
+                    hashes = _hash_keys(removed)
+                    present = self.stock_filter.contains(hashes)
+                    self.stock_filter.remove(hashes[present])
+                    counts["stock_removed"] = int(present.sum())
+        elif stock is not None and self.on_stock is not None:
+            serial_col = _pick_column(stock.columns, self.serial_col, "serial")
+            if serial_col:
+                upserts, removed = _split_ops(stock)
+                if len(upserts):
+                    normalized = normalize_serials(upserts[serial_col]).dropna()
+                    pos = self._ensure_keys(normalized)
+                    self.on_stock = self.on_stock.copy()
+                    self.on_stock[pos] = True
+                    counts["stock_added"] = len(normalized)
+                if len(removed):
+                    pos = self.locate(removed[serial_col])
+                    pos = pos[pos >= 0]
+                    self.on_stock = self.on_stock.copy()
+                    self.on_stock[pos] = False
+                    counts["stock_removed"] = len(pos)
+
+        self.version += 1
+        return counts
+
+
+def build_base_index(path: str, engine, sheet: str, serial_col: str, date_col: str,
+                     policy: str = "last", with_stock: bool = True, with_years: bool = True,
+                     df_base: pd.DataFrame = None, df_return: pd.DataFrame = None) -> BaseIndex:
+    """Читает базу данных и строит BaseIndex.
+
+    with_years — читать лист базы (серийник -> год), with_stock — лист "Возврат".
+    Уже прочитанные листы (из кеша) можно передать в df_base и df_return.
+    """
+    base_serials = base_dates = stock_serials = None
+
+    if with_years:
+        if df_base is None:
+            df_base = _read_sheet_safe(path, engine, sheet)
+        if date_col and date_col in df_base.columns:
+            base_serials = df_base[serial_col]
+            base_dates = df_base[date_col]
+
+    if with_stock:
+        try:
+            if df_return is None:
+                df_return = _read_sheet_safe(path, engine, RETURN_SHEET)
+            stock_col = _pick_column(df_return.columns, serial_col, "serial")
+            # Если не удалось определить столбец, считаем что на складе ничего нет
+            stock_serials = df_return[stock_col] if stock_col else pd.Series([], dtype=object)
+        except Exception:
+            # Лист "Возврат" не найден или ошибка чтения
+            stock_serials = None
+
+    return BaseIndex.build(base_serials, base_dates, stock_serials, policy, serial_col, date_col)
+
+
+def _split_ops(df: pd.DataFrame) -> tuple:
+    """Делит строки файла изменений на (добавление/замена, удаление)."""
+    if DELTA_OP_COLUMN not in df.columns:
+        return df, df.iloc[0:0]
+    ops = df[DELTA_OP_COLUMN].astype(str).str.strip().str.lower()
+    removed = ops.isin(DELTA_REMOVE_OPS)
+    return df[~removed], df[removed]
+
+
+def read_delta(path: str, engine, base_sheet: str) -> dict:
+    """Читает файл изменений базы данных.
+
+    Лист с именем листа базы — добавленные/изменённые/удалённые строки базы,
+    лист "Возврат" — строки склада. Операция задаётся столбцом "Операция"
+    ("удалить" — удаление, иначе добавление или замена).
+    Возвращает {"base": DataFrame | None, "stock": DataFrame | None}.
+    """
+    sheets = get_sheet_names(path, engine)
+    delta = {"base": None, "stock": None}
+    if base_sheet and base_sheet in sheets and base_sheet != RETURN_SHEET:
+        delta["base"] = _read_sheet_safe(path, engine, base_sheet)
+    if RETURN_SHEET in sheets:
+        delta["stock"] = _read_sheet_safe(path, engine, RETURN_SHEET)
+    if delta["base"] is None and delta["stock"] is None:
+        raise Exception(f"В файле изменений нет листов '{base_sheet}' или '{RETURN_SHEET}'")
+    return delta
+
+
+def apply_delta_to_frame(df: pd.DataFrame, delta_rows: pd.DataFrame, serial_col: str) -> pd.DataFrame:
+    """Применяет строки файла изменений к закешированному листу (например, "Возврат").
+
+    Строки с тем же серийником заменяются, новые добавляются, помеченные
+    на удаление — удаляются.
+    """
+    serial_col = _pick_column(df.columns, serial_col, "serial")
+    delta_col = _pick_column(delta_rows.columns, serial_col, "serial")
+    if not serial_col or not delta_col:
+        return df
+
+    upserts, removed = _split_ops(delta_rows)
+    touched = pd.concat([normalize_serials(upserts[delta_col]), normalize_serials(removed[delta_col])])
+    keep = ~normalize_serials(df[serial_col]).isin(touched.dropna())
+    added = upserts.drop(columns=[DELTA_OP_COLUMN], errors="ignore").rename(columns={delta_col: serial_col})
+    added = added.reindex(columns=df.columns)
+    return pd.concat([df[keep], added], ignore_index=True)
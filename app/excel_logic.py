@@ -1,16 +1,138 @@
 # Логика обработки Excel файлов
-import pandas as pd
+# pandas/numpy импортируются внутри функций: список листов и заголовки читаются
+# без них, и приложение стартует быстрее
+from __future__ import annotations
+
+import contextlib
 import tempfile
 import os
+import shutil
 import re
+import threading
+import time
 import zipfile
 import xml.etree.ElementTree as ET
 from datetime import datetime
+from functools import lru_cache
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
 
 
 CURRENT_YEAR = 2026
 TECH_REFRESH_YEARS = 5
 CRITICAL_AGE_YEARS = 9  # Возраст для критического устаревания
+RETURN_SHEET = "Возврат"  # Лист базы данных с оборудованием на складе
+
+# Форматы строковых дат в базе данных (порядок = приоритет)
+DATE_FORMATS = ['%d.%m.%Y', '%Y-%m-%d', '%d/%m/%Y']
+YEAR_MISSING = 0  # Сентинел «год не определён» в массиве годов
+EXCEL_EPOCH = '1899-12-30'  # День 0 для Excel serial (pyxlsb отдаёт даты числами)
+EXCEL_SERIAL_MAX = 2958465  # 31.12.9999
+
+# Политики выбора даты для серийника, который встречается в базе несколько раз
+DUPLICATE_POLICIES = ("first", "last", "oldest", "newest")
+
+# Потоковая обработка: файлы обработки от STREAM_MIN_BYTES читаются и пишутся
+# блоками по STREAM_CHUNK_ROWS строк, не загружая лист целиком
+STREAM_MIN_BYTES = 30 * 1024 * 1024
+STREAM_CHUNK_ROWS = 50_000
+
+PREVIEW_ROWS = 20  # Строк в предпросмотре листа по умолчанию
+PREVIEW_MAX_ROWS = 200
+
+# Предварительный анализ книги (prescan_workbook): оценка размера листов
+# по каталогу ZIP и <dimension ref> без разбора данных
+SCAN_HEAD_BYTES = 64 * 1024  # Сколько байт начала листа читать в поисках <dimension>
+XML_BYTES_PER_CELL = 24  # Средний размер ячейки в XML листа (если больше оценить не по чему)
+MEMORY_PER_CELL = 64  # Байт на ячейку в DataFrame (object-столбцы)
+STREAM_MIN_MEMORY = int(os.environ.get("EXCEL_STREAM_MIN_MB", "512")) << 20  # Дальше — потоково
+PROJECT_MIN_COLUMNS = 8  # С какой ширины листа базы читаются только нужные столбцы
+
+# Бюджет времени на один файл пакета, секунд (0 — без ограничения)
+FILE_TIMEOUT = float(os.environ.get("EXCEL_FILE_TIMEOUT", "900"))
+DEADLINE_CHECK_ROWS = 4096  # Как часто построчное чтение проверяет бюджет
+
+
+class ProcessingStopped(Exception):
+    """Обработка прервана: истёк бюджет времени файла или пакет отменён."""
+
+
+_budget = threading.local()  # Бюджет текущего потока: deadline, cancelled, timeout
+
+
+@contextlib.contextmanager
+def time_budget(seconds: Optional[float] = None, cancelled=None):
+    """Бюджет времени для обработки в текущем потоке.
+
+    Проверка кооперативная: check_deadline() вызывается между попытками
+    чтения листа и между блоками строк, поэтому уже начатый вызов
+    pandas/openpyxl дорабатывает до конца. cancelled — функция без
+    аргументов, True — пакет отменён.
+    """
+    previous = getattr(_budget, "value", None)
+    deadline = time.monotonic() + seconds if seconds else None
+    _budget.value = (deadline, cancelled, seconds)
+    try:
+        yield
+    finally:
+        _budget.value = previous
+
+
+def check_deadline():
+    """Бросает ProcessingStopped, если бюджет потока исчерпан или пакет отменён."""
+    value = getattr(_budget, "value", None)
+    if value is None:
+        return
+    deadline, cancelled, seconds = value
+    if cancelled is not None and cancelled():
+        raise ProcessingStopped("Обработка отменена")
+    if deadline is not None and time.monotonic() > deadline:
+        raise ProcessingStopped(f"Превышено время обработки файла ({seconds:g} с)")
+
+
+_detail = threading.local()  # Файл детализации для сводки пакета в текущем потоке
+
+
+@contextlib.contextmanager
+def collect_detail(path: Optional[str]):
+    """Детализация для сводной книги пакета: строки каждого обработанного
+    блока (лист, серийный номер, склад, устаревание) дописываются в path
+    последовательностью pickle-кадров. path=None — без детализации.
+    """
+    if path is None:
+        yield
+        return
+    previous = getattr(_detail, "value", None)
+    with open(path, "wb") as f:
+        _detail.value = f
+        try:
+            yield
+        finally:
+            _detail.value = previous
+
+
+def _spool_detail(df1: pd.DataFrame, serial_col1: str, sheet: Optional[str]):
+    f = getattr(_detail, "value", None)
+    if f is None:
+        return
+    import pickle
+    import pandas as pd
+    detail = pd.DataFrame({"Лист": sheet, "Серийный номер": df1[serial_col1].values})
+    for col in ("Передано на склад", "Оборудование устарело"):
+        if col in df1.columns:
+            detail[col] = df1[col].values
+    pickle.dump(detail, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _reset_detail():
+    """Отбрасывает детализацию неудавшейся попытки обработки."""
+    f = getattr(_detail, "value", None)
+    if f is not None:
+        f.seek(0)
+        f.truncate()
 
 
 def _pluralize_years(n: int) -> str:
@@ -48,11 +170,14 @@ def get_engine(filename: str):
     return None
 
 
-def save_temp_file(upload_file) -> str:
-    """Сохраняет загруженный файл во временную директорию."""
+def save_temp_file(upload_file, directory: str = None) -> str:
+    """Сохраняет загруженный файл во временную директорию (или в directory)."""
     ext = os.path.splitext(upload_file.filename)[-1]
-    with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp:
-        tmp.write(upload_file.file.read())
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=ext, dir=directory) as tmp:
+        # Копируем блоками: файл не читается в память целиком
+        shutil.copyfileobj(upload_file.file, tmp, 1024 * 1024)
         return tmp.name
 
 
@@ -83,6 +208,81 @@ def _get_sheets_from_zip(filepath: str) -> list:
         return []
 
 
+# BIFF12 (xlsb): типы записей workbook.bin
+XLSB_BUNDLE_SHEET = 0x9C  # BrtBundleSh — лист книги
+XLSB_END_BUNDLE_SHEETS = 0x90  # BrtEndBundleShs — конец списка листов
+XLSB_WS_DIM = 0x94  # BrtWsDim — диапазон данных листа
+
+
+def _iter_biff12_records(data: bytes):
+    """Итератор записей BIFF12: (тип, payload). Тип и размер — varint по 7 бит."""
+    pos, n = 0, len(data)
+    while pos < n:
+        rec_type = data[pos]
+        pos += 1
+        if rec_type & 0x80:
+            rec_type = (rec_type & 0x7F) | ((data[pos] & 0x7F) << 7)
+            pos += 1
+        size = 0
+        for shift in (0, 7, 14, 21):
+            b = data[pos]
+            pos += 1
+            size |= (b & 0x7F) << shift
+            if not b & 0x80:
+                break
+        yield rec_type, data[pos:pos + size]
+        pos += size
+
+
+def _read_xl_wide_string(payload: bytes, pos: int) -> tuple:
+    """XLWideString: длина (uint32, символы) + UTF-16LE. Возвращает (строка, новая позиция)."""
+    cch = int.from_bytes(payload[pos:pos + 4], "little")
+    pos += 4
+    if cch == 0xFFFFFFFF:  # XLNullableWideString = NULL
+        return None, pos
+    end = pos + cch * 2
+    return payload[pos:end].decode("utf-16-le"), end
+
+
+def _zip_rel_targets(z: zipfile.ZipFile, rels_path: str) -> dict:
+    """Id связи -> путь части внутри ZIP (относительно xl/)."""
+    targets = {}
+    if rels_path not in z.namelist():
+        return targets
+    for rel in ET.fromstring(z.read(rels_path)).findall('.//*'):
+        rid, target = rel.get('Id'), rel.get('Target')
+        if rid and target:
+            targets[rid] = target.lstrip('/') if target.startswith('/') else 'xl/' + target
+    return targets
+
+
+def _get_xlsb_sheet_parts(filepath: str) -> list:
+    """Низкоуровневое чтение листов XLSB из xl/workbook.bin и его связей.
+    Возвращает [(имя листа, путь части в ZIP)] без загрузки книги целиком:
+    разбор останавливается на конце списка листов.
+    """
+    try:
+        with zipfile.ZipFile(filepath, 'r') as z:
+            if 'xl/workbook.bin' not in z.namelist():
+                return []
+            targets = _zip_rel_targets(z, 'xl/_rels/workbook.bin.rels')
+            data = z.read('xl/workbook.bin')
+
+            sheets = []
+            for rec_type, payload in _iter_biff12_records(data):
+                if rec_type == XLSB_BUNDLE_SHEET:
+                    # hsState (4) + iTabID (4) + strRelID + strName
+                    rid, pos = _read_xl_wide_string(payload, 8)
+                    name, _ = _read_xl_wide_string(payload, pos)
+                    if name:
+                        sheets.append((name, targets.get(rid, "")))
+                elif rec_type == XLSB_END_BUNDLE_SHEETS:
+                    break
+            return sheets
+    except Exception:
+        return []
+
+
 def get_sheet_names(filepath: str, engine) -> list:
     """Возвращает список имён листов Excel-файла.
     Использует несколько методов для максимальной совместимости.
@@ -95,6 +295,12 @@ def get_sheet_names(filepath: str, engine) -> list:
         if sheets:
             return sheets
     
+    # Метод 0 для xlsb: список листов прямо из xl/workbook.bin
+    if engine == "pyxlsb":
+        sheets = [name for name, _ in _get_xlsb_sheet_parts(filepath)]
+        if sheets:
+            return sheets
+    
     # Метод 1: openpyxl с разными параметрами (для xlsx)
     if engine == "openpyxl":
         try:
@@ -120,6 +326,7 @@ def get_sheet_names(filepath: str, engine) -> list:
             pass
     
     # Метод 2: pd.ExcelFile с указанным engine
+    import pandas as pd
     try:
         xls = pd.ExcelFile(filepath, engine=engine)
         sheets = [s for s in xls.sheet_names if s]
@@ -152,97 +359,636 @@ def get_sheet_names(filepath: str, engine) -> list:
 
 
 def _get_columns_from_zip(filepath: str, sheet_name: str) -> list:
-    """Низкоуровневое чтение столбцов первой строки из XLSX через ZIP."""
+    """Низкоуровневое чтение столбцов первой строки из XLSX через ZIP.
+    Разбирается только первая строка листа.
+    """
     try:
-        with zipfile.ZipFile(filepath, 'r') as z:
-            # Находим соответствие имени листа и файла sheet?.xml
-            workbook_content = z.read('xl/workbook.xml')
-            wb_root = ET.fromstring(workbook_content)
-            
-            # Находим sheet элемент с нужным именем
-            all_elements = wb_root.findall('.//')
-            sheet_elements = [el for el in all_elements if el.tag.endswith('sheet')]
-            
-            rid = None
-            for el in sheet_elements:
-                name = el.get('name')
-                if name == sheet_name:
-                    # Находим relationship ID
-                    for attr_name, attr_value in el.attrib.items():
-                        if 'id' in attr_name.lower() and attr_value.startswith('rId'):
-                            rid = attr_value
-                            break
-                    break
-            
-            if not rid:
-                return []
-            
-            # Читаем relationships чтобы найти путь к sheet XML
-            rels_content = z.read('xl/_rels/workbook.xml.rels')
-            rels_root = ET.fromstring(rels_content)
-            
-            target_path = None
-            for rel in rels_root.findall('.//*'):
-                if rel.get('Id') == rid:
-                    target_path = 'xl/' + rel.get('Target')
-                    break
-            
-            if not target_path or target_path not in z.namelist():
-                return []
-            
-            # Читаем sheet XML
-            sheet_content = z.read(target_path)
-            sheet_root = ET.fromstring(sheet_content)
-            
-            # Находим первую строку (row)
-            all_elements = sheet_root.findall('.//')
-            rows = [el for el in all_elements if el.tag.endswith('row')]
-            
-            if not rows:
-                return []
-            
-            # Читаем sharedStrings если есть
-            shared_strings = []
-            if 'xl/sharedStrings.xml' in z.namelist():
-                ss_content = z.read('xl/sharedStrings.xml')
-                ss_root = ET.fromstring(ss_content)
-                si_elements = [el for el in ss_root.findall('.//')if el.tag.endswith('si')]
-                for si in si_elements:
-                    t_elements = [el for el in si.findall('.//')if el.tag.endswith('t')]
-                    if t_elements:
-                        shared_strings.append(t_elements[0].text or '')
-                    else:
-                        shared_strings.append('')
-            
-            # Читаем ячейки первой строки
-            first_row = rows[0]
-            cells = [el for el in first_row.findall('.//')if el.tag.endswith('c')]
-            
-            columns = []
-            for i, cell in enumerate(cells, 1):
-                cell_type = cell.get('t')
-                v_elements = [el for el in cell.findall('.//')if el.tag.endswith('v')]
-                
-                if v_elements and v_elements[0].text:
-                    value = v_elements[0].text
-                    # Если тип 's' - это индекс в sharedStrings
-                    if cell_type == 's' and value.isdigit():
-                        idx = int(value)
-                        if idx < len(shared_strings):
-                            columns.append(shared_strings[idx])
-                        else:
-                            columns.append(f"Column_{i}")
-                    else:
-                        columns.append(str(value))
-                else:
-                    columns.append(f"Column_{i}")
-            
-            return columns if columns else []
-            
+        first_row = next(_iter_zip_rows(filepath, sheet_name), None)
+        if not first_row:
+            return []
+        return [str(value) if value is not None and str(value) != '' else f"Column_{i}"
+                for i, value in enumerate(first_row, 1)]
     except Exception:
         return []
 
 
+# Встроенные форматы чисел Excel, означающие дату/время
+EXCEL_DATE_FORMAT_IDS = set(range(14, 23)) | set(range(27, 37)) | set(range(45, 48)) | set(range(50, 59))
+
+
+def _local_name(tag: str) -> str:
+    """Имя XML-элемента без namespace (strict и transitional OOXML)."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _zip_book(filepath: str) -> dict:
+    """Общие части книги XLSX для построчного чтения листов: пути листов,
+    общие строки, стили дат, система дат. Кешируется на версию файла,
+    поэтому несколько листов одной книги не разбирают sharedStrings заново.
+    """
+    st = os.stat(filepath)
+    return _zip_book_cached(filepath, st.st_size, st.st_mtime_ns)
+
+
+def _zip_workbook(z: zipfile.ZipFile) -> tuple:
+    """(имя листа -> путь части в ZIP, система дат 1904) из xl/workbook.xml
+    и его связей — без общих строк и стилей."""
+    wb_root = ET.fromstring(z.read('xl/workbook.xml'))
+    targets = _zip_rel_targets(z, 'xl/_rels/workbook.xml.rels')
+    parts, date1904 = {}, False
+    for el in wb_root.iter():
+        tag = _local_name(el.tag)
+        if tag == 'sheet':
+            rid = next((v for k, v in el.attrib.items() if _local_name(k) == 'id'), None)
+            if targets.get(rid) in z.namelist():
+                parts[el.get('name')] = targets[rid]
+        elif tag == 'workbookPr':
+            date1904 = el.get('date1904') in ('1', 'true')
+    return parts, date1904
+
+
+@lru_cache(maxsize=4)
+def _zip_book_cached(filepath: str, size: int, mtime: int) -> dict:
+    with zipfile.ZipFile(filepath, 'r') as z:
+        parts, date1904 = _zip_workbook(z)
+        return {
+            "parts": parts,
+            "strings": SharedStrings(z),
+            "date_styles": _zip_date_styles(z),
+            "date1904": date1904,
+        }
+
+
+# Общие строки книги (sharedStrings.xml): индекс смещений вместо списка строк
+SHARED_STRINGS_SPILL_BYTES = 16 * 1024 * 1024  # Больше — распакованная часть лежит на диске (mmap)
+SHARED_STRINGS_CACHE = 65536  # Сколько раскодированных строк держит LRU
+_SI_START_RE = re.compile(rb'<(?:\w+:)?si(?=[\s/>])')
+_SI_PHONETIC_RE = re.compile(rb'<((?:\w+:)?rPh)\b.*?</\1>', re.S)
+_SI_TEXT_RE = re.compile(rb'<(?:\w+:)?t(?:\s[^>]*)?>([^<]*)</(?:\w+:)?t>')
+
+
+class SharedStrings:
+    """Таблица общих строк с доступом по индексу без разбора всей части.
+
+    При создании часть распаковывается один раз (большая — во временный
+    файл, открытый через mmap) и строится массив смещений <si>. Строка
+    раскодируется при первом обращении и попадает в LRU-кеш. Один объект
+    на версию книги (_zip_book) делят чтение заголовков, предпросмотр и
+    полное чтение листа.
+    """
+
+    def __init__(self, z: zipfile.ZipFile, part: str = 'xl/sharedStrings.xml'):
+        import numpy as np
+        self._file = None
+        if part not in z.namelist():
+            self._data = b''
+            self._offsets = np.empty(0, dtype=np.int64)
+        else:
+            if z.getinfo(part).file_size > SHARED_STRINGS_SPILL_BYTES:
+                import mmap
+                self._file = tempfile.TemporaryFile()
+                with z.open(part) as f:
+                    shutil.copyfileobj(f, self._file, 1 << 20)
+                self._file.flush()
+                self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._data = z.read(part)
+            self._offsets = np.fromiter((m.start() for m in _SI_START_RE.finditer(self._data)),
+                                        dtype=np.int64)
+        self._get = lru_cache(maxsize=SHARED_STRINGS_CACHE)(self._decode)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, i: int) -> str:
+        if not 0 <= i < len(self._offsets):
+            raise IndexError(i)
+        return self._get(int(i))
+
+    def _decode(self, i: int) -> str:
+        end = self._offsets[i + 1] if i + 1 < len(self._offsets) else len(self._data)
+        fragment = self._data[self._offsets[i]:end]
+        if b'rPh' in fragment:
+            fragment = _SI_PHONETIC_RE.sub(b'', fragment)
+        text = b''.join(_SI_TEXT_RE.findall(fragment)).decode('utf-8')
+        if '&' in text:
+            import html
+            text = html.unescape(text)
+        return text
+
+    def take(self, indices):
+        """Строки по массиву индексов (object-массив); вне таблицы — None.
+        Каждая различная строка раскодируется один раз."""
+        import numpy as np
+        indices = np.asarray(indices, dtype=np.int64)
+        uniq, inverse = np.unique(indices, return_inverse=True)
+        values = np.empty(len(uniq), dtype=object)
+        values[:] = [self._get(int(i)) if 0 <= i < len(self._offsets) else None for i in uniq]
+        return values[inverse]
+
+
+def _zip_date_styles(z: zipfile.ZipFile) -> set:
+    """Индексы стилей ячеек (cellXfs), у которых формат — дата/время."""
+    if 'xl/styles.xml' not in z.namelist():
+        return set()
+    root = ET.fromstring(z.read('xl/styles.xml'))
+    custom = {}
+    for el in root.iter():
+        if _local_name(el.tag) == 'numFmt':
+            custom[int(el.get('numFmtId', -1))] = _is_date_format(el.get('formatCode', ''))
+    dates = set()
+    for el in root.iter():
+        if _local_name(el.tag) == 'cellXfs':
+            for i, xf in enumerate(x for x in el if _local_name(x.tag) == 'xf'):
+                fmt = int(xf.get('numFmtId', 0))
+                if custom.get(fmt, fmt in EXCEL_DATE_FORMAT_IDS):
+                    dates.add(i)
+    return dates
+
+
+def _is_date_format(code: str) -> bool:
+    """Пользовательский формат числа — дата/время (без текста в кавычках и [цвет])."""
+    code = re.sub(r'"[^"]*"|\\.|\[[^\]]*\]', '', code or '')
+    return bool(re.search(r'[dmyhs]', code, re.I))
+
+
+# BIFF12 (xlsb): записи styles.bin и workbook.bin для дат
+XLSB_FMT = 0x2C  # BrtFmt — пользовательский формат числа
+XLSB_XF = 0x2F  # BrtXF — стиль ячейки
+XLSB_BEGIN_CELL_XFS = 0x269  # BrtBeginCellXFs — стили ячеек (в отличие от стилей-образцов)
+XLSB_END_CELL_XFS = 0x26A
+XLSB_WB_PROP = 0x99  # BrtWbProp — свойства книги (система дат 1904)
+
+
+def _xlsb_date_styles(z: zipfile.ZipFile) -> tuple:
+    """(индексы стилей ячеек с форматом даты/времени, система дат 1904) книги XLSB."""
+    date1904 = False
+    if 'xl/workbook.bin' in z.namelist():
+        for rec_type, payload in _iter_biff12_records(z.read('xl/workbook.bin')):
+            if rec_type == XLSB_WB_PROP:
+                date1904 = bool(payload[0] & 1) if payload else False
+                break
+            if rec_type == XLSB_BUNDLE_SHEET:
+                break
+    dates = set()
+    if 'xl/styles.bin' not in z.namelist():
+        return dates, date1904
+    custom, in_cell_xfs, i = {}, False, 0
+    for rec_type, payload in _iter_biff12_records(z.read('xl/styles.bin')):
+        if rec_type == XLSB_FMT:
+            fmt = int.from_bytes(payload[:2], "little")
+            custom[fmt] = _is_date_format(_read_xl_wide_string(payload, 2)[0])
+        elif rec_type == XLSB_BEGIN_CELL_XFS:
+            in_cell_xfs = True
+        elif rec_type == XLSB_END_CELL_XFS:
+            break
+        elif rec_type == XLSB_XF and in_cell_xfs:
+            fmt = int.from_bytes(payload[2:4], "little")  # ixfeParent (2) + iFmt (2)
+            if custom.get(fmt, fmt in EXCEL_DATE_FORMAT_IDS):
+                dates.add(i)
+            i += 1
+    return dates, date1904
+
+
+def _cell_column(ref: str) -> int:
+    """Номер столбца (с 0) по адресу ячейки вида "AB12"."""
+    col = 0
+    for ch in ref:
+        if not ch.isalpha():
+            break
+        col = col * 26 + ord(ch.upper()) - 64
+    return col - 1
+
+
+def _excel_datetime(serial: float, date1904: bool = False) -> datetime:
+    """Дата Excel (число дней) -> datetime с точностью до миллисекунд, как у openpyxl."""
+    from datetime import timedelta
+    base = datetime(1904, 1, 1) if date1904 else datetime(1899, 12, 30)
+    return base + timedelta(milliseconds=round(serial * 86_400_000))
+
+
+def _iter_zip_rows(filepath: str, sheet_name: str):
+    """Построчное чтение листа XLSX прямо из ZIP через iterparse.
+
+    Работает с transitional и strict OOXML и не делает предварительного
+    прохода по листу, поэтому чтение первых строк не разбирает остальные.
+    Значения — как у openpyxl (data_only): str, int/float, bool, datetime.
+    """
+    book = _zip_book(filepath)
+    part = book["parts"].get(sheet_name)
+    if not part:
+        raise Exception(f"Лист '{sheet_name}' не найден")
+    strings, date_styles, date1904 = book["strings"], book["date_styles"], book["date1904"]
+
+    with zipfile.ZipFile(filepath, 'r') as z:
+        with z.open(part) as f:
+            row, sheet_data, n_rows = [], None, 0
+            for event, el in ET.iterparse(f, events=("start", "end")):
+                tag = _local_name(el.tag)
+                if event == "start":
+                    if tag == 'sheetData':
+                        sheet_data = el
+                    continue
+                if tag == 'c':
+                    ref = el.get('r')
+                    col = _cell_column(ref) if ref else len(row)
+                    value = _cell_value(el, strings, date_styles, date1904)
+                    if col >= len(row):
+                        row.extend([None] * (col - len(row) + 1))
+                    row[col] = value
+                elif tag == 'row':
+                    yield row
+                    row = []
+                    n_rows += 1
+                    if n_rows % DEADLINE_CHECK_ROWS == 0:
+                        check_deadline()
+                    if sheet_data is not None:
+                        sheet_data.clear()
+
+
+def _cell_value(cell, strings: "SharedStrings", date_styles: set, date1904: bool):
+    """Значение ячейки <c> листа XLSX."""
+    cell_type = cell.get('t', 'n')
+    v = text = None
+    for child in cell:
+        name = _local_name(child.tag)
+        if name == 'v':
+            v = child.text
+        elif name == 'is':
+            text = ''.join(t.text or '' for t in child.iter() if _local_name(t.tag) == 't')
+    if cell_type == 'inlineStr':
+        return text
+    if v is None:
+        return None
+    if cell_type == 's':
+        return strings[int(v)] if int(v) < len(strings) else None
+    if cell_type in ('str', 'e'):
+        return v
+    if cell_type == 'b':
+        return v == '1'
+    if cell_type == 'd':
+        return datetime.fromisoformat(v)
+    number = float(v) if ('.' in v or 'E' in v or 'e' in v) else int(v)
+    if int(cell.get('s', 0)) in date_styles:
+        return _excel_datetime(number, date1904)
+    return number
+
+
+# Быстрый разбор ячеек листа XLSX регулярным выражением: подходит для
+# ячеек вида <c r="B7" s="1" t="s"><v>12</v></c> (Excel, openpyxl и strict
+# OOXML без префиксов). Группы: столбец, строка, стиль, тип, <v>, inline-текст.
+_FAST_CELL_RE = re.compile(
+    rb'<c r="([A-Z]{1,3})(\d+)"(?: s="(\d+)")?(?: t="(\w+)")? ?'
+    rb'(?:/>|>(?:<f\b[^>]*/>|<f\b[^>]*>[^<]*</f>)?(?:<v>([^<]*)</v>|<is><t(?: [^>]*)?>([^<]*)</t></is>)?</c>)'
+)
+ZIP_READ_CHUNK = 8 * 1024 * 1024  # Байт XML листа за одно чтение
+
+
+_ROW_END_RE = re.compile(rb'</(?:\w+:)?row>')
+_ROOT_TAG_RE = re.compile(rb'<(\w+:)?worksheet[\s>]')
+
+
+class _FastPathMiss(Exception):
+    """Лист содержит ячейки, которые быстрый разбор не понимает."""
+
+
+def read_sheet_from_zip(filepath: str, sheet_name: str) -> pd.DataFrame:
+    """Полное чтение листа XLSX (transitional и strict OOXML) без pandas/openpyxl-движков.
+
+    XML листа читается блоками постоянного размера, ячейки раскладываются
+    по столбцам как сырые байты и переводятся в типизированные массивы
+    numpy векторно (числа, даты, общие строки). Ячейки необычного вида
+    (префиксы namespace, rich text, ячейки без адреса) разбираются
+    построчно через _iter_zip_rows. Результат — как у pandas.read_excel:
+    первая строка — заголовок, пустые строки пропускаются.
+    """
+    import pandas as pd
+    book = _zip_book(filepath)
+    part = book["parts"].get(sheet_name)
+    if not part:
+        raise Exception(f"Лист '{sheet_name}' не найден")
+    try:
+        cells = _scan_zip_cells(filepath, part)
+    except _FastPathMiss:
+        rows = [r for r in _iter_zip_rows(filepath, sheet_name)
+                if not all(v is None or v == "" for v in r)]
+        if not rows:
+            return pd.DataFrame()
+        width = max(len(r) for r in rows)
+        header = _header_names((rows[0] + [None] * width)[:width])
+        return pd.DataFrame([(r + [None] * width)[:width] for r in rows[1:]],
+                            columns=header).infer_objects()
+    return _cells_to_frame(cells, book)
+
+
+def _scan_zip_cells(filepath: str, part: str) -> dict:
+    """Сырые ячейки листа по столбцам: {столбец: (строки, стили, типы, <v>, текст)}.
+    Адреса, стили и типы — байтовые массивы numpy, значения — object-массивы bytes.
+    """
+    import numpy as np
+    pieces = {}
+    rows_seen = False
+    with zipfile.ZipFile(filepath, 'r') as z:
+        with z.open(part) as f:
+            rest, first = b'', True
+            while True:
+                check_deadline()
+                chunk = f.read(ZIP_READ_CHUNK)
+                if first:
+                    # Элементы с префиксом namespace (<x:row>, <x:c>) — построчно
+                    root = _ROOT_TAG_RE.search(chunk)
+                    if root is None or root.group(1):
+                        raise _FastPathMiss()
+                    first = False
+                data = rest + chunk
+                if chunk:
+                    # Разбираем только целые строки листа, хвост — со следующим блоком
+                    cut = _last_row_end(data)
+                    if cut < 0:
+                        rest = data
+                        continue
+                    data, rest = data[:cut], data[cut:]
+                matches = _FAST_CELL_RE.findall(data)
+                if len(matches) != data.count(b'<c ') + data.count(b'<c>'):
+                    raise _FastPathMiss()
+                if not pieces and not matches:
+                    rows_seen = rows_seen or _ROW_TAG_RE.search(data) is not None
+                if matches:
+                    letters, rows, styles, types, values, texts = zip(*matches)
+                    arrays = (np.array(rows), np.array(styles), np.array(types),
+                              np.array(values, dtype=object), np.array(texts, dtype=object))
+                    # Раскладываем блок по столбцам одной сортировкой
+                    uniq, inverse = np.unique(np.array(letters), return_inverse=True)
+                    order = np.argsort(inverse, kind="stable")
+                    bounds = np.searchsorted(inverse[order], np.arange(len(uniq) + 1))
+                    for i, col_letters in enumerate(uniq):
+                        take = order[bounds[i]:bounds[i + 1]]
+                        col = _cell_column(col_letters.decode())
+                        pieces.setdefault(col, []).append(tuple(a[take] for a in arrays))
+                if not chunk:
+                    break
+    if not pieces and rows_seen:
+        # Строки есть, а ячеек не нашлось — разметка не того вида, что ждёт разбор
+        raise _FastPathMiss()
+    return {col: tuple(np.concatenate(parts) for parts in zip(*chunks))
+            for col, chunks in pieces.items()}
+
+
+def _last_row_end(data: bytes) -> int:
+    """Позиция сразу за последним закрывающим тегом строки (</row>, </x:row>) или -1."""
+    end = len(data)
+    while True:
+        pos = data.rfind(b'row>', 0, end)
+        if pos < 0:
+            return -1
+        start = data.rfind(b'<', 0, pos)
+        if start >= 0 and _ROW_END_RE.fullmatch(data, start, pos + 4):
+            return pos + 4
+        end = pos
+
+
+def _xml_text(raw: bytes) -> str:
+    text = raw.decode('utf-8')
+    if '&' in text:
+        import html
+        text = html.unescape(text)
+    return text
+
+
+def _excel_datetimes(numbers, date1904: bool = False):
+    """Векторный _excel_datetime: float-массив дней -> datetime64[us] с точностью
+    до миллисекунд (NaN -> NaT)."""
+    import numpy as np
+    base = np.datetime64('1904-01-01' if date1904 else EXCEL_EPOCH, 'us')
+    ms = np.round(numbers * 86_400_000)
+    out = np.full(len(numbers), np.datetime64('NaT'), dtype='datetime64[us]')
+    ok = np.isfinite(ms)
+    out[ok] = base + ms[ok].astype(np.int64).astype('timedelta64[ms]')
+    return out
+
+
+def _zip_column_values(lists: tuple, book: dict):
+    """Значения одного столбца (numpy-массив) из сырых ячеек _scan_zip_cells."""
+    import numpy as np
+    _, styles, types, values, texts = lists
+    numeric = (types == b'') | (types == b'n')
+    empty = values == b''
+    date_styles = [str(s).encode() for s in book["date_styles"]]
+    is_date = numeric & ~empty & (np.isin(styles, date_styles) if date_styles else False)
+
+    if numeric.all():
+        numbers = np.where(empty, b'nan', values).astype(np.float64)
+        if is_date.any() and (is_date | empty).all():
+            return _excel_datetimes(numbers, book["date1904"])
+        if not is_date.any():
+            # Чисто числовой столбец: int64, если нет пропусков и дробей, иначе float64
+            if not empty.any() and not any(b'.' in v or b'e' in v or b'E' in v for v in values):
+                try:
+                    return values.astype(np.int64)
+                except (ValueError, OverflowError):
+                    pass
+            return numbers
+
+    out = np.full(len(values), None, dtype=object)
+    plain = numeric & ~is_date & ~empty
+    if plain.any():
+        out[plain] = [float(v) if (b'.' in v or b'e' in v or b'E' in v) else int(v) for v in values[plain]]
+    if is_date.any():
+        out[is_date] = [_excel_datetime(float(v), book["date1904"]) for v in values[is_date]]
+    shared = (types == b's') & ~empty
+    if shared.any():
+        out[shared] = book["strings"].take(values[shared].astype(np.int64))
+    inline = types == b'inlineStr'
+    if inline.any():
+        out[inline] = [_xml_text(t) for t in texts[inline]]
+    for pos in np.flatnonzero(~numeric & ~inline & (types != b's') & ~empty):
+        cell_type, v = types[pos], values[pos]
+        if cell_type == b'b':
+            out[pos] = v == b'1'
+        elif cell_type == b'd':
+            out[pos] = datetime.fromisoformat(v.decode())
+        else:  # str, e
+            out[pos] = _xml_text(v)
+    return out
+
+
+def _cells_to_frame(cells: dict, book: dict) -> pd.DataFrame:
+    """DataFrame из столбцов _scan_zip_cells: заголовок — первая непустая строка.
+    Ячейки заголовка отделяются до перевода значений, чтобы столбцы данных
+    получили свой тип (числа, даты), а не object из-за текста заголовка.
+    """
+    import numpy as np
+    import pandas as pd
+    raw_rows = {col: lists[0].astype(np.int64) for col, lists in cells.items()}
+    starts = [rows[(lists[3] != b'') | (lists[4] != b'')].min(initial=np.iinfo(np.int64).max)
+              for rows, lists in zip(raw_rows.values(), cells.values())]
+    if not starts or min(starts) == np.iinfo(np.int64).max:
+        return pd.DataFrame()
+    header_row = min(starts)
+
+    width = max(cells) + 1
+    header = [None] * width
+    columns, present = {}, []
+    for col, lists in cells.items():
+        rows = raw_rows[col]
+        at_header = rows == header_row
+        if at_header.any():
+            value = _zip_column_values(tuple(a[at_header] for a in lists), book)[0]
+            header[col] = value.item() if hasattr(value, "item") else value
+        body = rows > header_row
+        rows = rows[body]
+        values = _zip_column_values(tuple(a[body] for a in lists), book)
+        if values.dtype == object:
+            # Пустая строка — пропуск, как у pandas.read_excel
+            filled = np.array([v is not None and v != "" for v in values], dtype=bool)
+            values[~filled] = np.nan
+            rows_filled = rows[filled]
+        elif values.dtype.kind in "fM":
+            rows_filled = rows[~pd.isna(values)]
+        else:
+            rows_filled = rows
+        columns[col] = (rows, values)
+        present.append(rows_filled)
+    data_rows = np.unique(np.concatenate(present))  # Строки хотя бы с одним значением
+
+    data = {}
+    for col in range(width):
+        rows, values = columns.get(col, (np.empty(0, np.int64), np.empty(0, object)))
+        # Строки без значений в этом столбце (и пустые строки листа) — пропуски
+        pos = np.searchsorted(data_rows, rows)
+        keep = (pos < len(data_rows)) & (data_rows[np.minimum(pos, max(len(data_rows) - 1, 0))] == rows)
+        pos, values = pos[keep], values[keep]
+        if values.dtype.kind in "ifM" and len(pos) == len(data_rows):
+            data[col] = values
+            continue
+        if values.dtype.kind in "if":
+            full = np.full(len(data_rows), np.nan)
+        elif values.dtype.kind == "M":
+            full = np.full(len(data_rows), np.datetime64('NaT'), dtype=values.dtype)
+        else:
+            full = np.full(len(data_rows), np.nan, dtype=object)
+        full[pos] = values
+        data[col] = full
+    df = pd.DataFrame({i: data[i] for i in range(width)})
+    df.columns = _header_names(header)
+    return df.infer_objects()
+
+
+_DIMENSION_RE = re.compile(rb'<(?:\w+:)?dimension\s+ref="([A-Za-z]*)(\d*)(?::([A-Za-z]+)(\d+))?"')
+
+
+def _column_number(letters: str) -> int:
+    n = 0
+    for ch in letters.upper():
+        n = n * 26 + ord(ch) - 64
+    return n
+
+
+_ROW_TAG_RE = re.compile(rb'<(?:\w+:)?row[\s>]')
+_CELL_TAG_RE = re.compile(rb'<(?:\w+:)?c[\s>]')
+
+
+def _xml_dimension(z: zipfile.ZipFile, part: str, part_bytes: int):
+    """(строк, столбцов, оценка ли) для листа XLSX: из <dimension ref>, а если
+    его нет — по первым строкам (байт на строку, ячеек в строке) или None."""
+    with z.open(part) as f:
+        head = f.read(SCAN_HEAD_BYTES)
+    m = _DIMENSION_RE.search(head)
+    if m and m.group(2):
+        c1, r1, c2, r2 = (g.decode() if g else None for g in m.groups())
+        if c2 is None:
+            return 1, 1, False
+        return int(r2) - int(r1) + 1, _column_number(c2) - _column_number(c1) + 1, False
+    starts = [r.start() for r in _ROW_TAG_RE.finditer(head)]
+    if len(starts) < 2:
+        return None
+    bytes_per_row = (starts[-1] - starts[0]) / (len(starts) - 1)
+    cells = len(_CELL_TAG_RE.findall(head, starts[0], starts[-1]))
+    return int(part_bytes / bytes_per_row), max(round(cells / (len(starts) - 1)), 1), True
+
+
+def _xlsb_dimension(z: zipfile.ZipFile, part: str):
+    """(строк, столбцов, оценка ли) из записи BrtWsDim листа XLSB или None."""
+    import struct
+    with z.open(part) as f:
+        head = f.read(SCAN_HEAD_BYTES)
+    try:
+        for rec_type, payload in _iter_biff12_records(head):
+            if rec_type == XLSB_WS_DIM and len(payload) >= 16:
+                r1, r2, c1, c2 = struct.unpack_from("<4I", payload)
+                return r2 - r1 + 1, c2 - c1 + 1, False
+    except IndexError:
+        pass  # Запись обрезана границей прочитанного начала
+    return None
+
+
+def prescan_workbook(filepath: str, engine) -> dict:
+    """Дешёвая оценка размеров книги до разбора листов.
+
+    Берёт из каталога ZIP размер каждого листа (сжатый и распакованный) и
+    диапазон <dimension ref> (BrtWsDim для XLSB) из начала листа. Если
+    диапазона нет или он явно меньше объёма XML, строки оцениваются по
+    размеру XML. Это только оценка; по ней выбираются потоковое чтение и
+    проекция столбцов (plan_sheet).
+    Кешируется на версию файла.
+    """
+    st = os.stat(filepath)
+    return _prescan_cached(filepath, engine, st.st_size, st.st_mtime_ns)
+
+
+@lru_cache(maxsize=32)
+def _prescan_cached(filepath: str, engine, size: int, mtime: int) -> dict:
+    scan = {"file_bytes": size, "sheets": {}}
+    xlsb = engine == "pyxlsb"
+    with zipfile.ZipFile(filepath, 'r') as z:
+        # Только пути листов: общие строки и стили оценке не нужны
+        parts = dict(_get_xlsb_sheet_parts(filepath)) if xlsb else _zip_workbook(z)[0]
+        for name, part in parts.items():
+            try:
+                info = z.getinfo(part)
+            except KeyError:
+                continue
+            dim = _xlsb_dimension(z, part) if xlsb else _xml_dimension(z, part, info.file_size)
+            rows, cols, estimated = dim or (0, 0, True)
+            by_bytes = info.file_size // XML_BYTES_PER_CELL
+            if rows * cols * 10 < by_bytes:
+                # Диапазона нет или он не соответствует объёму листа
+                cols = max(cols, 1)
+                rows, estimated = max(by_bytes // cols, rows), True
+            sheet = {
+                "rows": rows,
+                "cols": cols,
+                "estimated": estimated,
+                "part_bytes": info.file_size,
+                "compressed_bytes": info.compress_size,
+                "memory_bytes": rows * cols * MEMORY_PER_CELL,
+            }
+            sheet.update(plan_sheet(sheet))
+            scan["sheets"][name] = sheet
+    return scan
+
+
+def plan_sheet(sheet: dict) -> dict:
+    """Стратегия чтения листа по оценке prescan_workbook:
+    strategy — "memory" (лист целиком) или "streaming" (блоками),
+    projected — читать только нужные столбцы (для листа базы, если он
+    шире PROJECT_MIN_COLUMNS). Движок оценка не выбирает: чтение листа
+    целиком всегда начинается с calamine (_read_sheet_attempts).
+    """
+    return {
+        "strategy": "streaming" if sheet["memory_bytes"] >= STREAM_MIN_MEMORY else "memory",
+        "projected": sheet["cols"] > PROJECT_MIN_COLUMNS,
+    }
+
+
+def sheet_scan(filepath: str, engine, sheet_name: str) -> Optional[dict]:
+    """Оценка одного листа или None (книга не ZIP, лист не найден, ошибка)."""
+    try:
+        return prescan_workbook(filepath, engine)["sheets"].get(sheet_name)
+    except Exception:
+        return None
+
+
 def get_columns(filepath: str, engine, sheet_name: str) -> list:
     """Возвращает список столбцов указанного листа."""
     # Попытка 0: Низкоуровневое чтение из ZIP (для strict OOXML)
@@ -252,6 +998,7 @@ def get_columns(filepath: str, engine, sheet_name: str) -> list:
             return cols
     
     # Попытка 1: pandas
+    import pandas as pd
     try:
         df = pd.read_excel(filepath, engine=engine, sheet_name=sheet_name, nrows=0)
         return [str(c) for c in df.columns.tolist()]
@@ -320,31 +1067,72 @@ def auto_detect_columns(columns: list) -> dict:
 
 def _read_sheet_safe(filepath: str, engine, sheet_name: str) -> pd.DataFrame:
     """Безопасное чтение листа Excel с fallback для проблемных файлов."""
-    # Попытка 0: calamine engine для strict OOXML (лучший вариант)
-    if engine == "openpyxl":
+    from .tracing import span
+    with span("read_sheet", sheet=sheet_name, engine=str(engine)) as sp:
+        if sp:
+            sp.set(file=os.path.basename(filepath), bytes=os.path.getsize(filepath))
+        df = _read_sheet_attempts(filepath, engine, sheet_name)
+        if sp:
+            sp.set(rows=len(df), cols=len(df.columns))
+        return df
+
+
+def _read_sheet_attempts(filepath: str, engine, sheet_name: str) -> pd.DataFrame:
+    """Попытки чтения листа по очереди, до первой удачной (в трассировке — read_attempt)."""
+    import pandas as pd
+    from .tracing import span
+    # Перед каждой попыткой — проверка бюджета времени: ошибки попыток
+    # глотаются, а ProcessingStopped должен прервать всю цепочку
+    check_deadline()
+    # Попытка 0: calamine engine для strict OOXML (лучший вариант); он же
+    # читает XLSB быстрее pyxlsb (см. plan_sheet), даты при этом — datetime
+    if engine in ("openpyxl", "pyxlsb"):
         try:
-            return pd.read_excel(filepath, engine="calamine", sheet_name=sheet_name)
-        except (ValueError, KeyError, ImportError):
+            with span("read_attempt", method="calamine"):
+                return pd.read_excel(filepath, engine="calamine", sheet_name=sheet_name)
+        except ProcessingStopped:
+            raise
+        except Exception:
+            # CalamineError и прочие отказы calamine — дальше по списку (для XLSB — pyxlsb)
             pass
         
         # Если не нашли по имени, пробуем по индексу с calamine
+        check_deadline()
         try:
-            sheets = get_sheet_names(filepath, engine)
-            if sheet_name in sheets:
-                idx = sheets.index(sheet_name)
-                return pd.read_excel(filepath, sheet_name=idx, engine="calamine")
-        except (ValueError, KeyError, ImportError, Exception):
+            with span("read_attempt", method="calamine_index"):
+                sheets = get_sheet_names(filepath, engine)
+                if sheet_name in sheets:
+                    idx = sheets.index(sheet_name)
+                    return pd.read_excel(filepath, sheet_name=idx, engine="calamine")
+        except ProcessingStopped:
+            raise
+        except Exception:
+            pass
+        
+        # Собственный потоковый разбор ZIP/XML (strict OOXML, который не
+        # прочитал calamine) — до полных загрузок книги через pandas/openpyxl
+        check_deadline()
+        try:
+            with span("read_attempt", method="zip"):
+                return read_sheet_from_zip(filepath, sheet_name)
+        except ProcessingStopped:
+            raise
+        except Exception:
             pass
     
+    check_deadline()
     # Попытка 1: стандартное чтение по имени
     try:
-        return pd.read_excel(filepath, engine=engine, sheet_name=sheet_name)
+        with span("read_attempt", method="engine"):
+            return pd.read_excel(filepath, engine=engine, sheet_name=sheet_name)
     except (ValueError, KeyError):
         pass
     
+    check_deadline()
     # Попытка 2: читаем все листы и ищем нужный
     try:
-        all_sheets = pd.read_excel(filepath, sheet_name=None, engine=engine)
+        with span("read_attempt", method="engine_all"):
+            all_sheets = pd.read_excel(filepath, sheet_name=None, engine=engine)
         if sheet_name in all_sheets:
             return all_sheets[sheet_name]
         # Ищем с учётом регистра
@@ -354,15 +1142,19 @@ def _read_sheet_safe(filepath: str, engine, sheet_name: str) -> pd.DataFrame:
     except Exception:
         pass
     
+    check_deadline()
     # Попытка 3: читаем без engine
     try:
-        return pd.read_excel(filepath, sheet_name=sheet_name)
+        with span("read_attempt", method="default"):
+            return pd.read_excel(filepath, sheet_name=sheet_name)
     except (ValueError, KeyError):
         pass
     
+    check_deadline()
     # Попытка 4: читаем все листы без engine
     try:
-        all_sheets = pd.read_excel(filepath, sheet_name=None)
+        with span("read_attempt", method="default_all"):
+            all_sheets = pd.read_excel(filepath, sheet_name=None)
         if sheet_name in all_sheets:
             return all_sheets[sheet_name]
         for name, df in all_sheets.items():
@@ -371,27 +1163,207 @@ def _read_sheet_safe(filepath: str, engine, sheet_name: str) -> pd.DataFrame:
     except Exception:
         pass
     
+    check_deadline()
     # Попытка 5: используем индекс листа (получаем список листов и находим индекс)
     try:
-        sheets = get_sheet_names(filepath, engine)
-        if sheet_name in sheets:
-            idx = sheets.index(sheet_name)
-            return pd.read_excel(filepath, sheet_name=idx, engine=engine)
+        with span("read_attempt", method="engine_index"):
+            sheets = get_sheet_names(filepath, engine)
+            if sheet_name in sheets:
+                idx = sheets.index(sheet_name)
+                return pd.read_excel(filepath, sheet_name=idx, engine=engine)
     except Exception:
         pass
     
+    check_deadline()
     # Попытка 6: последний шанс - без engine по индексу
     try:
-        sheets = get_sheet_names(filepath, engine)
-        if sheet_name in sheets:
-            idx = sheets.index(sheet_name)
-            return pd.read_excel(filepath, sheet_name=idx)
+        with span("read_attempt", method="default_index"):
+            sheets = get_sheet_names(filepath, engine)
+            if sheet_name in sheets:
+                idx = sheets.index(sheet_name)
+                return pd.read_excel(filepath, sheet_name=idx)
     except Exception:
         pass
     
+    check_deadline()
     raise Exception(f"Не удалось прочитать лист '{sheet_name}' из файла")
 
 
+def read_sheet_columns(filepath: str, engine, sheet_name: str, columns: list) -> pd.DataFrame:
+    """Чтение только нужных столбцов листа (проекция): для широких листов
+    базы не строятся столбцы, которые не используются. Если выбрать столбцы
+    при чтении не удалось — лист читается целиком и столбцы берутся из него.
+    """
+    import pandas as pd
+    check_deadline()
+    try:
+        df = pd.read_excel(filepath, engine="calamine", sheet_name=sheet_name, usecols=columns)
+        if set(df.columns) == set(columns):
+            return df[columns]
+    except Exception:
+        pass
+    return _read_sheet_safe(filepath, engine, sheet_name)[columns]
+
+
+@lru_cache(maxsize=65536)
+def _parse_year_str(raw: str) -> int:
+    """Год из строковой даты по DATE_FORMATS (каждое значение парсится один раз)."""
+    date_str = raw.strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(date_str, fmt).year
+        except ValueError:
+            continue
+    return YEAR_MISSING
+
+
+def _serials_to_years(serials) -> np.ndarray:
+    """Excel serial (дни от 30.12.1899) -> годы, арифметикой над массивом."""
+    import numpy as np
+    serials = np.asarray(serials, dtype="float64")
+    valid = np.isfinite(serials) & (serials >= 1) & (serials <= EXCEL_SERIAL_MAX)
+    days = np.where(valid, np.floor(serials), 0).astype("int64")
+    dates = np.datetime64(EXCEL_EPOCH) + days.astype("timedelta64[D]")
+    years = dates.astype("datetime64[Y]").astype("int64") + 1970
+    return np.where(valid, years, YEAR_MISSING).astype("int16")
+
+
+def dates_to_years(values) -> np.ndarray:
+    """Векторно переводит столбец дат в массив годов (int16).
+
+    Понимает Timestamp/datetime, Excel serial (числа из pyxlsb) и строки
+    в форматах DATE_FORMATS. Каждое уникальное значение разбирается один раз,
+    пустые и нераспознанные значения получают YEAR_MISSING.
+    """
+    import numpy as np
+    import pandas as pd
+    s = pd.Series(values)
+    if len(s) == 0:
+        return np.empty(0, dtype="int16")
+
+    if pd.api.types.is_datetime64_any_dtype(s.dtype):
+        return s.dt.year.fillna(YEAR_MISSING).to_numpy(dtype="int16")
+    if pd.api.types.is_numeric_dtype(s.dtype) and not pd.api.types.is_bool_dtype(s.dtype):
+        return _serials_to_years(s.to_numpy(dtype="float64", na_value=np.nan))
+
+    # Смешанный столбец: разбираем только уникальные значения
+    codes, uniques = pd.factorize(s)
+    uniq_years = np.full(len(uniques), YEAR_MISSING, dtype="int16")
+    numeric_pos = []
+    for i, val in enumerate(uniques):
+        if isinstance(val, (pd.Timestamp, datetime)):
+            uniq_years[i] = val.year
+        elif isinstance(val, (int, float, np.integer, np.floating)) and not isinstance(val, (bool, np.bool_)):
+            numeric_pos.append(i)
+        elif isinstance(val, str):
+            uniq_years[i] = _parse_year_str(val)
+    if numeric_pos:
+        uniq_years[numeric_pos] = _serials_to_years([uniques[i] for i in numeric_pos])
+
+    years = uniq_years[codes]
+    years[codes < 0] = YEAR_MISSING
+    return years
+
+
+def _age_labels(years: np.ndarray) -> np.ndarray:
+    """Массив годов -> значения столбца 'Оборудование устарело'."""
+    import numpy as np
+    labels = np.full(len(years), "Не найдено в базе данных", dtype=object)
+    known = years != YEAR_MISSING
+    ages = CURRENT_YEAR - years.astype("int32")
+    labels[known & (ages <= TECH_REFRESH_YEARS)] = "Нет"
+    # Подписи строим по уникальным возрастам, а не по строкам
+    for age in np.unique(ages[known & (ages > TECH_REFRESH_YEARS)]):
+        prefix = "Да" if age <= CRITICAL_AGE_YEARS else "Критично"
+        labels[known & (ages == age)] = f"{prefix}, {_pluralize_years(int(age))}"
+    return labels
+
+
+def normalize_serials(values) -> pd.Series:
+    """Приводит серийные номера к ключу сравнения: строка без пробелов по краям
+    в нижнем регистре. Пустые значения остаются NaN.
+    """
+    import pandas as pd
+    s = pd.Series(values)
+    normalized = s.astype(str).str.strip().str.lower()
+    return normalized.mask(s.isna() | (normalized == ""))
+
+
+def encode_serials(*columns) -> tuple:
+    """Нормализует несколько столбцов серийников и кодирует их одним словарём.
+
+    Возвращает (список массивов кодов int64 по столбцам, pd.Index уникальных
+    серийников). Одинаковые серийники в разных столбцах получают один код,
+    пустые — код -1, поэтому сверка и поиск дат сводятся к операциям над
+    целочисленными массивами.
+    """
+    import numpy as np
+    import pandas as pd
+    normalized = [normalize_serials(col) for col in columns]
+    if not normalized:
+        return [], pd.Index([], dtype=object)
+    codes, uniques = pd.factorize(pd.concat(normalized, ignore_index=True))
+    bounds = np.cumsum([0] + [len(col) for col in normalized])
+    return [codes[bounds[i]:bounds[i + 1]] for i in range(len(normalized))], uniques
+
+
+def join_base_years(base_codes: np.ndarray, base_years: np.ndarray, n_keys: int,
+                    policy: str = "last") -> tuple:
+    """Строит таблицу «код серийника -> год» по строкам базы данных.
+
+    Вместо dict по всей базе используется сортировка кодов: для каждого кода
+    выбирается одна строка согласно policy:
+      first  — первая строка в базе, last — последняя (как раньше в dict),
+      oldest — самый ранний известный год, newest — самый поздний.
+    Возвращает (массив int16 длиной n_keys, статистика).
+    Статистика: число дублирующихся серийников, лишних строк и суммарный
+    объём массивов, выделенных под соединение (join_array_bytes — не замер
+    пика памяти процесса; его даёт профиль памяти, см. profiling).
+    """
+    import numpy as np
+    if policy not in DUPLICATE_POLICIES:
+        raise ValueError(f"Неизвестная политика дубликатов '{policy}'. "
+                         f"Допустимые: {', '.join(DUPLICATE_POLICIES)}")
+
+    valid = base_codes >= 0
+    codes = base_codes[valid]
+    years = base_years[valid]
+    if policy in ("oldest", "newest"):
+        # Строки без даты уходят в конец группы и выбираются, только если
+        # у серийника нет ни одной известной даты
+        year_key = years.astype("int32") if policy == "oldest" else -years.astype("int32")
+        year_key[years == YEAR_MISSING] = np.iinfo("int32").max
+        order = np.lexsort((year_key, codes))
+    elif policy == "first":
+        order = np.argsort(codes, kind="stable")
+    else:
+        # Стабильная сортировка перевёрнутого массива ставит последнюю строку группы первой
+        order = len(codes) - 1 - np.argsort(codes[::-1], kind="stable")
+
+    # После сортировки берём первую строку каждой группы одинаковых кодов
+    sorted_codes = codes[order]
+    group_start = np.ones(len(sorted_codes), dtype=bool)
+    group_start[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    picked = order[group_start]
+
+    year_by_code = np.full(n_keys, YEAR_MISSING, dtype="int16")
+    year_by_code[codes[picked]] = years[picked]
+
+    unique_keys = int(group_start.sum())
+    counts = np.diff(np.append(np.flatnonzero(group_start), len(sorted_codes)))
+    stats = {
+        "duplicate_policy": policy,
+        "base_rows": int(len(base_codes)),
+        "base_unique_serials": unique_keys,
+        "duplicate_serials": int((counts > 1).sum()),
+        "duplicate_rows": int(len(codes) - unique_keys),
+        "join_array_bytes": int(codes.nbytes + years.nbytes + order.nbytes
+                                + sorted_codes.nbytes + group_start.nbytes
+                                + year_by_code.nbytes),
+    }
+    return year_by_code, stats
+
+
 def process_excels(
     path1: str,
     path2: str,
@@ -405,6 +1377,12 @@ def process_excels(
     date_col2: str,
     compare: bool = True,
     tech_refresh: bool = True,
+    duplicate_policy: str = "last",
+    stats: Optional[dict] = None,
+    base_index=None,
+    stock_check: str = "exact",
+    streaming: Optional[bool] = None,
+    output_format: str = "xlsx",
 ) -> str:
     """
     Основная логика:
@@ -412,84 +1390,466 @@ def process_excels(
     2. Добавляет столбец 'Передано на склад' (если compare=True).
     3. Если tech_refresh=True — сравнивает серийники с базой данных, 
        берет дату из базы и определяет устаревание (>5 лет).
-    Возвращает путь к результирующему .xlsx файлу.
+       Дубликаты серийников в базе разрешаются по duplicate_policy.
+    Готовый индекс базы (base_index.BaseIndex) можно передать, чтобы не
+    перечитывать базу для каждого файла.
+    stock_check — проверка ложных срабатываний фильтра склада (base_index.STOCK_CHECKS).
+    streaming — потоковая обработка (см. process_excels_stream); None — для
+    файлов от STREAM_MIN_BYTES.
+    output_format — формат результата (result_formats.RESULT_FORMATS).
+    Если передан словарь stats — заполняет его статистикой обработки.
+    Возвращает путь к файлу результата.
     """
-    df1 = _read_sheet_safe(path1, engine1, sheet1)
-    df2 = _read_sheet_safe(path2, engine2, sheet2)
+    from .profiling import memory_stage
+    from .tracing import span
+    if stats is None:
+        stats = {}
 
-    # Сверка серийных номеров (опционально)
-    if compare:
-        # Читаем лист "Возврат" из базы данных для сверки
+    # Индекс базы: один словарь серийников базы и листа "Возврат"
+    if base_index is None:
+        with memory_stage("base_index"):
+            base_index = _build_index(path2, engine2, sheet2, serial_col2, date_col2,
+                                      duplicate_policy, compare, tech_refresh)
+
+    if streaming is None:
+        # По оценке листа; если книгу не удалось оценить — по размеру файла
+        scan = sheet_scan(path1, engine1, sheet1)
+        streaming = scan["strategy"] == "streaming" if scan else os.path.getsize(path1) >= STREAM_MIN_BYTES
+    if streaming:
         try:
-            df_return = _read_sheet_safe(path2, engine2, "Возврат")
-            
-            # Приводим серийные номера к строковому типу и убираем пробелы
-            df1[serial_col1] = df1[serial_col1].astype(str).str.strip().str.lower()
-            
-            # Проверяем, есть ли столбец serial_col2 на листе "Возврат"
-            if serial_col2 in df_return.columns:
-                df_return[serial_col2] = df_return[serial_col2].astype(str).str.strip().str.lower()
-                serials_on_stock = set(df_return[serial_col2])
-            else:
-                # Если столбца нет, пробуем автоопределить
-                detected = auto_detect_columns(df_return.columns.tolist())
-                if detected["serial"]:
-                    df_return[detected["serial"]] = df_return[detected["serial"]].astype(str).str.strip().str.lower()
-                    serials_on_stock = set(df_return[detected["serial"]])
-                else:
-                    # Если не удалось определить, считаем что на складе ничего нет
-                    serials_on_stock = set()
-            
-            # Векторизованное сравнение серийных номеров
-            df1["Передано на склад"] = df1[serial_col1].isin(serials_on_stock).map(
-                {True: "Да", False: "Нет"}
-            )
+            with memory_stage("stream"), span("stream", sheet=sheet1) as sp:
+                out_path = process_excels_stream(path1, engine1, sheet1, serial_col1, base_index,
+                                                 compare, tech_refresh, stats, stock_check,
+                                                 output_format=output_format)
+                if sp:
+                    sp.set(rows=stats["total_rows"])
+                return out_path
+        except ProcessingStopped:
+            raise
         except Exception:
-            # Если лист "Возврат" не найден или ошибка чтения
+            # Лист не удалось прочитать построчно — обычный путь
+            stats.clear()
+            _reset_detail()
+
+    with memory_stage("read"):
+        df1 = _read_sheet_safe(path1, engine1, sheet1)
+    stats.update(base_index.stats)
+    with memory_stage("enrich"):
+        _enrich_frame(df1, serial_col1, base_index, compare, tech_refresh, stats, stock_check, sheet1)
+    check_deadline()
+
+    from .result_formats import RESULT_FORMATS, write_frame
+    from .tracing import span
+    out_path = _result_path(RESULT_FORMATS[output_format][0])
+    with memory_stage("write"), span("write", format=output_format, rows=len(df1)) as sp:
+        write_frame(df1, out_path, output_format)
+        if sp:
+            sp.set(bytes=os.path.getsize(out_path))
+    return out_path
+
+
+def _iter_sheet_rows(filepath: str, engine, sheet_name: str):
+    """Построчное чтение листа (списки значений) без загрузки его целиком."""
+    if engine == "pyxlsb":
+        yield from _iter_xlsb_rows(filepath, sheet_name)
+        return
+
+    try:
+        rows = _iter_zip_rows(filepath, sheet_name)
+        first = next(rows, None)
+    except ProcessingStopped:
+        raise
+    except Exception:
+        rows = first = None
+    if rows is not None:
+        if first is not None:
+            yield first
+            yield from rows
+    else:
+        # Не удалось разобрать ZIP напрямую — openpyxl read_only
+        import openpyxl
+        wb = openpyxl.load_workbook(filepath, read_only=True, data_only=True)
+        try:
+            for i, row in enumerate(wb[sheet_name].iter_rows(values_only=True), 1):
+                if i % DEADLINE_CHECK_ROWS == 0:
+                    check_deadline()
+                yield list(row)
+        finally:
+            wb.close()
+
+
+def _iter_xlsb_rows(filepath: str, sheet_name: str):
+    """Построчное чтение листа XLSB записями pyxlsb (BIFF12Reader).
+
+    Sheet.rows() у pyxlsb теряет стиль ячейки, поэтому записи листа читаются
+    напрямую: числа в ячейках с форматом даты — datetime, целые — int, как
+    у calamine при чтении листа целиком (иначе серийник 12345 станет
+    "12345.0", а дата — числом Excel).
+    """
+    from pyxlsb import biff12, open_workbook
+    from pyxlsb.reader import BIFF12Reader
+    parts = {name.lower(): part for name, part in _get_xlsb_sheet_parts(filepath)}
+    if sheet_name.lower() not in parts:
+        raise Exception(f"Лист '{sheet_name}' не найден")
+    with open_workbook(filepath) as wb, zipfile.ZipFile(filepath, 'r') as z:
+        strings = wb.stringtable
+        date_styles, date1904 = _xlsb_date_styles(z)
+        with z.open(parts[sheet_name.lower()]) as f:
+            width, row_num, row = 0, -1, None
+            for rec_type, item in BIFF12Reader(fp=f):
+                if rec_type == biff12.DIMENSION:
+                    width = item.c + item.w
+                elif rec_type == biff12.ROW and item.r != row_num:
+                    if row is not None:
+                        yield row
+                    # Пропущенные строки — пустые, как у pyxlsb
+                    while row_num < item.r - 1:
+                        row_num += 1
+                        yield [None] * width
+                    row_num, row = item.r, [None] * width
+                    if row_num % DEADLINE_CHECK_ROWS == 0:
+                        check_deadline()
+                elif biff12.BLANK <= rec_type <= biff12.FORMULA_BOOLERR and row is not None:
+                    value = item.v
+                    if rec_type == biff12.STRING:
+                        value = strings[value] if strings is not None else None
+                    elif isinstance(value, float):
+                        if item.style in date_styles:
+                            value = _excel_datetime(value, date1904)
+                        elif value.is_integer():
+                            value = int(value)
+                    if item.c >= len(row):
+                        row.extend([None] * (item.c + 1 - len(row)))
+                    row[item.c] = value
+                elif rec_type == biff12.SHEETDATA_END:
+                    break
+            if row is not None:
+                yield row
+
+
+def _header_names(row: list) -> list:
+    """Имена столбцов из строки заголовка — как их даёт pandas.read_excel."""
+    names, seen = [], {}
+    for i, value in enumerate(row):
+        name = f"Unnamed: {i}" if value is None or str(value).strip() == "" else value
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def _preview_value(value):
+    """Значение ячейки для предпросмотра (JSON)."""
+    import math
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, datetime):
+        return value.strftime("%d.%m.%Y" if value.time() == datetime.min.time() else "%d.%m.%Y %H:%M")
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (int, float, str, bool)):
+        return value
+    return str(value)
+
+
+def preview_sheet(filepath: str, engine, sheet_name: str, rows: int = PREVIEW_ROWS) -> dict:
+    """Заголовок и первые rows строк листа: {"columns": [...], "rows": [[...], ...]}.
+    Лист читается построчно и чтение прекращается после rows строк.
+    """
+    import itertools
+    try:
+        it = _iter_sheet_rows(filepath, engine, sheet_name)
+        try:
+            filled = (r for r in it if not all(v is None or v == "" for v in r))
+            head = list(itertools.islice(filled, rows + 1))
+        finally:
+            it.close()
+    except Exception:
+        # Например, strict OOXML — через обычное чтение (лист разбирается целиком)
+        df = _read_sheet_safe(filepath, engine, sheet_name).head(rows)
+        head = [list(df.columns)] + df.astype(object).values.tolist()
+
+    if not head:
+        return {"columns": [], "rows": []}
+    columns = _header_names(head[0])
+    width = len(columns)
+    return {
+        "columns": [str(c) for c in columns],
+        "rows": [[_preview_value(v) for v in (list(r) + [None] * width)[:width]] for r in head[1:]],
+    }
+
+
+def process_excels_stream(
+    path1: str,
+    engine1,
+    sheet1: str,
+    serial_col1: str,
+    base_index,
+    compare: bool = True,
+    tech_refresh: bool = True,
+    stats: Optional[dict] = None,
+    stock_check: str = "exact",
+    chunk_rows: int = STREAM_CHUNK_ROWS,
+    output_format: str = "xlsx",
+) -> str:
+    """Потоковый вариант process_excels для файлов больше памяти.
+
+    Строки листа читаются блоками по chunk_rows (openpyxl read_only / pyxlsb),
+    каждый блок сверяется с готовым индексом базы и сразу дописывается в
+    файл результата (result_formats.ChunkWriter). Пиковая память
+    определяется размером блока, а не размером файла.
+    Возвращает путь к файлу результата.
+    """
+    import pandas as pd
+    from .result_formats import RESULT_FORMATS, ChunkWriter
+    from .tracing import span
+    if stats is None:
+        stats = {}
+
+    rows = _iter_sheet_rows(path1, engine1, sheet1)
+    header = next(rows, None)
+    if header is None:
+        raise Exception(f"Лист '{sheet1}' пуст")
+    columns = _header_names(header)
+    if serial_col1 not in columns:
+        raise Exception(f"Столбец '{serial_col1}' не найден на листе '{sheet1}'")
+    width = len(columns)
+
+    stats.update(base_index.stats)
+    stats.update({"total_rows": 0, "matched": None, "outdated": None, "streamed": True})
+    out_path = _result_path(RESULT_FORMATS[output_format][0])
+    writer = ChunkWriter(out_path, output_format)
+
+    def flush(chunk: list):
+        df = pd.DataFrame(chunk, columns=columns)
+        item = {}
+        _enrich_frame(df, serial_col1, base_index, compare, tech_refresh, item, stock_check, sheet1)
+        _add_counts(stats, item)
+        with span("write", format=output_format, rows=len(df)):
+            writer.write(df)
+
+    try:
+        chunk, flushed = [], 0
+        for row in rows:
+            # Пустые строки pandas пропускает — пропускаем и здесь
+            if all(v is None or v == "" for v in row):
+                continue
+            chunk.append((row + [None] * width)[:width])
+            if len(chunk) >= chunk_rows:
+                flush(chunk)
+                chunk, flushed = [], flushed + 1
+        if chunk or not flushed:
+            flush(chunk)
+        writer.close()
+    except BaseException:
+        # Недописанный результат не оставляем (process_excels перейдёт к обычному пути)
+        with contextlib.suppress(Exception):
+            writer.close()
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        raise
+    return out_path
+
+
+def _build_index(path2, engine2, sheet2, serial_col2, date_col2, duplicate_policy, compare, tech_refresh):
+    """Индекс базы для разовой обработки (когда готовый не передан)."""
+    from .base_index import build_base_index
+    return build_base_index(
+        path2, engine2, sheet2, serial_col2, date_col2, policy=duplicate_policy,
+        with_stock=compare, with_years=tech_refresh,
+    )
+
+
+def _result_path(suffix: str) -> str:
+    """Уникальный путь для результата в общей папке результатов (у каждого
+    файла пакета — свой; удаляется, когда результаты сессии заменяются)."""
+    from .shared_store import RESULT_DIR
+    os.makedirs(RESULT_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile(delete=False, dir=RESULT_DIR, prefix="result_", suffix=suffix) as tmp:
+        return tmp.name
+
+
+def _enrich_frame(df1: pd.DataFrame, serial_col1: str, base_index, compare: bool,
+                  tech_refresh: bool, stats: dict, stock_check: str = "exact",
+                  sheet: Optional[str] = None):
+    """Добавляет в df1 столбцы сверки и техрефреша, счётчики пишет в stats.
+    Для сводки пакета — группы устаревания (age_buckets), возрасты (ages) и
+    детализация (collect_detail) с именем листа sheet."""
+    import numpy as np
+    from .tracing import span
+    stats.update({"total_rows": len(df1), "matched": None, "outdated": None})
+
+    # Нормализуем серийники файла обработки один раз: позиции в индексе и склад
+    with span("join", sheet=sheet, rows=len(df1)) as sp:
+        pos, matched = base_index.lookup(df1[serial_col1], with_stock=compare,
+                                         stock_check=stock_check, stats=stats)
+        if sp and matched is not None:
+            sp.set(matched=int(matched.sum()))
+
+    # Сверка серийных номеров (опционально)
+    if compare:
+        if matched is None:
+            # Лист "Возврат" не найден или ошибка чтения
             df1["Передано на склад"] = "Нет (лист 'Возврат' не найден)"
+            stats["matched"] = 0
+        else:
+            df1["Передано на склад"] = np.where(matched, "Да", "Нет")
+            stats["matched"] = int(matched.sum())
 
     # Техрефреш оборудования (опционально)
-    if tech_refresh and date_col2 and date_col2 in df2.columns:
-        # Нормализуем серийные номера в обоих файлах
-        df1_serials = df1[serial_col1].astype(str).str.strip().str.lower()
-        df2_serials = df2[serial_col2].astype(str).str.strip().str.lower()
-        
-        # Создаем маппинг: серийный номер -> дата из базы данных
-        serial_to_date = dict(zip(df2_serials, df2[date_col2]))
-        
-        # Инициализируем столбец
-        df1["Оборудование устарело"] = "Не найдено в базе данных"
-        
-        # Для каждого серийника из файла обработки ищем дату в базе
-        for idx, serial in enumerate(df1_serials):
-            if serial in serial_to_date:
-                date_val = serial_to_date[serial]
-                
-                # Извлекаем год из даты
-                year = None
-                if pd.notna(date_val):
-                    if isinstance(date_val, (pd.Timestamp, datetime)):
-                        year = date_val.year
-                    else:
-                        # Попытка парсинга строки
-                        date_str = str(date_val).strip()
-                        for fmt in ['%d.%m.%Y', '%Y-%m-%d', '%d/%m/%Y']:
-                            try:
-                                year = datetime.strptime(date_str, fmt).year
-                                break
-                            except:
-                                continue
-                
-                if year:
-                    age = CURRENT_YEAR - year
-                    
-                    if age <= TECH_REFRESH_YEARS:
-                        df1.loc[idx, "Оборудование устарело"] = "Нет"
-                    elif age <= CRITICAL_AGE_YEARS:
-                        df1.loc[idx, "Оборудование устарело"] = f"Да, {_pluralize_years(age)}"
-                    else:
-                        df1.loc[idx, "Оборудование устарело"] = f"Критично, {_pluralize_years(age)}"
-
-    out_path = os.path.join(tempfile.gettempdir(), "result.xlsx")
-    df1.to_excel(out_path, index=False)
+    if tech_refresh and base_index.years is not None:
+        with span("tech_refresh", sheet=sheet, rows=len(df1)) as sp:
+            # Ищем год для каждого серийника из файла обработки
+            years = base_index.years_at(pos)
+            df1["Оборудование устарело"] = _age_labels(years)
+            ages = CURRENT_YEAR - years.astype("int32")
+            stats["outdated"] = int(((years != YEAR_MISSING) & (ages > TECH_REFRESH_YEARS)
+                                     & (ages <= CRITICAL_AGE_YEARS)).sum())
+            stats.update(_age_counts(years))
+            sp.set(outdated=stats["outdated"])
+    _spool_detail(df1, serial_col1, sheet)
+
+
+def _age_counts(years: np.ndarray) -> dict:
+    """Счётчики строк для сводки: по группам устаревания и по возрасту в годах."""
+    import numpy as np
+    known = years != YEAR_MISSING
+    ages = CURRENT_YEAR - years[known].astype("int32")
+    values, counts = np.unique(ages, return_counts=True)
+    return {
+        "age_buckets": {
+            "fresh": int((ages <= TECH_REFRESH_YEARS).sum()),
+            "outdated": int(((ages > TECH_REFRESH_YEARS) & (ages <= CRITICAL_AGE_YEARS)).sum()),
+            "critical": int((ages > CRITICAL_AGE_YEARS).sum()),
+            "missing": int((~known).sum()),
+        },
+        "ages": {str(v): int(c) for v, c in zip(values, counts)},
+    }
+
+
+def _add_counts(total: dict, item: dict):
+    """Прибавляет счётчики item к total (вложенные словари — по ключам)."""
+    for key, value in item.items():
+        if value is None:
+            continue
+        if isinstance(value, dict):
+            _add_counts(total.setdefault(key, {}), value)
+        else:
+            total[key] = (total.get(key) or 0) + value
+
+
+def read_sheets(filepath: str, engine, sheet_names: Optional[list] = None) -> dict:
+    """Читает несколько листов, открывая книгу один раз.
+    sheet_names=None — все листы. Лист, который не удалось разобрать
+    из открытой книги, читается через _read_sheet_safe.
+    Возвращает {имя листа: DataFrame} в порядке sheet_names.
+    """
+    import pandas as pd
+    from .tracing import span
+    xls = None
+    try:
+        xls = pd.ExcelFile(filepath, engine="calamine" if engine == "openpyxl" else engine)
+        if sheet_names is None:
+            sheet_names = [s for s in xls.sheet_names if s]
+    except Exception:
+        if sheet_names is None:
+            sheet_names = get_sheet_names(filepath, engine)
+
+    frames = {}
+    try:
+        for name in sheet_names:
+            check_deadline()
+            df = None
+            if xls is not None:
+                try:
+                    with span("read_attempt", method="workbook", sheet=name):
+                        df = xls.parse(name)
+                except Exception:
+                    df = None
+            frames[name] = df if df is not None else _read_sheet_safe(filepath, engine, name)
+    finally:
+        if xls is not None:
+            xls.close()
+    return frames
+
+
+def process_workbook_sheets(
+    path1: str,
+    path2: str,
+    engine1,
+    engine2,
+    sheets1: Optional[list],
+    sheet2: str,
+    serial_col1: str,
+    serial_col2: str,
+    date_col2: str,
+    compare: bool = True,
+    tech_refresh: bool = True,
+    duplicate_policy: str = "last",
+    stats: Optional[dict] = None,
+    base_index=None,
+    stock_check: str = "exact",
+    output_format: str = "xlsx",
+) -> str:
+    """
+    Обработка нескольких листов одной книги за один проход (sheets1=None — все листы).
+    Книга открывается один раз, столбец серийных номеров определяется на каждом
+    листе отдельно (serial_col1 используется, если он есть на листе).
+    Результат — одна книга с теми же листами (для форматов кроме XLSX — ZIP
+    с файлом на лист); в stats["sheets"] — статистика по каждому листу,
+    в stats — суммы.
+    Возвращает путь к файлу результата.
+    """
+    from .profiling import memory_stage
+    if stats is None:
+        stats = {}
+    with memory_stage("read"):
+        frames = read_sheets(path1, engine1, sheets1)
+
+    if base_index is None:
+        with memory_stage("base_index"):
+            base_index = _build_index(path2, engine2, sheet2, serial_col2, date_col2,
+                                      duplicate_policy, compare, tech_refresh)
+    stats.update(base_index.stats)
+
+    sheet_stats = []
+    for name, df in frames.items():
+        check_deadline()
+        serial_col = serial_col1 if serial_col1 in df.columns else \
+            auto_detect_columns([str(c) for c in df.columns])["serial"]
+        item = {"sheet": name, "serial_col": serial_col}
+        if serial_col:
+            with memory_stage("enrich"):
+                _enrich_frame(df, serial_col, base_index, compare, tech_refresh, item, stock_check, name)
+        else:
+            # Лист без серийных номеров переносим в результат без изменений
+            item.update({"total_rows": len(df), "matched": None, "outdated": None,
+                         "error": "Не найден столбец с серийными номерами"})
+        sheet_stats.append(item)
+
+    def _total(key):
+        values = [s[key] for s in sheet_stats if s.get(key) is not None]
+        return sum(values) if values else None
+
+    stats.update({
+        "total_rows": _total("total_rows") or 0,
+        "matched": _total("matched"),
+        "outdated": _total("outdated"),
+        "stock_false_positives": _total("stock_false_positives"),
+        "sheets": sheet_stats,
+    })
+    for item in sheet_stats:
+        _add_counts(stats, {k: item[k] for k in ("age_buckets", "ages") if k in item})
+
+    from .result_formats import write_frames
+    from .tracing import span
+    out_path = _result_path(".xlsx" if output_format == "xlsx" else ".zip")
+    with memory_stage("write"), span("write", format=output_format, sheets=len(frames),
+                                     rows=stats["total_rows"]) as sp:
+        write_frames(frames, out_path, output_format)
+        if sp:
+            sp.set(bytes=os.path.getsize(out_path))
     return out_path
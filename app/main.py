@@ -1,13 +1,17 @@
 # Основной модуль - Множественная обработка файлов
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
+from fastapi.responses import HTMLResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import FileResponse
-import uvicorn
+from starlette.background import BackgroundTask
+from starlette.responses import FileResponse, StreamingResponse
+import contextlib
 import os
 import json
+import gzip
+import hashlib
 import tempfile
+import threading
 import zipfile
 from typing import List, Optional
 
@@ -18,6 +22,54 @@ from .excel_logic import (
     get_columns,
     auto_detect_columns,
     process_excels,
+    process_workbook_sheets,
+    collect_detail,
+    preview_sheet,
+    prescan_workbook,
+    sheet_scan,
+    CURRENT_YEAR,
+    TECH_REFRESH_YEARS,
+    FILE_TIMEOUT,
+    ProcessingStopped,
+    time_budget,
+    PREVIEW_ROWS,
+    PREVIEW_MAX_ROWS,
+    RETURN_SHEET,
+)
+from .shared_store import (
+    UPLOAD_DIR,
+    RESULT_DIR,
+    load_session,
+    update_session,
+    file_digest,
+    cache_path,
+    load_cached,
+    store_cached,
+    evict_cache,
+    DELTA_SUFFIX,
+    read_sheet_cached,
+    result_cache_key,
+    load_cached_result,
+    store_cached_result,
+    has_cached_result,
+    discard_results,
+    request_cancel,
+    is_cancelled,
+    clear_cancel,
+)
+from .profiling import (
+    check_mode,
+    memory_profile,
+    record_metrics,
+    load_metrics,
+)
+from .tracing import span, trace_context
+from .scheduler import (
+    ADMISSION_POLL,
+    estimate_job_memory,
+    try_admit,
+    release,
+    queue_status,
 )
 
 app = FastAPI()
@@ -30,1070 +82,868 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Хранилище сессии
-session_data: dict = {
-    "base_file": None,  # База данных {path, engine, filename}
-    "process_files": [],  # Массив файлов для обработки
-    "results": []  # Массив результатов {filename, path, stats}
+# Состояние сессии хранится в общем хранилище (shared_store), поэтому запрос
+# может обработать любой worker. Здесь — только кеши процесса, которые
+# догоняют общее состояние.
+_local_cache: dict = {
+    # (ключ, BaseIndex) — одной записью; ключ — (путь базы, лист, серийник, дата, политика)
+    "base_index": None,
+    "return_df": None,  # Лист "Возврат" в памяти для запросов склада
+    "return_df_key": None,  # (путь базы, число применённых изменений)
 }
 
 
-# ─── HTML ────────────────────────────────────────────────────────────────────
-
-HTML_PAGE = """
-<!DOCTYPE html>
-<html lang="ru">
-<head>
-  <meta charset="UTF-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1.0">
-  <title>Множественная обработка Excel</title>
-  <style>
-    * { box-sizing: border-box; margin: 0; padding: 0; }
-    body { font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
-           background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-           color: #333; min-height: 100vh; padding: 20px; }
-    .container { max-width: 900px; margin: 0 auto; }
-    h1 { text-align: center; margin-bottom: 8px; font-size: 2rem; color: #fff; text-shadow: 0 2px 4px rgba(0,0,0,0.2); }
-    .subtitle { text-align: center; color: #f0f0f0; margin-bottom: 32px; font-size: 1rem; }
-    .card { background: #fff; border-radius: 16px; padding: 32px;
-            box-shadow: 0 8px 32px rgba(0,0,0,0.15); margin-bottom: 24px; }
-    .step-title { font-size: 1.2rem; font-weight: 700; margin-bottom: 20px;
-                  display: flex; align-items: center; gap: 12px; color: #1a1a2e; }
-    .step-num { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                color: #fff; width: 36px; height: 36px; border-radius: 50%;
-                display: flex; align-items: center; justify-content: center;
-                font-size: 1rem; flex-shrink: 0; box-shadow: 0 4px 8px rgba(102, 126, 234, 0.3); }
-    
-    .base-file-section { background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);
-                         padding: 20px; border-radius: 12px; margin-bottom: 24px; color: #fff; }
-    .base-file-section label { color: #fff; font-weight: 600; margin-bottom: 8px; display: block; }
-    
-    .process-files-section { border: 2px dashed #e0e0e0; border-radius: 12px; padding: 20px; margin-bottom: 20px; }
-    .file-item { background: #f8f9ff; border-radius: 10px; padding: 16px; margin-bottom: 12px;
-                 border-left: 4px solid #667eea; position: relative; }
-    .file-item-header { display: flex; justify-content: space-between; align-items: center; margin-bottom: 12px; }
-    .file-num { font-weight: 700; color: #667eea; font-size: 1.1rem; }
-    .btn-remove { background: #ff4757; color: #fff; border: none; padding: 6px 12px;
-                  border-radius: 6px; cursor: pointer; font-size: 0.85rem; }
-    .btn-remove:hover { background: #ee5a6f; }
-    
-    label { display: block; font-weight: 600; margin-bottom: 6px; margin-top: 12px;
-            font-size: 0.9rem; color: #555; }
-    input[type="file"] { width: 100%; padding: 12px; border: 2px solid #e0e0e0;
-                         border-radius: 10px; background: #fff; cursor: pointer;
-                         font-size: 0.95rem; }
-    input[type="file"]:hover { border-color: #667eea; }
-    
-    select { width: 100%; padding: 10px 12px; border: 2px solid #e0e0e0;
-             border-radius: 10px; font-size: 0.95rem; background: #fff; }
-    select:disabled { background: #f5f5f5; color: #999; }
-    
-    .checkbox-group { display: flex; gap: 24px; margin-top: 12px; }
-    .checkbox-label { display: flex; align-items: center; gap: 8px; font-size: 0.95rem;
-                      cursor: pointer; user-select: none; }
-    input[type="checkbox"] { width: 18px; height: 18px; cursor: pointer; }
-    
-    button { padding: 14px 32px; border: none; border-radius: 10px; font-size: 1rem;
-             cursor: pointer; font-weight: 600; transition: all 0.2s; box-shadow: 0 4px 12px rgba(0,0,0,0.1); }
-    .btn-primary { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: #fff; }
-    .btn-primary:hover { transform: translateY(-2px); box-shadow: 0 6px 16px rgba(102, 126, 234, 0.4); }
-    .btn-primary:disabled { background: #ccc; cursor: not-allowed; transform: none; }
-    .btn-success { background: linear-gradient(135deg, #84fab0 0%, #8fd3f4 100%); color: #333; }
-    .btn-success:hover { transform: translateY(-2px); }
-    .btn-add { background: #4cd137; color: #fff; width: 100%; margin-top: 12px; }
-    .btn-add:hover { background: #44bd32; }
-    
-    .actions { margin-top: 24px; display: flex; gap: 16px; justify-content: center; flex-wrap: wrap; }
-    .hidden { display: none; }
-    .status { padding: 14px 18px; border-radius: 10px; margin-top: 16px; font-size: 0.95rem; }
-    .status-info { background: #e8f4fd; color: #1565c0; border-left: 4px solid #1565c0; }
-    .status-ok { background: #e8f5e9; color: #2e7d32; border-left: 4px solid #2e7d32; }
-    .status-err { background: #fdecea; color: #c62828; border-left: 4px solid #c62828; }
-    
-    .spinner { display: inline-block; width: 16px; height: 16px; border: 2px solid #ddd;
-               border-top: 2px solid #667eea; border-radius: 50%;
-               animation: spin 0.8s linear infinite; vertical-align: middle; margin-right: 8px; }
-    @keyframes spin { to { transform: rotate(360deg); } }
-    
-    .result-item { background: #f8f9ff; border-radius: 10px; padding: 16px; margin-bottom: 16px;
-                   border-left: 4px solid #2e7d32; }
-    .result-stats { display: flex; gap: 20px; margin: 10px 0; font-size: 0.9rem; }
-    .stat { display: flex; align-items: center; gap: 6px; }
-    .stat-label { color: #666; }
-    .stat-value { font-weight: 700; color: #667eea; }
-    
-    .file-name { font-size: 0.85rem; color: #666; margin-top: 4px; font-style: italic; }
-    .auto-hint { font-size: 0.8rem; color: #667eea; margin-top: 4px; }
-    .auto-hint.empty { color: #ff6b6b; }
-    
-    /* Табы навигации */
-    .tabs { display: flex; gap: 8px; margin-bottom: 24px; background: rgba(255,255,255,0.2); 
-            padding: 8px; border-radius: 12px; }
-    .tab { background: transparent; color: #fff; padding: 12px 24px; border-radius: 8px; 
-           border: 2px solid transparent; cursor: pointer; transition: all 0.3s; 
-           font-size: 1rem; font-weight: 600; }
-    .tab:hover { background: rgba(255,255,255,0.1); }
-    .tab.active { background: #fff; color: #667eea; border-color: #fff; 
-                  box-shadow: 0 4px 12px rgba(0,0,0,0.1); }
-    .tab-content { display: none; }
-    .tab-content.active { display: block; }
-    
-    /* Склад - фильтры */
-    .warehouse-filters { display: grid; grid-template-columns: 1fr 1fr auto; gap: 16px; 
-                         margin-bottom: 24px; align-items: end; }
-    
-    /* Склад - таблица */
-    .warehouse-table { width: 100%; border-collapse: collapse; margin-top: 20px; }
-    .warehouse-table th { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); 
-                          color: #fff; padding: 14px; text-align: left; font-weight: 600; 
-                          font-size: 0.9rem; }
-    .warehouse-table td { padding: 12px; border-bottom: 1px solid #e0e0e0; font-size: 0.9rem; }
-    .warehouse-table tr:hover { background: #f8f9ff; }
-    .warehouse-table tr:last-child td { border-bottom: none; }
-    .warehouse-empty { text-align: center; padding: 40px; color: #666; font-size: 1rem; }
-    .warehouse-count { color: #667eea; font-weight: 700; margin-bottom: 12px; font-size: 1.1rem; }
-  </style>
-</head>
-<body>
-<div class="container">
-  <h1>📊 Множественная обработка Excel</h1>
-  <p class="subtitle">База данных + неограниченное количество файлов для обработки</p>
-
-  <!-- Табы навигации -->
-  <div class="tabs">
-    <button class="tab active" onclick="switchTab('processing')">📄 Обработка файлов</button>
-    <button class="tab" onclick="switchTab('warehouse')">📦 Склад</button>
-    <button class="tab" onclick="switchTab('top')">👥 Оборудование у ТОПа</button>
-  </div>
-
-  <!-- Вкладка: Обработка файлов -->
-  <div id="tabProcessing" class="tab-content active">
-  <!-- STEP 1: Загрузка файлов -->
-  <div class="card" id="step1">
-    <div class="step-title"><span class="step-num">1</span> Загрузка файлов</div>
-    
-    <!-- База данных -->
-    <div class="base-file-section">
-      <label>📁 База данных (склад для сверки)</label>
-      <input type="file" id="baseFile" accept=".xlsx,.xlsb">
-      <div class="file-name" id="baseName"></div>
-    </div>
-    
-    <!-- Файлы для обработки -->
-    <div class="process-files-section">
-      <label style="color: #667eea; font-size: 1rem; margin-bottom: 12px;">📄 Файлы для обработки</label>
-      <div id="processFilesList"></div>
-      <button class="btn-add" id="btnAddFile">+ Добавить файл</button>
-    </div>
-    
-    <div class="actions">
-      <button class="btn-primary" id="btnUpload" disabled>Загрузить все файлы</button>
-    </div>
-    <div id="uploadStatus" class="hidden"></div>
-  </div>
-
-  <!-- STEP 2: Настройка -->
-  <div class="card hidden" id="step2">
-    <div class="step-title"><span class="step-num">2</span> Настройка обработки</div>
-    
-    <!-- База данных -->
-    <div style="background: #f0f2f5; padding: 16px; border-radius: 10px; margin-bottom: 20px;">
-      <h3 style="font-size: 1rem; margin-bottom: 12px; color: #667eea;">База данных</h3>
-      <div style="display: grid; grid-template-columns: 1fr 1fr 1fr; gap: 16px;">
-        <div>
-          <label>Лист</label>
-          <select id="baseSheet"></select>
-        </div>
-        <div>
-          <label>Столбец с серийными номерами</label>
-          <select id="baseSerial" disabled></select>
-          <div class="auto-hint" id="hintBaseSerial"></div>
-        </div>
-        <div>
-          <label>Столбец с датой</label>
-          <select id="baseDate" disabled></select>
-          <div class="auto-hint" id="hintBaseDate"></div>
-        </div>
-      </div>
-    </div>
-    
-    <!-- Файлы для обработки -->
-    <div id="configFilesList"></div>
-    
-    <div class="actions">
-      <button class="btn-success" id="btnProcess" disabled>🚀 Обработать все файлы</button>
-    </div>
-    <div id="processStatus" class="hidden"></div>
-  </div>
-
-  <!-- STEP 3: Результаты -->
-  <div class="card hidden" id="step3">
-    <div class="step-title"><span class="step-num">3</span> Результаты обработки</div>
-    <div id="resultsList"></div>
-    <div class="actions">
-      <a id="downloadAllLink" href="#"><button class="btn-primary">📦 Скачать все файлы (ZIP)</button></a>
-      <button class="btn-success" onclick="location.reload()">🔄 Начать заново</button>
-    </div>
-  </div>
-  </div> <!-- /tabProcessing -->
-
-  <!-- Вкладка: Склад -->
-  <div id="tabWarehouse" class="tab-content">
-    <div class="card">
-      <div class="step-title">📦 Поиск оборудования на складе</div>
-      
-      <!-- Загрузка базы данных для склада -->
-      <div class="base-file-section" style="margin-bottom: 24px;">
-        <label>📁 База данных (файл с листом "Возврат")</label>
-        <input type="file" id="warehouseFile" accept=".xlsx,.xlsb">
-        <div class="file-name" id="warehouseFileName"></div>
-      </div>
-      
-      <div class="warehouse-filters hidden" id="warehouseFiltersSection">
-        <div>
-          <label>Тип оборудования</label>
-          <select id="warehouseType" disabled>
-            <option value="">— Выберите тип —</option>
-          </select>
-        </div>
-        <div>
-          <label>Модель</label>
-          <select id="warehouseModel" disabled>
-            <option value="">— Все модели —</option>
-          </select>
-        </div>
-        <div>
-          <button class="btn-primary" id="btnSearchWarehouse" disabled>🔍 Найти</button>
-        </div>
-      </div>
-      
-      <div id="warehouseStatus" class="hidden"></div>
-      <div id="warehouseResults"></div>
-    </div>
-  </div>
-
-  <!-- Вкладка: Оборудование у ТОПа -->
-  <div id="tabTop" class="tab-content">
-    <div class="card">
-      <div class="step-title">👥 Оборудование у ТОПа</div>
-      
-      <!-- Загрузка базы данных -->
-      <div class="base-file-section" style="margin-bottom: 24px;">
-        <label>📁 База данных с оборудованием у ТОПа</label>
-        <input type="file" id="topFile" accept=".xlsx,.xlsb">
-        <div class="file-name" id="topFileName"></div>
-      </div>
-      
-      <div class="warehouse-filters hidden" id="topFiltersSection">
-        <div>
-          <label>ФИО пользователя</label>
-          <select id="topUser" disabled>
-            <option value="">— Выберите пользователя —</option>
-          </select>
-        </div>
-      </div>
-      
-      <div id="topStatus" class="hidden"></div>
-      <div id="topResults"></div>
-    </div>
-  </div>
-
-</div> <!-- /container -->
-
-<script>
-const $ = id => document.getElementById(id);
-const API = '';
-
-// State
-let baseFile = null;
-let processFiles = [];
-let fileCounter = 0;
-
-// --- Step 1: Управление файлами ---
-$('baseFile').onchange = e => {
-  baseFile = e.target.files[0];
-  $('baseName').textContent = baseFile?.name || '';
-  checkUploadReady();
-};
-
-$('btnAddFile').onclick = () => addProcessFileInput();
-
-function addProcessFileInput() {
-  fileCounter++;
-  const id = fileCounter;
-  const div = document.createElement('div');
-  div.className = 'file-item';
-  div.id = `fileItem${id}`;
-  div.innerHTML = `
-    <div class="file-item-header">
-      <span class="file-num">Файл #${id}</span>
-      <button class="btn-remove" onclick="removeFile(${id})">✕ Удалить</button>
-    </div>
-    <input type="file" id="processFile${id}" accept=".xlsx,.xlsb">
-    <div class="file-name" id="fileName${id}"></div>
-  `;
-  $('processFilesList').appendChild(div);
-  
-  $(`processFile${id}`).onchange = e => {
-    const file = e.target.files[0];
-    $(`fileName${id}`).textContent = file?.name || '';
-    processFiles[id] = file;
-    checkUploadReady();
-  };
-}
+_base_index_lock = threading.Lock()
 
-function removeFile(id) {
-  $(`fileItem${id}`).remove();
-  delete processFiles[id];
-  checkUploadReady();
-}
 
-function checkUploadReady() {
-  const hasBase = !!baseFile;
-  const hasProcess = Object.values(processFiles).some(f => f);
-  $('btnUpload').disabled = !(hasBase && hasProcess);
-}
+def _set_base_file(info: dict):
+    """Запоминает новую базу данных; всё, что построено по старой, больше не используется."""
+    with update_session() as state:
+        previous = state["base_deltas"]
+        state["base_file"] = info
+        state["base_config"] = None
+        state["base_deltas"] = []
+    # Изменения прежней базы больше не применяются
+    for path in previous:
+        with contextlib.suppress(OSError):
+            os.remove(path)
 
-// Добавляем первый файл по умолчанию
-addProcessFileInput();
-
-$('btnUpload').onclick = async () => {
-  $('btnUpload').disabled = true;
-  showStatus('uploadStatus', 'info', '<span class="spinner"></span> Загрузка файлов...');
-  
-  const fd = new FormData();
-  fd.append('base_file', baseFile);
-  
-  Object.entries(processFiles).forEach(([id, file]) => {
-    if (file) fd.append('process_files', file);
-  });
-  
-  try {
-    const r = await fetch(API + '/upload_multiple', { method: 'POST', body: fd });
-    const d = await r.json();
-    if (!r.ok) throw new Error(d.detail || 'Ошибка загрузки');
-    
-    showStatus('uploadStatus', 'ok', `✓ Загружено: база данных + ${d.files_count} файлов`);
-    
-    // Заполняем настройки базы
-    fillSelect('baseSheet', d.base_sheets);
-    
-    // Создаем конфигурацию для каждого файла
-    d.process_files_info.forEach((info, idx) => {
-      createFileConfig(idx, info);
-    });
-    
-    $('step2').classList.remove('hidden');
-    $('baseSheet').dispatchEvent(new Event('change'));
-  } catch(e) {
-    showStatus('uploadStatus', 'err', '✗ ' + e.message);
-    $('btnUpload').disabled = false;
-  }
-};
-
-// --- Step 2: Настройка ---
-$('baseSheet').onchange = async () => {
-  const sheet = $('baseSheet').value;
-  if (!sheet) return;
-  const r = await fetch(API + `/columns?file_type=base&sheet=${encodeURIComponent(sheet)}`);
-  const d = await r.json();
-  fillSelect('baseSerial', d.columns);
-  fillSelect('baseDate', d.columns);
-  $('baseSerial').disabled = false;
-  $('baseDate').disabled = false;
-  if (d.detected_serial) {
-    $('baseSerial').value = d.detected_serial;
-    $('hintBaseSerial').textContent = '↑ Автоопределён: ' + d.detected_serial;
-  }
-  if (d.detected_date) {
-    $('baseDate').value = d.detected_date;
-    $('hintBaseDate').textContent = '↑ Автоопределён: ' + d.detected_date;
-  }
-  checkProcessReady();
-};
-
-$('baseSerial').onchange = checkProcessReady;
-$('baseDate').onchange = checkProcessReady;
-
-function createFileConfig(idx, info) {
-  const div = document.createElement('div');
-  div.className = 'file-item';
-  div.innerHTML = `
-    <div class="file-item-header">
-      <span class="file-num">📄 ${info.filename}</span>
-    </div>
-    <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 12px;">
-      <div>
-        <label>Лист</label>
-        <select id="sheet${idx}"></select>
-      </div>
-      <div>
-        <label>Серийный номер</label>
-        <select id="serial${idx}" disabled></select>
-        <div class="auto-hint" id="hintSerial${idx}"></div>
-      </div>
-    </div>
-    <div>
-      <label>Дата отражения проводки (для техрефреша)</label>
-      <select id="date${idx}" disabled>
-        <option value="">— не выбран (пропустить техрефреш) —</option>
-      </select>
-      <div class="auto-hint" id="hintDate${idx}"></div>
-    </div>
-    <div class="checkbox-group">
-      <label class="checkbox-label">
-        <input type="checkbox" id="opCompare${idx}" checked>
-        <span>Сверка с базой данных</span>
-      </label>
-      <label class="checkbox-label">
-        <input type="checkbox" id="opTechRefresh${idx}" checked>
-        <span>Анализ устаревшего оборудования</span>
-      </label>
-    </div>
-  `;
-  $('configFilesList').appendChild(div);
-  
-  fillSelect(`sheet${idx}`, info.sheets);
-  
-  $(`sheet${idx}`).onchange = async () => {
-    const sheet = $(`sheet${idx}`).value;
-    if (!sheet) return;
-    const r = await fetch(API + `/columns?file_type=process&file_idx=${idx}&sheet=${encodeURIComponent(sheet)}`);
-    const d = await r.json();
-    
-    fillSelect(`serial${idx}`, d.columns);
-    fillSelect(`date${idx}`, d.columns, true);
-    $(`serial${idx}`).disabled = false;
-    $(`date${idx}`).disabled = false;
-    
-    if (d.detected_serial) {
-      $(`serial${idx}`).value = d.detected_serial;
-      $(`hintSerial${idx}`).textContent = '↑ Автоопределён: ' + d.detected_serial;
-    }
-    if (d.detected_date) {
-      $(`date${idx}`).value = d.detected_date;
-      $(`hintDate${idx}`).textContent = '↑ Автоопределён: ' + d.detected_date;
-    }
-    
-    checkProcessReady();
-  };
-  
-  $(`serial${idx}`).onchange = checkProcessReady;
-  $(`sheet${idx}`).dispatchEvent(new Event('change'));
-}
 
-function checkProcessReady() {
-  const baseReady = $('baseSerial').value && $('baseDate').value;
-  $('btnProcess').disabled = !baseReady;
-}
+def _pending_deltas(state: dict, applied: int):
+    """Изменения базы из общего журнала, ещё не применённые в этом процессе."""
+    for delta_path in state["base_deltas"][applied:]:
+        yield load_cached(delta_path) or {}
 
-$('btnProcess').onclick = async () => {
-  $('btnProcess').disabled = true;
-  showStatus('processStatus', 'info', '<span class="spinner"></span> Обработка файлов...');
-  
-  // Собираем конфигурацию
-  const config = {
-    base_sheet: $('baseSheet').value,
-    base_serial: $('baseSerial').value,
-    base_date: $('baseDate').value,
-    files_config: []
-  };
-  
-  const fileConfigs = document.querySelectorAll('#configFilesList .file-item');
-  fileConfigs.forEach((item, idx) => {
-    config.files_config.push({
-      sheet: $(`sheet${idx}`).value,
-      serial_col: $(`serial${idx}`).value,
-      date_col: $(`date${idx}`).value || null,
-      compare: $(`opCompare${idx}`).checked,
-      tech_refresh: $(`opTechRefresh${idx}`).checked
-    });
-  });
-  
-  try {
-    const r = await fetch(API + '/process_multiple', {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify(config)
-    });
-    const d = await r.json();
-    if (!r.ok) throw new Error(d.detail || 'Ошибка обработки');
-    
-    showStatus('processStatus', 'ok', `✓ Обработано файлов: ${d.results.length}`);
-    
-    // Отображаем результаты
-    d.results.forEach((res, idx) => {
-      createResultItem(idx, res);
-    });
-    
-    $('downloadAllLink').href = API + '/download_all';
-    $('step3').classList.remove('hidden');
-  } catch(e) {
-    showStatus('processStatus', 'err', '✗ ' + e.message);
-    $('btnProcess').disabled = false;
-  }
-};
-
-// --- Step 3: Результаты ---
-function createResultItem(idx, result) {
-  const div = document.createElement('div');
-  div.className = 'result-item';
-  div.innerHTML = `
-    <h3 style="font-size: 1rem; margin-bottom: 8px; color: #333;">
-      ${result.source_filename}
-    </h3>
-    <div class="result-stats">
-      <div class="stat">
-        <span class="stat-label">Строк:</span>
-        <span class="stat-value">${result.total_rows}</span>
-      </div>
-      ${result.matched !== null ? `
-        <div class="stat">
-          <span class="stat-label">На складе:</span>
-          <span class="stat-value">${result.matched}</span>
-        </div>
-      ` : ''}
-      ${result.outdated !== null ? `
-        <div class="stat">
-          <span class="stat-label">Устарело:</span>
-          <span class="stat-value">${result.outdated}</span>
-        </div>
-      ` : ''}
-    </div>
-    <a href="${API}/download_single?idx=${idx}" style="text-decoration: none;">
-      <button class="btn-primary" style="padding: 8px 20px; font-size: 0.9rem; margin-top: 8px;">
-        📥 Скачать ${result.result_filename}
-      </button>
-    </a>
-  `;
-  $('resultsList').appendChild(div);
-}
-
-// --- Helpers ---
-function showStatus(id, type, html) {
-  const el = $(id);
-  el.className = 'status status-' + type;
-  el.innerHTML = html;
-  el.classList.remove('hidden');
-}
 
-function fillSelect(id, items, addEmpty) {
-  const sel = $(id);
-  sel.innerHTML = '';
-  if (addEmpty) {
-    const o = document.createElement('option');
-    o.value = '';
-    o.textContent = '— не выбран (пропустить техрефреш) —';
-    sel.appendChild(o);
-  }
-  items.forEach(item => {
-    const o = document.createElement('option');
-    o.value = item;
-    o.textContent = item;
-    sel.appendChild(o);
-  });
+def _get_return_df(state: dict):
+    """Лист "Возврат" базы данных (разбирается один раз, с учётом изменений)."""
+    from .base_index import apply_delta_to_frame
+    base = state["base_file"]
+    cached_key = _local_cache["return_df_key"]
+    if cached_key and cached_key[0] == base["path"]:
+        df, applied = _local_cache["return_df"], cached_key[1]
+    else:
+        df, applied = read_sheet_cached(base["path"], base["engine"], RETURN_SHEET), 0
+    for delta in _pending_deltas(state, applied):
+        if delta.get("stock") is not None:
+            df = apply_delta_to_frame(df, delta["stock"], "Серийный номер")
+    _local_cache["return_df"] = df
+    _local_cache["return_df_key"] = (base["path"], len(state["base_deltas"]))
+    return df
+
+
+def _catch_up_index(index, state: dict, sheet: str) -> tuple:
+    """Применяет к индексу изменения базы, сделанные в любом процессе.
+
+    Изменения применяются к копии: исходный индекс в это время могут читать
+    потоки других пакетов. Возвращает (индекс, счётчики последнего изменения).
+    """
+    pending = list(_pending_deltas(state, index.version))
+    if not pending:
+        return index, {}
+    index, counts = index.copy(), {}
+    for delta in pending:
+        if delta.get("sheet") != sheet:
+            delta = {**delta, "base": None}
+        counts = index.apply_delta(delta)
+    return index, counts
+
+
+def _publish_index(key: tuple, index):
+    """Делает индекс индексом процесса (одна замена ссылки); более старая
+    версия того же индекса новую не вытесняет."""
+    with _base_index_lock:
+        cached = _local_cache["base_index"]
+        if cached is not None and cached[0] == key and cached[1].version > index.version:
+            return
+        _local_cache["base_index"] = (key, index)
+
+
+def _get_base_index(state: dict, sheet: str, serial_col: str, date_col: str, policy: str):
+    """Индекс базы для обработки.
+
+    Снимок индекса (без изменений базы) строится один раз и сохраняется в
+    общий кеш массивами .npy; остальные процессы открывают его через mmap
+    и делят одну копию в памяти. Изменения из журнала применяются поверх.
+    """
+    from .base_index import STOCK_FILTER_BYTES, STOCK_FILTER_MIN_ROWS, BaseIndex, build_base_index
+    base = state["base_file"]
+    key = (base["path"], sheet, serial_col, date_col, policy)
+    cached = _local_cache["base_index"]
+    index = cached[1] if cached is not None and cached[0] == key else None
+    if index is None:
+        # Настройки фильтра склада меняют устройство снимка — они в ключе
+        snapshot = cache_path("index", file_digest(base["path"]), sheet, serial_col, date_col, policy,
+                              STOCK_FILTER_MIN_ROWS, STOCK_FILTER_BYTES, suffix="")
+        index = BaseIndex.load(snapshot)
+        if index is None:
+            with span("base_index", file=base["filename"], sheet=sheet):
+                try:
+                    df_return = read_sheet_cached(base["path"], base["engine"], RETURN_SHEET)
+                except Exception:
+                    df_return = None
+                # Широкий лист базы (по оценке prescan) — только серийник и дата
+                scan = sheet_scan(base["path"], base["engine"], sheet)
+                columns = list(dict.fromkeys(c for c in (serial_col, date_col) if c)) \
+                    if scan and scan["projected"] else None
+                built = build_base_index(
+                    base["path"], base["engine"], sheet, serial_col, date_col, policy=policy,
+                    df_base=read_sheet_cached(base["path"], base["engine"], sheet, columns),
+                    df_return=df_return,
+                )
+                built.save(snapshot)
+                evict_cache(keep=snapshot)
+            # Снимок мог успеть вытеснить другой процесс — тогда индекс в памяти
+            index = BaseIndex.load(snapshot) or built
+    index, _ = _catch_up_index(index, state, sheet)
+    _publish_index(key, index)
+    return index
+
+
+# ─── Статика (UI) ────────────────────────────────────────────────────────────
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
+STATIC_MEDIA_TYPES = {
+    ".html": "text/html; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".js": "application/javascript; charset=utf-8",
 }
+STATIC_ASSETS = ("style.css", "app.js")  # Подключаются из index.html с ?v=<хеш>
+_static_cache: dict = {}  # имя файла -> {"mtimes", "digest", "media_type", "variants"}
+
+
+def _load_static(name: str) -> dict:
+    """Файл UI из app/static: читается и сжимается (gzip, brotli) один раз.
+    Перечитывается только при изменении файла на диске.
+    """
+    deps = (name,) + (STATIC_ASSETS if name == "index.html" else ())
+    mtimes = tuple(os.path.getmtime(os.path.join(STATIC_DIR, n)) for n in deps)
+    cached = _static_cache.get(name)
+    if cached and cached["mtimes"] == mtimes:
+        return cached
+    
+    with open(os.path.join(STATIC_DIR, name), "rb") as f:
+        body = f.read()
+    if name == "index.html":
+        # Версия ассета в ссылке: их можно кешировать навсегда
+        for asset in STATIC_ASSETS:
+            version = _load_static(asset)["digest"]
+            body = body.replace(f'/static/{asset}"'.encode(), f'/static/{asset}?v={version}"'.encode())
+    
+    variants = {"identity": body, "gzip": gzip.compress(body, 9)}
+    try:
+        import brotli
+        variants["br"] = brotli.compress(body, quality=11)
+    except ImportError:
+        pass
+    
+    cached = {
+        "mtimes": mtimes,
+        "digest": hashlib.sha1(body).hexdigest()[:16],
+        "media_type": STATIC_MEDIA_TYPES[os.path.splitext(name)[1]],
+        "variants": variants,
+    }
+    _static_cache[name] = cached
+    return cached
 
-// Делаем функцию removeFile глобальной
-window.removeFile = removeFile;
-
-// ─── Переключение табов ───
-function switchTab(tabName) {
-  // Скрыть все вкладки
-  document.querySelectorAll('.tab-content').forEach(t => t.classList.remove('active'));
-  document.querySelectorAll('.tab').forEach(t => t.classList.remove('active'));
-  
-  // Показать выбранную вкладку
-  if (tabName === 'processing') {
-    $('tabProcessing').classList.add('active');
-    event.target.classList.add('active');
-  } else if (tabName === 'warehouse') {
-    $('tabWarehouse').classList.add('active');
-    event.target.classList.add('active');
-  } else if (tabName === 'top') {
-    $('tabTop').classList.add('active');
-    event.target.classList.add('active');
-  }
-}
 
-window.switchTab = switchTab;
-
-// ─── Склад: Управление файлом ───
-let warehouseFileSelected = null;
-
-$('warehouseFile').onchange = async e => {
-  warehouseFileSelected = e.target.files[0];
-  if (!warehouseFileSelected) {
-    $('warehouseFileName').textContent = '';
-    return;
-  }
-  
-  $('warehouseFileName').textContent = warehouseFileSelected.name;
-  showStatus('warehouseStatus', 'info', '<span class="spinner"></span> Загрузка базы данных...');
-  
-  try {
-    const formData = new FormData();
-    formData.append('file', warehouseFileSelected);
-    
-    const r = await fetch(API + '/warehouse/upload', {
-      method: 'POST',
-      body: formData
-    });
-    
-    if (!r.ok) {
-      const errText = await r.text();
-      throw new Error(errText);
-    }
-    
-    showStatus('warehouseStatus', 'ok', '✓ База данных загружена');
-    
-    // Загружаем данные для фильтров
-    await loadWarehouseData();
+def _static_response(request: Request, name: str, cache_control: str) -> Response:
+    """Отдаёт файл UI с ETag/Cache-Control и заранее сжатым вариантом."""
+    asset = _load_static(name)
+    accepted = {p.split(";")[0].strip() for p in request.headers.get("accept-encoding", "").split(",")}
+    encoding = next((e for e in ("br", "gzip") if e in accepted and e in asset["variants"]), "identity")
     
-    // Показываем фильтры
-    $('warehouseFiltersSection').classList.remove('hidden');
-    
-    setTimeout(() => $('warehouseStatus').classList.add('hidden'), 2000);
-    
-  } catch (e) {
-    showStatus('warehouseStatus', 'err', '❌ Ошибка загрузки: ' + e.message);
-  }
-};
-
-// ─── Склад: Загрузка данных ───
-async function loadWarehouseData() {
-  try {
-    // Загружаем типы оборудования
-    const r = await fetch(API + '/warehouse/types');
-    if (!r.ok) {
-      const errText = await r.text();
-      throw new Error(errText);
-    }
-    const data = await r.json();
-    
-    fillSelect('warehouseType', data.types);
-    $('warehouseType').disabled = false;
-    $('btnSearchWarehouse').disabled = false;
-    
-    // Устанавливаем обработчики
-    $('warehouseType').onchange = async () => {
-      const type = $('warehouseType').value;
-      if (!type) {
-        $('warehouseModel').disabled = true;
-        fillSelect('warehouseModel', []);
-        return;
-      }
-      
-      // Загружаем модели для выбранного типа
-      const r = await fetch(API + `/warehouse/models?type=${encodeURIComponent(type)}`);
-      const d = await r.json();
-      fillSelect('warehouseModel', d.models);
-      $('warehouseModel').disabled = false;
-    };
-    
-    $('btnSearchWarehouse').onclick = searchWarehouse;
-    
-  } catch (e) {
-    showStatus('warehouseStatus', 'err', '❌ Ошибка загрузки данных склада: ' + e.message);
-  }
-}
+    etag = f'"{asset["digest"]}"' if encoding == "identity" else f'"{asset["digest"]}-{encoding}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if asset["digest"] in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(asset["variants"][encoding], media_type=asset["media_type"], headers=headers)
 
-// ─── Склад: Поиск ───
-async function searchWarehouse() {
-  const type = $('warehouseType').value;
-  if (!type) {
-    showStatus('warehouseStatus', 'err', '❌ Выберите тип оборудования');
-    return;
-  }
-  
-  showStatus('warehouseStatus', 'info', '<span class="spinner"></span> Поиск...');
-  
-  try {
-    const model = $('warehouseModel').value;
-    let url = API + `/warehouse/search?type=${encodeURIComponent(type)}`;
-    if (model) url += `&model=${encodeURIComponent(model)}`;
-    
-    const r = await fetch(url);
-    if (!r.ok) throw new Error(await r.text());
-    const data = await r.json();
-    
-    displayWarehouseResults(data.items, data.total);
-    $('warehouseStatus').classList.add('hidden');
-    
-  } catch (e) {
-    showStatus('warehouseStatus', 'err', '❌ Ошибка поиска: ' + e.message);
-  }
-}
 
-// ─── Склад: Отображение результатов ───
-function displayWarehouseResults(items, total) {
-  const container = $('warehouseResults');
-  
-  if (items.length === 0) {
-    container.innerHTML = '<div class="warehouse-empty">🔍 Оборудование не найдено</div>';
-    return;
-  }
-  
-  let html = `<div class="warehouse-count">📦 Найдено: ${total} шт.</div>`;
-  html += '<table class="warehouse-table">';
-  html += '<thead><tr>';
-  html += '<th>Адрес</th>';
-  html += '<th>Корпус/Этаж</th>';
-  html += '<th>Местоположение</th>';
-  html += '<th>Тип оборудования</th>';
-  html += '<th>Марка</th>';
-  html += '<th>Модель</th>';
-  html += '<th>Серийный номер</th>';
-  html += '<th>Инвентарный номер</th>';
-  html += '</tr></thead><tbody>';
-  
-  items.forEach(item => {
-    html += '<tr>';
-    html += `<td>${item['Адрес'] || '-'}</td>`;
-    html += `<td>${item['Корпус/Этаж'] || '-'}</td>`;
-    html += `<td>${item['Местоположение'] || '-'}</td>`;
-    html += `<td>${item['Тип оборудования'] || '-'}</td>`;
-    html += `<td>${item['Марка'] || '-'}</td>`;
-    html += `<td>${item['Модель'] || '-'}</td>`;
-    html += `<td>${item['Серийный номер'] || '-'}</td>`;
-    html += `<td>${item['Инвентарный номер'] || '-'}</td>`;
-    html += '</tr>';
-  });
-  
-  html += '</tbody></table>';
-  container.innerHTML = html;
-}
+# ─── API Routes ──────────────────────────────────────────────────────────────
 
-// ─── ТОП: Управление файлом ───
-let topFileSelected = null;
-
-$('topFile').onchange = async e => {
-  topFileSelected = e.target.files[0];
-  if (!topFileSelected) {
-    $('topFileName').textContent = '';
-    return;
-  }
-  
-  $('topFileName').textContent = topFileSelected.name;
-  showStatus('topStatus', 'info', '<span class="spinner"></span> Загрузка базы данных...');
-  
-  try {
-    const formData = new FormData();
-    formData.append('file', topFileSelected);
-    
-    const r = await fetch(API + '/top/upload', {
-      method: 'POST',
-      body: formData
-    });
-    
-    if (!r.ok) {
-      const errText = await r.text();
-      throw new Error(errText);
-    }
-    
-    showStatus('topStatus', 'ok', '✓ База данных загружена');
-    
-    // Загружаем список пользователей
-    await loadTopUsers();
-    
-    // Показываем фильтры
-    $('topFiltersSection').classList.remove('hidden');
-    
-    setTimeout(() => $('topStatus').classList.add('hidden'), 2000);
-    
-  } catch (e) {
-    showStatus('topStatus', 'err', '❌ Ошибка загрузки: ' + e.message);
-  }
-};
-
-// ─── ТОП: Загрузка пользователей ───
-async function loadTopUsers() {
-  try {
-    const r = await fetch(API + '/top/users');
-    if (!r.ok) throw new Error(await r.text());
-    const data = await r.json();
-    
-    fillSelect('topUser', data.users);
-    $('topUser').disabled = false;
-    
-    $('topUser').onchange = () => {
-      if ($('topUser').value) {
-        searchTop();
-      } else {
-        $('topResults').innerHTML = '';
-      }
-    };
-    
-  } catch (e) {
-    showStatus('topStatus', 'err', '❌ Ошибка загрузки пользователей: ' + e.message);
-  }
-}
+@app.get("/", response_class=HTMLResponse)
+def main_form(request: Request):
+    return _static_response(request, "index.html", "no-cache")
 
-// ─── ТОП: Поиск ───
-async function searchTop() {
-  const user = $('topUser').value;
-  if (!user) {
-    showStatus('topStatus', 'err', '❌ Выберите пользователя');
-    return;
-  }
-  
-  showStatus('topStatus', 'info', '<span class="spinner"></span> Поиск...');
-  
-  try {
-    const r = await fetch(API + `/top/search?user=${encodeURIComponent(user)}`);
-    if (!r.ok) throw new Error(await r.text());
-    const data = await r.json();
-    
-    displayTopResults(data.items, data.total);
-    $('topStatus').classList.add('hidden');
-    
-  } catch (e) {
-    showStatus('topStatus', 'err', '❌ Ошибка поиска: ' + e.message);
-  }
-}
 
-// ─── ТОП: Отображение результатов ───
-function displayTopResults(items, total) {
-  const container = $('topResults');
-  
-  if (items.length === 0) {
-    container.innerHTML = '<div class="warehouse-empty">🔍 Оборудование не найдено</div>';
-    return;
-  }
-  
-  let html = `<div class="warehouse-count">📦 Найдено: ${total} шт.</div>`;
-  html += '<table class="warehouse-table">';
-  html += '<thead><tr>';
-  html += '<th>БЕ</th>';
-  html += '<th>ID актива</th>';
-  html += '<th>Название</th>';
-  html += '<th>Описание класса материала</th>';
-  html += '<th>Серийный номер</th>';
-  html += '<th>Инвентарный номер</th>';
-  html += '<th>Пользователь</th>';
-  html += '<th>ФИО пользователя</th>';
-  html += '<th>Комментарии</th>';
-  html += '</tr></thead><tbody>';
-  
-  items.forEach(item => {
-    html += '<tr>';
-    html += `<td>${item['БЕ'] || '-'}</td>`;
-    html += `<td>${item['ID актива'] || '-'}</td>`;
-    html += `<td>${item['Название'] || '-'}</td>`;
-    html += `<td>${item['Описание класса материала'] || '-'}</td>`;
-    html += `<td>${item['Серийный номер'] || '-'}</td>`;
-    html += `<td>${item['Инвентарный номер'] || '-'}</td>`;
-    html += `<td>${item['Пользователь'] || '-'}</td>`;
-    html += `<td>${item['ФИО пользователя'] || '-'}</td>`;
-    html += `<td>${item['Комментарии'] || '-'}</td>`;
-    html += '</tr>';
-  });
-  
-  html += '</tbody></table>';
-  container.innerHTML = html;
-}
+@app.get("/static/{name}")
+def static_asset(name: str, request: Request):
+    if name not in STATIC_ASSETS:
+        raise HTTPException(404, "Файл не найден")
+    return _static_response(request, name, "public, max-age=31536000, immutable")
 
-</script>
-</body>
-</html>
-"""
 
+def _ingest_file(upload: UploadFile) -> dict:
+    """Сохраняет загруженный файл и читает список его листов (в потоке пула)."""
+    with span("upload", file=upload.filename) as sp:
+        path = save_temp_file(upload, UPLOAD_DIR)
+        engine = get_engine(upload.filename)
+        if sp:
+            sp.set(bytes=os.path.getsize(path), engine=str(engine))
+        try:
+            with span("prescan"):
+                scan = prescan_workbook(path, engine)
+        except Exception:
+            scan = None  # Оценка необязательна: стратегия выберется по размеру файла
+        with span("sheet_list") as sp:
+            sheets = get_sheet_names(path, engine)
+            sp.set(sheets=len(sheets))
+    return {
+        "path": path,
+        "engine": engine,
+        "filename": upload.filename,
+        "sheets": sheets,
+        "scan": scan
+    }
 
-# ─── API Routes ──────────────────────────────────────────────────────────────
 
-@app.get("/", response_class=HTMLResponse)
-def main_form():
-    return HTML_PAGE
+async def _ingest_uploads(base_file: UploadFile, process_files: List[UploadFile]):
+    """Параллельный приём файлов: сохранение и чтение листов идут в пуле
+    потоков, события отдаются по мере готовности файлов:
+      {"event": "file", "position", "filename", "sheets", "scan"} — файл готов
+      (scan — оценка размеров листов, см. prescan_workbook),
+      {"event": "error", "position", "filename", "detail"} — файл не прочитан
+      (position = None — базовый файл, дальше приём не идёт),
+      {"event": "done", "base_sheets", "base_scan", "files_count", "process_files_info"}.
+    В сессию попадают только прочитанные файлы, в порядке загрузки.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    base_task = loop.run_in_executor(None, _ingest_file, base_file)
+    tasks = [loop.run_in_executor(None, _ingest_file, pf) for pf in process_files]
+    
+    async def tagged(position, task):
+        try:
+            return position, await task, None
+        except Exception as e:
+            return position, None, e
+    
+    ready = {}
+    for next_done in asyncio.as_completed([tagged(i, t) for i, t in enumerate(tasks)]):
+        position, info, error = await next_done
+        filename = process_files[position].filename
+        if error is not None:
+            yield {"event": "error", "position": position, "filename": filename,
+                   "detail": f"Не удалось прочитать листы файла {filename}: {error}"}
+            continue
+        ready[position] = info
+        yield {"event": "file", "position": position, "filename": filename, "sheets": info["sheets"],
+               "scan": info["scan"]}
+    
+    try:
+        base_info = await base_task
+    except Exception as e:
+        yield {"event": "error", "position": None, "filename": base_file.filename,
+               "detail": f"Не удалось прочитать листы базового файла: {e}"}
+        return
+    
+    process_files_state = [ready[i] for i in sorted(ready)]
+    _set_base_file(base_info)
+    with update_session() as state:
+        previous = (state["results"], state["summary"])
+        state["process_files"] = process_files_state
+        state["results"] = []
+        state["summary"] = None
+    discard_results(*previous)
+    
+    yield {
+        "event": "done",
+        "base_sheets": base_info["sheets"],
+        "base_scan": base_info["scan"],
+        "files_count": len(process_files_state),
+        "process_files_info": [{"filename": f["filename"], "sheets": f["sheets"], "scan": f["scan"]}
+                               for f in process_files_state]
+    }
 
 
 @app.post("/upload_multiple")
 async def upload_multiple(
     base_file: UploadFile = File(...),
-    process_files: List[UploadFile] = File(...)
+    process_files: List[UploadFile] = File(...),
+    stream: bool = False
 ):
-    """Загрузка базового файла + массива файлов для обработки"""
+    """Загрузка базового файла + массива файлов для обработки.
+    stream=true — ответ NDJSON: статус каждого файла по мере готовности
+    (см. _ingest_uploads), иначе один JSON после приёма всех файлов.
+    """
     allowed_ext = (".xlsx", ".xlsb")
     
-    # Проверка базового файла
+    # Проверка форматов до приёма файлов
     if not base_file.filename.lower().endswith(allowed_ext):
         raise HTTPException(400, f"Базовый файл {base_file.filename} — неподдерживаемый формат")
-    
-    # Сохраняем базовый файл
-    base_path = save_temp_file(base_file)
-    base_engine = get_engine(base_file.filename)
-    
-    try:
-        base_sheets = get_sheet_names(base_path, base_engine)
-    except Exception as e:
-        raise HTTPException(500, f"Не удалось прочитать листы базового файла: {e}")
-    
-    session_data["base_file"] = {
-        "path": base_path,
-        "engine": base_engine,
-        "filename": base_file.filename,
-        "sheets": base_sheets
-    }
-    
-    # Обрабатываем файлы для обработки
-    session_data["process_files"] = []
-    process_files_info = []
-    
     for pf in process_files:
         if not pf.filename.lower().endswith(allowed_ext):
             raise HTTPException(400, f"Файл {pf.filename} — неподдерживаемый формат")
-        
-        path = save_temp_file(pf)
-        engine = get_engine(pf.filename)
-        
-        try:
-            sheets = get_sheet_names(path, engine)
-        except Exception as e:
-            raise HTTPException(500, f"Не удалось прочитать листы файла {pf.filename}: {e}")
-        
-        session_data["process_files"].append({
-            "path": path,
-            "engine": engine,
-            "filename": pf.filename,
-            "sheets": sheets
-        })
-        
-        process_files_info.append({
-            "filename": pf.filename,
-            "sheets": sheets
-        })
     
-    return {
-        "base_sheets": base_sheets,
-        "files_count": len(process_files),
-        "process_files_info": process_files_info
-    }
-
-
-@app.get("/columns")
-def get_cols(file_type: str, sheet: str, file_idx: Optional[int] = None):
-    """Возвращает столбцы указанного листа"""
+    events = _ingest_uploads(base_file, process_files)
+    
+    if stream:
+        async def ndjson():
+            async for event in events:
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+    
+    async for event in events:
+        if event["event"] == "error":
+            await events.aclose()
+            raise HTTPException(500, event["detail"])
+        if event["event"] == "done":
+            return {
+                "base_sheets": event["base_sheets"],
+                "base_scan": event["base_scan"],
+                "files_count": event["files_count"],
+                "process_files_info": event["process_files_info"]
+            }
+
+
+def _file_info(file_type: str, file_idx: Optional[int]) -> dict:
+    """Загруженный файл по типу ("base" / "process") и индексу."""
+    state = load_session()
     if file_type == "base":
-        if not session_data.get("base_file"):
+        if not state.get("base_file"):
             raise HTTPException(400, "Базовый файл не загружен")
-        file_info = session_data["base_file"]
+        file_info = state["base_file"]
     elif file_type == "process":
         if file_idx is None:
             raise HTTPException(400, "Не указан индекс файла")
-        if file_idx >= len(session_data["process_files"]):
+        if file_idx >= len(state["process_files"]):
             raise HTTPException(400, "Некорректный индекс файла")
-        file_info = session_data["process_files"][file_idx]
+        file_info = state["process_files"][file_idx]
     else:
         raise HTTPException(400, "Некорректный тип файла")
-    
-    try:
+    return file_info
+
+
+def _sheet_columns(file_info: dict, sheet: str) -> dict:
+    """Столбцы листа и автоопределённые серийник/дата (кешируется по содержимому файла)."""
+    cached_file = cache_path("columns", file_digest(file_info["path"]), sheet)
+    result = load_cached(cached_file)
+    if result is None:
         cols = get_columns(file_info["path"], file_info["engine"], sheet)
         detected = auto_detect_columns(cols)
+        result = {
+            "columns": cols,
+            "detected_serial": detected["serial"],
+            "detected_date": detected["date"]
+        }
+        store_cached(cached_file, result)
+    return result
+
+
+@app.get("/columns")
+def get_cols(file_type: str, sheet: str, file_idx: Optional[int] = None):
+    """Возвращает столбцы указанного листа"""
+    file_info = _file_info(file_type, file_idx)
+    
+    try:
+        return _sheet_columns(file_info, sheet)
     except Exception as e:
         raise HTTPException(500, f"Ошибка чтения столбцов: {e}")
-    
-    return {
-        "columns": cols,
-        "detected_serial": detected["serial"],
-        "detected_date": detected["date"]
-    }
+
+
+@app.get("/columns_batch")
+def get_cols_batch():
+    """Столбцы всех листов всех загруженных файлов за один запрос.
+    Файлы разбираются параллельно, листы одной книги — подряд (общие строки
+    книги читаются один раз).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    state = load_session()
+    if not state.get("base_file"):
+        raise HTTPException(400, "Базовый файл не загружен")
+    files = [state["base_file"]] + state["process_files"]
+    
+    def file_columns(file_info: dict) -> dict:
+        sheets = {}
+        for sheet in file_info["sheets"]:
+            try:
+                sheets[sheet] = _sheet_columns(file_info, sheet)
+            except Exception as e:
+                sheets[sheet] = {"error": f"Ошибка чтения столбцов: {e}"}
+        return sheets
+    
+    with ThreadPoolExecutor(max_workers=min(8, len(files))) as pool:
+        results = list(pool.map(file_columns, files))
+    
+    return {"base": results[0], "process": results[1:]}
+
+
+@app.get("/preview")
+def preview(file_type: str, sheet: str, file_idx: Optional[int] = None, rows: int = PREVIEW_ROWS):
+    """Заголовок и первые строки листа (кешируется по содержимому файла)"""
+    file_info = _file_info(file_type, file_idx)
+    rows = max(1, min(rows, PREVIEW_MAX_ROWS))
+    
+    cached_file = cache_path("preview", file_digest(file_info["path"]), sheet, rows)
+    result = load_cached(cached_file)
+    if result is None:
+        try:
+            result = preview_sheet(file_info["path"], file_info["engine"], sheet, rows)
+        except Exception as e:
+            raise HTTPException(500, f"Ошибка чтения листа: {e}")
+        store_cached(cached_file, result)
+    
+    return {"sheet": sheet, **result}
+
+
+def _process_file(file_info: dict, file_config: dict, base: dict, base_index, config: dict,
+                  output_format: str, stats: dict, detail_path: Optional[str] = None) -> str:
+    """Обработка одного файла пакета; возвращает путь к результату.
+    detail_path — куда писать детализацию для сводки (summary.write_summary)."""
+    with collect_detail(detail_path), span("process_file", file=file_info["filename"]) as sp:
+        if sp:
+            sp.set(bytes=os.path.getsize(file_info["path"]))
+        result_path = _process_sheets(file_info, file_config, base, base_index, config, output_format, stats)
+        sp.set(rows=stats.get("total_rows"), matched=stats.get("matched"), outdated=stats.get("outdated"))
+        return result_path
+
+
+def _process_sheets(file_info: dict, file_config: dict, base: dict, base_index, config: dict,
+                    output_format: str, stats: dict) -> str:
+    if file_config.get("all_sheets") or len(file_config.get("sheets") or []) > 1:
+        # Несколько листов книги — за один проход, в одну книгу результата
+        return process_workbook_sheets(
+            path1=file_info["path"],
+            path2=base["path"],
+            engine1=file_info["engine"],
+            engine2=base["engine"],
+            sheets1=None if file_config.get("all_sheets") else file_config["sheets"],
+            sheet2=config["base_sheet"],
+            serial_col1=file_config.get("serial_col"),
+            serial_col2=config["base_serial"],
+            date_col2=config["base_date"],
+            compare=file_config["compare"],
+            tech_refresh=file_config["tech_refresh"],
+            duplicate_policy=config.get("duplicate_policy", "last"),
+            stats=stats,
+            base_index=base_index,
+            stock_check=config.get("stock_check", "exact"),
+            output_format=output_format
+        )
+    return process_excels(
+        path1=file_info["path"],
+        path2=base["path"],
+        engine1=file_info["engine"],
+        engine2=base["engine"],
+        sheet1=file_config.get("sheet") or file_config["sheets"][0],
+        sheet2=config["base_sheet"],
+        serial_col1=file_config["serial_col"],
+        serial_col2=config["base_serial"],
+        date_col1=file_config["date_col"],
+        date_col2=config["base_date"],
+        compare=file_config["compare"],
+        tech_refresh=file_config["tech_refresh"],
+        duplicate_policy=config.get("duplicate_policy", "last"),
+        stats=stats,
+        base_index=base_index,
+        stock_check=config.get("stock_check", "exact"),
+        streaming=file_config.get("streaming"),
+        output_format=output_format
+    )
+
+
+def _batch_keys(base: dict, process_files: list, files_config: list, base_key: list) -> list:
+    """Ключи кеша результатов файлов пакета (хеш файла, хеш базы, base_key).
+    Хеширует файлы целиком, поэтому вызывается в потоке пула."""
+    base_digest = file_digest(base["path"])
+    return [result_cache_key(file_digest(f["path"]), files_config[i], base_digest, *base_key)
+            for i, f in enumerate(process_files)]
+
+
+def _admission_memory(base: dict, config: dict, process_files: list, result_keys: list) -> int:
+    """Оценка памяти пакета без файлов, результаты которых уже есть в кеше."""
+    return estimate_job_memory(base, config["base_sheet"], [
+        (f, config["files_config"][i]) for i, f in enumerate(process_files)
+        if not has_cached_result(result_keys[i])
+    ])
+
+
+def _run_budgeted(job_id: str, seconds, profile_mode: str, memory: dict, func, *args):
+    """func(*args) в потоке пула с бюджетом времени и проверкой отмены пакета;
+    профиль памяти (profiling.memory_profile) записывается в memory."""
+    with time_budget(seconds, lambda: is_cancelled(job_id)), memory_profile(profile_mode, memory), \
+            trace_context(job_id=job_id):
+        return func(*args)
+
+
+_background: set = set()  # Фоновые задачи пакетов (ссылки, чтобы их не собрал GC)
+
+
+async def _finish_abandoned(job_id: str, tasks: list):
+    """Дожидается файлов пакета, брошенных по таймауту, забирает их результат
+    (готовый файл уже не нужен) и освобождает бюджет памяти пакета."""
+    import asyncio
+    try:
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, str):
+                with contextlib.suppress(OSError):
+                    os.remove(result)
+        await asyncio.get_running_loop().run_in_executor(None, release, job_id)
+    finally:
+        _background.discard(asyncio.current_task())
 
 
 @app.post("/process_multiple")
 async def process_multiple(config: dict):
     """Обработка всех файлов"""
-    if not session_data.get("base_file") or not session_data.get("process_files"):
+    state = load_session()
+    if not state.get("base_file") or not state.get("process_files"):
         raise HTTPException(400, "Файлы не загружены")
     
-    base = session_data["base_file"]
+    base = state["base_file"]
     results = []
-    session_data["results"] = []
+    result_files = []
+    base_config = [config["base_sheet"], config["base_serial"], config["base_date"],
+                   config.get("duplicate_policy", "last")]
     
-    for idx, file_info in enumerate(session_data["process_files"]):
-        file_config = config["files_config"][idx]
-        
+    from .base_index import STOCK_FILTER_BYTES, STOCK_FILTER_MIN_ROWS
+    from .result_formats import check_format, result_filename
+    try:
+        output_format = check_format(config.get("output_format"))
+        profile_mode = check_mode(config.get("profile_memory"))
+    except Exception as e:
+        raise HTTPException(400, str(e))
+    
+    # Пакет можно отменить через /cancel (job_id задаёт клиент); каждый файл
+    # обрабатывается в пуле потоков с бюджетом времени file_timeout секунд
+    import asyncio
+    import uuid
+    job_id = str(config.get("job_id") or uuid.uuid4())
+    file_timeout = config.get("file_timeout")
+    timeout = float(FILE_TIMEOUT if file_timeout is None else file_timeout) or None  # 0 — без ограничения
+    loop = asyncio.get_running_loop()
+    cancelled = False
+    abandoned = []  # Файлы, которые не дождались: их потоки ещё могут работать
+    
+    # База читается один раз на весь пакет (и между пакетами, пока не менялась),
+    # и только если хотя бы одного результата нет в кеше
+    base_index = None
+    base_memory = {}
+    base_key = [state["base_deltas"], base_config, config.get("stock_check", "exact"), output_format,
+                CURRENT_YEAR, TECH_REFRESH_YEARS, STOCK_FILTER_MIN_ROWS, STOCK_FILTER_BYTES]
+    # Сводная книга строится из статистики файлов; детализация для неё
+    # пишется при обработке и хранится в кеше вместе с результатом
+    summary_detail = bool(config.get("summary_detail"))
+    summary_files = []
+    detail_paths = []
+    if summary_detail:
+        base_key.append("detail")
+    # Хеши файлов, копии из кеша результатов и блокировка очереди — в потоках
+    # пула: цикл событий не должен стоять (/cancel и /queue опрашиваются)
+    result_keys = await loop.run_in_executor(None, _batch_keys, base, state["process_files"],
+                                             config["files_config"], base_key)
+    
+    # Пакет в трассировке — асинхронный интервал: в цикле событий вперемешку
+    # идут другие запросы, а файлы обрабатываются в потоках пула
+    with span("batch", async_id=job_id, job_id=job_id, files=len(state["process_files"])) as batch_span:
         try:
-            result_path = process_excels(
-                path1=file_info["path"],
-                path2=base["path"],
-                engine1=file_info["engine"],
-                engine2=base["engine"],
-                sheet1=file_config["sheet"],
-                sheet2=config["base_sheet"],
-                serial_col1=file_config["serial_col"],
-                serial_col2=config["base_serial"],
-                date_col1=file_config["date_col"],
-                date_col2=config["base_date"],
-                compare=file_config["compare"],
-                tech_refresh=file_config["tech_refresh"]
-            )
-        except Exception as e:
-            raise HTTPException(500, f"Ошибка обработки файла {file_info['filename']}: {e}")
-        
-        # Статистика
-        import pandas as pd
-        df = pd.read_excel(result_path, engine="calamine")
+            # Допуск по памяти: пакет ждёт в общей очереди, пока его оценка (без
+            # файлов, уже готовых в кеше) не поместится в бюджет; /queue — позиция
+            memory_bytes = await loop.run_in_executor(None, _admission_memory, base, config,
+                                                      state["process_files"], result_keys)
+            with span("admission", async_id=job_id, memory_bytes=memory_bytes):
+                while not await loop.run_in_executor(None, try_admit, job_id, memory_bytes):
+                    if is_cancelled(job_id):
+                        break
+                    await asyncio.sleep(ADMISSION_POLL)
         
-        matched = None
-        outdated = None
+            for idx, file_info in enumerate(state["process_files"]):
+                if is_cancelled(job_id):
+                    cancelled = True
+                    break
+                file_config = config["files_config"][idx]
+            
+                stats = {}
+                memory = {}
+                detail_path = None
+                if summary_detail:
+                    with tempfile.NamedTemporaryFile(delete=False, dir=RESULT_DIR, prefix="detail_",
+                                                     suffix=".detail") as tmp:
+                        detail_path = tmp.name
+                    detail_paths.append(detail_path)
+                result_key = result_keys[idx]
+                cached = await loop.run_in_executor(None, load_cached_result, result_key)
+                if cached is not None:
+                    result_path, stats = cached
+                    stats["cached"] = True
+                    detail_path = stats.pop("detail_path", None)
+                    if detail_path:
+                        detail_paths.append(detail_path)
+                else:
+                    try:
+                        if base_index is None:
+                            try:
+                                base_index = await loop.run_in_executor(
+                                    None, _run_budgeted, job_id, None, profile_mode, base_memory,
+                                    _get_base_index, state, *base_config)
+                            except ProcessingStopped:
+                                raise
+                            except Exception as e:
+                                raise HTTPException(500, f"Ошибка чтения базы данных: {e}")
+                        # Ожидание ограничено тем же бюджетом: если поток застрял в долгом
+                        # вызове, файл помечается неудачным, а поток остановится на
+                        # ближайшей проверке бюджета (его дождётся _finish_abandoned)
+                        task = loop.run_in_executor(None, _run_budgeted, job_id, timeout, profile_mode,
+                                                    memory, _process_file, file_info, file_config, base,
+                                                    base_index, config, output_format, stats, detail_path)
+                        abandoned.append(task)
+                        done, _ = await asyncio.wait({task}, timeout=timeout)
+                        if not done:
+                            raise asyncio.TimeoutError()
+                        abandoned.remove(task)
+                        result_path = task.result()
+                    except (ProcessingStopped, asyncio.TimeoutError) as e:
+                        if is_cancelled(job_id):
+                            cancelled = True
+                            break
+                        error = str(e) or f"Превышено время обработки файла ({timeout:g} с)"
+                        result_files.append({"path": None, "filename": None})
+                        summary_files.append({"filename": file_info["filename"], "stats": None, "error": error})
+                        results.append({"source_filename": file_info["filename"], "result_filename": None,
+                                        "failed": True, "error": error, "memory": memory or None})
+                        continue
+                    except HTTPException:
+                        raise
+                    except Exception as e:
+                        raise HTTPException(500, f"Ошибка обработки файла {file_info['filename']}: {e}")
+                    try:
+                        await loop.run_in_executor(None, store_cached_result, result_key, result_path,
+                                                   dict(stats, detail_path=detail_path))
+                    except Exception:
+                        pass  # Кеш результатов необязателен
+                    try:
+                        await loop.run_in_executor(None, record_metrics, file_info["filename"], memory)
+                    except Exception:
+                        pass  # Сводка профилей необязательна
+            
+                # Несколько листов не в XLSX — ZIP с файлом на лист
+                out_name = result_filename(file_info["filename"], output_format)
+                if os.path.splitext(result_path)[1] == ".zip":
+                    out_name = os.path.splitext(out_name)[0] + ".zip"
+                result_name = f"result_{idx + 1}_{out_name}"
         
-        if file_config["compare"] and "Передано на склад" in df.columns:
-            matched = int((df["Передано на склад"] == "Да").sum())
+                result_files.append({
+                    "path": result_path,
+                    "filename": result_name
+                })
+                summary_files.append({"filename": file_info["filename"], "stats": stats,
+                                      "detail_path": detail_path})
         
-        if file_config["tech_refresh"] and "Оборудование устарело" in df.columns:
-            outdated = int(df["Оборудование устарело"].str.startswith("Да", na=False).sum())
-        
-        result_filename = f"result_{idx + 1}_{file_info['filename']}"
-        
-        session_data["results"].append({
-            "path": result_path,
-            "filename": result_filename
-        })
-        
-        results.append({
-            "source_filename": file_info["filename"],
-            "result_filename": result_filename,
-            "total_rows": len(df),
-            "matched": matched,
-            "outdated": outdated
-        })
+                # Статистика считается при обработке, без повторного чтения результата
+                results.append({
+                    "source_filename": file_info["filename"],
+                    "result_filename": result_name,
+                    "total_rows": stats["total_rows"],
+                    "matched": stats["matched"],
+                    "outdated": stats["outdated"],
+                    "duplicate_serials": stats.get("duplicate_serials"),
+                    "duplicate_rows": stats.get("duplicate_rows"),
+                    "join_array_bytes": stats.get("join_array_bytes"),
+                    "stock_filter": stats.get("stock_filter"),
+                    "stock_false_positives": stats.get("stock_false_positives"),
+                    "streamed": stats.get("streamed", False),
+                    "sheets": stats.get("sheets"),
+                    "age_buckets": stats.get("age_buckets"),
+                    "cached": stats.get("cached", False),
+                    "memory": memory or None
+                })
+        except BaseException:
+            # Пакет не завершён: его файлы в сессию не попадут
+            discard_results(result_files)
+            for path in detail_paths:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+            raise
+        finally:
+            if abandoned:
+                # Бюджет памяти освобождается, только когда брошенные потоки завершатся
+                _background.add(asyncio.ensure_future(_finish_abandoned(job_id, abandoned)))
+            else:
+                await loop.run_in_executor(None, release, job_id)
+            clear_cancel(job_id)
+        batch_span.set(cancelled=cancelled)
+    
+    # Сводная книга — по статистике, собранной при обработке
+    summary_path = None
+    if any(item["stats"] for item in summary_files):
+        from .summary import write_summary
+        with tempfile.NamedTemporaryFile(delete=False, dir=RESULT_DIR, prefix="summary_", suffix=".xlsx") as tmp:
+            summary_path = tmp.name
+        try:
+            await loop.run_in_executor(None, write_summary, summary_path, summary_files, summary_detail)
+        except Exception:
+            os.remove(summary_path)
+            summary_path = None  # Сводка необязательна: результаты файлов уже готовы
+    for path in detail_paths:
+        if os.path.exists(path):
+            os.remove(path)
+    
+    # Результаты прежнего пакета заменяются — их файлы больше не нужны
+    with update_session() as state:
+        previous = (state["results"], state["summary"])
+        state["results"] = result_files
+        state["summary"] = summary_path
+        state["base_config"] = base_config
+    await loop.run_in_executor(None, discard_results, *previous)
+    
+    if base_memory:
+        try:
+            record_metrics(base["filename"], base_memory, kind="base")
+        except Exception:
+            pass
     
-    return {"results": results}
+    return {"results": results, "job_id": job_id, "cancelled": cancelled,
+            "base_memory": base_memory or None, "summary": summary_path is not None}
+
+
+@app.get("/queue")
+def queue(job_id: str):
+    """Положение пакета в очереди допуска (position 0 — выполняется)."""
+    return queue_status(job_id)
+
+
+@app.get("/metrics")
+def metrics():
+    """Память по этапам обработки (профили всех процессов) и RSS этого процесса."""
+    return load_metrics()
+
+
+@app.post("/cancel")
+def cancel(job_id: str):
+    """Отмена пакета: ожидающий в очереди снимается, у выполняемого текущий
+    файл прерывается на ближайшей проверке, следующие не обрабатываются."""
+    request_cancel(job_id)
+    return {"job_id": job_id, "cancelled": True}
 
 
 @app.get("/download_single")
 def download_single(idx: int):
     """Скачать отдельный результат"""
-    if idx >= len(session_data["results"]):
+    results = load_session()["results"]
+    if idx >= len(results):
         raise HTTPException(400, "Некорректный индекс файла")
+    if not results[idx]["path"]:
+        raise HTTPException(400, "Файл не обработан")
     
-    result = session_data["results"][idx]
+    from .result_formats import RESULT_FORMATS
+    result = results[idx]
+    ext = os.path.splitext(result["filename"])[1].lower()
+    media_type = next((media for suffix, media in RESULT_FORMATS.values() if suffix == ext), "application/zip")
     return FileResponse(
         result["path"],
         filename=result["filename"],
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        media_type=media_type
     )
 
 
 @app.get("/download_all")
 def download_all():
     """Скачать все результаты в ZIP"""
-    if not session_data.get("results"):
+    results = load_session()["results"]
+    if not results:
         raise HTTPException(400, "Нет результатов для скачивания")
     
-    # Создаем ZIP архив
-    zip_path = os.path.join(tempfile.gettempdir(), "results_all.zip")
+    # Создаем ZIP архив (свой файл на запрос: его могут собирать разные процессы)
+    with tempfile.NamedTemporaryFile(delete=False, dir=RESULT_DIR, prefix="results_all_", suffix=".zip") as tmp:
+        zip_path = tmp.name
     
     with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for result in session_data["results"]:
-            zipf.write(result["path"], result["filename"])
+        for result in results:
+            if result["path"]:
+                zipf.write(result["path"], result["filename"])
     
+    # Архив собирается на каждый запрос, поэтому удаляется после отправки
     return FileResponse(
         zip_path,
         filename="results_all.zip",
-        media_type="application/zip"
+        media_type="application/zip",
+        background=BackgroundTask(os.remove, zip_path)
     )
 
 
+@app.get("/download_summary")
+def download_summary():
+    """Скачать сводную книгу последнего пакета"""
+    path = load_session().get("summary")
+    if not path or not os.path.exists(path):
+        raise HTTPException(400, "Нет сводки для скачивания")
+    
+    from .summary import SUMMARY_FILENAME
+    from .result_formats import RESULT_FORMATS
+    return FileResponse(path, filename=SUMMARY_FILENAME, media_type=RESULT_FORMATS["xlsx"][1])
+
+
+def _read_delta_upload(file: UploadFile, base_sheet: str) -> tuple:
+    """Сохраняет загруженный файл изменений и читает его: (путь, изменение)."""
+    from .base_index import read_delta
+    path = save_temp_file(file, UPLOAD_DIR)
+    return path, read_delta(path, get_engine(file.filename), base_sheet)
+
+
+def _store_delta(path: str, delta: dict, base_sheet: str) -> tuple:
+    """Добавляет изменение в общий журнал и применяет его к кешам процесса.
+    Возвращает (состояние сессии, счётчики изменения индекса)."""
+    # Изменение попадает в общий журнал: остальные процессы применят его
+    # к своим индексам и листу "Возврат" при следующем запросе
+    delta["sheet"] = base_sheet
+    delta_path = cache_path("delta", file_digest(path), base_sheet, suffix=DELTA_SUFFIX)
+    store_cached(delta_path, delta)
+    with update_session() as state:
+        state["base_deltas"].append(delta_path)
+    
+    # В этом процессе применяем сразу
+    counts = {}
+    cached = _local_cache["base_index"]
+    if cached is not None and cached[0][0] == state["base_file"]["path"]:
+        index, counts = _catch_up_index(cached[1], state, cached[0][1])
+        _publish_index(cached[0], index)
+    if _local_cache["return_df_key"] and _local_cache["return_df_key"][0] == state["base_file"]["path"]:
+        _get_return_df(state)
+    return state, counts
+
+
+@app.post("/base/delta")
+async def base_delta(file: UploadFile = File(...), base_sheet: Optional[str] = Form(None)):
+    """Применить файл изменений к загруженной базе данных без её перечитывания.
+
+    Лист с именем листа базы — добавленные/изменённые/удалённые строки базы,
+    лист "Возврат" — строки склада; удаление помечается в столбце "Операция".
+    """
+    state = load_session()
+    if not state.get("base_file"):
+        raise HTTPException(400, "База данных не загружена")
+    if not file.filename.lower().endswith((".xlsx", ".xlsb")):
+        raise HTTPException(400, f"Файл {file.filename} — неподдерживаемый формат")
+    
+    if not base_sheet:
+        if state["base_config"]:
+            base_sheet = state["base_config"][0]
+        else:
+            sheets = [s for s in state["base_file"]["sheets"] if s != RETURN_SHEET]
+            base_sheet = sheets[0] if sheets else None
+    
+    # Чтение и сохранение изменений — в потоке пула, не в цикле событий
+    import asyncio
+    loop = asyncio.get_running_loop()
+    try:
+        path, delta = await loop.run_in_executor(None, _read_delta_upload, file, base_sheet)
+    except Exception as e:
+        raise HTTPException(400, f"Не удалось прочитать файл изменений: {e}")
+    state, counts = await loop.run_in_executor(None, _store_delta, path, delta, base_sheet)
+    
+    return {
+        "status": "ok",
+        "base_sheet": base_sheet,
+        "base_rows": 0 if delta["base"] is None else len(delta["base"]),
+        "stock_rows": 0 if delta["stock"] is None else len(delta["stock"]),
+        "applied": counts,
+        "deltas_total": len(state["base_deltas"])
+    }
+
+
 # ─── Склад ───────────────────────────────────────────────────────────────────
 
 @app.post("/warehouse/upload")
@@ -1101,7 +951,7 @@ async def warehouse_upload(file: UploadFile = File(...)):
     """Загрузить файл базы данных для склада"""
     try:
         # Сохраняем файл
-        file_path = save_temp_file(file)
+        file_path = save_temp_file(file, UPLOAD_DIR)
         engine = get_engine(file.filename)
         
         # Проверяем наличие листа "Возврат"
@@ -1109,13 +959,13 @@ async def warehouse_upload(file: UploadFile = File(...)):
         if "Возврат" not in sheets:
             raise HTTPException(400, f"Лист 'Возврат' не найден. Доступные листы: {', '.join(sheets)}")
         
-        # Сохраняем в session_data
-        session_data["base_file"] = {
+        # Сохраняем в общее состояние сессии
+        _set_base_file({
             "path": file_path,
             "engine": engine,
             "filename": file.filename,
             "sheets": sheets
-        }
+        })
         
         return {"status": "ok", "filename": file.filename, "sheets": sheets}
     
@@ -1128,15 +978,12 @@ async def warehouse_upload(file: UploadFile = File(...)):
 @app.get("/warehouse/types")
 def warehouse_types():
     """Получить уникальные типы оборудования из листа Возврат"""
-    if not session_data.get("base_file"):
+    state = load_session()
+    if not state.get("base_file"):
         raise HTTPException(400, "База данных не загружена")
     
     try:
-        import pandas as pd
-        from .excel_logic import _read_sheet_safe
-        
-        base = session_data["base_file"]
-        df = _read_sheet_safe(base["path"], base["engine"], "Возврат")
+        df = _get_return_df(state)
         
         if "Тип оборудования" not in df.columns:
             raise HTTPException(400, "Столбец 'Тип оборудования' не найден на листе 'Возврат'")
@@ -1154,15 +1001,12 @@ def warehouse_types():
 @app.get("/warehouse/models")
 def warehouse_models(type: str):
     """Получить модели по типу оборудования"""
-    if not session_data.get("base_file"):
+    state = load_session()
+    if not state.get("base_file"):
         raise HTTPException(400, "База данных не загружена")
     
     try:
-        import pandas as pd
-        from .excel_logic import _read_sheet_safe
-        
-        base = session_data["base_file"]
-        df = _read_sheet_safe(base["path"], base["engine"], "Возврат")
+        df = _get_return_df(state)
         
         if "Тип оборудования" not in df.columns or "Модель" not in df.columns:
             raise HTTPException(400, "Необходимые столбцы не найдены")
@@ -1180,18 +1024,54 @@ def warehouse_models(type: str):
         raise HTTPException(500, f"Ошибка чтения данных: {str(e)}")
 
 
+SEARCH_CHUNK_ROWS = 5000  # Строк в одном блоке ответа поиска
+
+
+def _json_records(df, lines: bool = False) -> str:
+    """Строки DataFrame в JSON C-кодировщиком pandas, без промежуточных словарей."""
+    df = df.fillna("")
+    for col in df.columns:
+        if df[col].dtype.kind == "M":
+            df[col] = df[col].dt.strftime("%Y-%m-%dT%H:%M:%S")
+    return df.to_json(orient="records", lines=lines, force_ascii=False, double_precision=15)
+
+
+def _records_response(df, stream: bool = False) -> StreamingResponse:
+    """Ответ поиска блоками по SEARCH_CHUNK_ROWS строк прямо из закешированного листа.
+    Обычный ответ — JSON {"total", "items": [...]}, который пишется по частям;
+    stream=true — NDJSON: {"total"} первой строкой, дальше по строке на запись.
+    """
+    total = len(df)
+    
+    def chunks():
+        for start in range(0, total, SEARCH_CHUNK_ROWS):
+            yield df.iloc[start:start + SEARCH_CHUNK_ROWS]
+    
+    def ndjson():
+        yield json.dumps({"total": total}) + "\n"
+        for chunk in chunks():
+            yield _json_records(chunk, lines=True).rstrip("\n") + "\n"
+    
+    def chunked_json():
+        yield '{"total": %d, "items": [' % total
+        for i, chunk in enumerate(chunks()):
+            yield ("," if i else "") + _json_records(chunk)[1:-1]
+        yield "]}"
+    
+    if stream:
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+    return StreamingResponse(chunked_json(), media_type="application/json")
+
+
 @app.get("/warehouse/search")
-def warehouse_search(type: str, model: Optional[str] = None):
-    """Поиск оборудования на складе"""
-    if not session_data.get("base_file"):
+def warehouse_search(type: str, model: Optional[str] = None, stream: bool = False):
+    """Поиск оборудования на складе (stream=true — NDJSON, см. _records_response)"""
+    state = load_session()
+    if not state.get("base_file"):
         raise HTTPException(400, "База данных не загружена")
     
     try:
-        import pandas as pd
-        from .excel_logic import _read_sheet_safe
-        
-        base = session_data["base_file"]
-        df = _read_sheet_safe(base["path"], base["engine"], "Возврат")
+        df = _get_return_df(state)
         
         # Проверяем наличие всех необходимых столбцов
         required_cols = ["Адрес", "Корпус/Этаж", "Местоположение", "Тип оборудования", 
@@ -1208,13 +1088,7 @@ def warehouse_search(type: str, model: Optional[str] = None):
         if model:
             filtered = filtered[filtered["Модель"] == model]
         
-        # Преобразуем в список словарей
-        items = filtered[required_cols].fillna("").to_dict('records')
-        
-        return {
-            "items": items,
-            "total": len(items)
-        }
+        return _records_response(filtered[required_cols], stream)
     
     except Exception as e:
         raise HTTPException(500, f"Ошибка поиска: {str(e)}")
@@ -1227,19 +1101,20 @@ async def top_upload(file: UploadFile = File(...)):
     """Загрузить файл с оборудованием у ТОПа"""
     try:
         # Сохраняем файл
-        file_path = save_temp_file(file)
+        file_path = save_temp_file(file, UPLOAD_DIR)
         engine = get_engine(file.filename)
         
         # Получаем листы
         sheets = get_sheet_names(file_path, engine)
         
-        # Сохраняем в session_data
-        session_data["top_file"] = {
-            "path": file_path,
-            "engine": engine,
-            "filename": file.filename,
-            "sheets": sheets
-        }
+        # Сохраняем в общее состояние сессии
+        with update_session() as state:
+            state["top_file"] = {
+                "path": file_path,
+                "engine": engine,
+                "filename": file.filename,
+                "sheets": sheets
+            }
         
         return {"status": "ok", "filename": file.filename, "sheets": sheets}
     
@@ -1252,17 +1127,14 @@ async def top_upload(file: UploadFile = File(...)):
 @app.get("/top/users")
 def top_users():
     """Получить уникальные ФИО пользователей"""
-    if not session_data.get("top_file"):
+    top = load_session().get("top_file")
+    if not top:
         raise HTTPException(400, "База данных не загружена")
     
     try:
-        import pandas as pd
-        from .excel_logic import _read_sheet_safe
-        
-        top = session_data["top_file"]
         # Читаем первый лист (предполагаем что данные на первом листе)
         sheet_name = top["sheets"][0]
-        df = _read_sheet_safe(top["path"], top["engine"], sheet_name)
+        df = read_sheet_cached(top["path"], top["engine"], sheet_name)
         
         if "ФИО пользователя" not in df.columns:
             raise HTTPException(400, "Столбец 'ФИО пользователя' не найден")
@@ -1278,18 +1150,15 @@ def top_users():
 
 
 @app.get("/top/search")
-def top_search(user: str):
-    """Поиск оборудования по ФИО пользователя"""
-    if not session_data.get("top_file"):
+def top_search(user: str, stream: bool = False):
+    """Поиск оборудования по ФИО пользователя (stream=true — NDJSON, см. _records_response)"""
+    top = load_session().get("top_file")
+    if not top:
         raise HTTPException(400, "База данных не загружена")
     
     try:
-        import pandas as pd
-        from .excel_logic import _read_sheet_safe
-        
-        top = session_data["top_file"]
         sheet_name = top["sheets"][0]
-        df = _read_sheet_safe(top["path"], top["engine"], sheet_name)
+        df = read_sheet_cached(top["path"], top["engine"], sheet_name)
         
         # Проверяем наличие всех необходимых столбцов
         required_cols = ["БЕ", "ID актива", "Название", "Описание класса материала", 
@@ -1303,17 +1172,12 @@ def top_search(user: str):
         # Фильтруем по ФИО пользователя
         filtered = df[df["ФИО пользователя"] == user]
         
-        # Преобразуем в список словарей
-        items = filtered[required_cols].fillna("").to_dict('records')
-        
-        return {
-            "items": items,
-            "total": len(items)
-        }
+        return _records_response(filtered[required_cols], stream)
     
     except Exception as e:
         raise HTTPException(500, f"Ошибка поиска: {str(e)}")
 
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run("app.main:app", host="127.0.0.1", port=8001, reload=True)
@@ -0,0 +1,237 @@
+# Профилирование памяти обработки: tracemalloc / выборки RSS по этапам
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+from .shared_store import SHARED_DIR, atomic_write, locked
+
+PROFILE_MODES = ("off", "rss", "tracemalloc")
+PROFILE_MEMORY = os.environ.get("EXCEL_PROFILE_MEMORY", "off")  # Режим по умолчанию
+RSS_SAMPLE_INTERVAL = 0.05  # Период выборки RSS, секунд
+METRICS_FILE = os.path.join(SHARED_DIR, "metrics.json")  # Сводка по всем worker-процессам
+METRICS_RECENT = 50  # Сколько последних файлов хранить в сводке
+
+_profile = threading.local()  # Профиль текущего потока
+_tracing_lock = threading.Lock()
+_tracing_users = 0  # Сколько профилей сейчас используют tracemalloc
+
+
+def check_mode(mode: Optional[str]) -> str:
+    """Проверяет режим профилирования; None — режим по умолчанию."""
+    mode = mode or PROFILE_MEMORY
+    if mode not in PROFILE_MODES:
+        raise Exception(f"Неизвестный режим профилирования: {mode}. Доступны: {', '.join(PROFILE_MODES)}")
+    return mode
+
+
+def current_rss() -> Optional[int]:
+    """Текущий RSS процесса в байтах (None, если /proc недоступен)."""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def max_rss() -> Optional[int]:
+    """Наибольший RSS процесса за всё время работы."""
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, OSError):
+        return None
+
+
+class _RssSampler(threading.Thread):
+    """Фоновая выборка RSS: наибольшее значение с последнего reset()."""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = current_rss()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(RSS_SAMPLE_INTERVAL):
+            self.sample()
+
+    def sample(self) -> Optional[int]:
+        rss = current_rss()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+        return rss
+
+    def reset(self) -> Optional[int]:
+        self.peak = None
+        return self.sample()
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def _start_tracing():
+    global _tracing_users
+    import tracemalloc
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracing_users += 1
+
+
+def _stop_tracing():
+    global _tracing_users
+    import tracemalloc
+    with _tracing_lock:
+        _tracing_users -= 1
+        if _tracing_users == 0:
+            tracemalloc.stop()
+
+
+def _traced() -> tuple:
+    """(текущая, пиковая) память по tracemalloc."""
+    import tracemalloc
+    return tracemalloc.get_traced_memory()
+
+
+@contextlib.contextmanager
+def memory_profile(mode: str = "off", target: Optional[dict] = None):
+    """Профиль памяти обработки в текущем потоке.
+
+    Этапы отмечаются memory_stage(); по выходу (и при ошибке) target
+    заполняется: peak_bytes / retained_bytes — рост памяти на пике и в конце
+    относительно начала, rss_peak_bytes — наибольший RSS по выборкам,
+    stages — то же по каждому этапу. В режиме "tracemalloc" рост считается
+    по выделениям Python (точнее, но обработка медленнее), в режиме "rss" —
+    по RSS процесса. Пакеты, идущие параллельно в одном процессе, попадают
+    в замеры друг друга.
+    """
+    if mode == "off" or target is None:
+        yield
+        return
+    tracing = mode == "tracemalloc"
+    if tracing:
+        _start_tracing()
+    sampler = _RssSampler()
+    sampler.start()
+    start = _traced()[0] if tracing else sampler.peak
+    state = {"tracing": tracing, "sampler": sampler, "stages": [], "peak": start, "rss_peak": sampler.peak}
+    previous = getattr(_profile, "value", None)
+    _profile.value = state
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        _profile.value = previous
+        sampler.stop()
+        if tracing:
+            current, peak = _traced()
+            _stop_tracing()
+        else:
+            current = peak = sampler.sample()
+        peak = _max(state["peak"], peak, sampler.peak if not tracing else None)
+        target.update({
+            "mode": mode,
+            "seconds": round(time.perf_counter() - began, 3),
+            "peak_bytes": _growth(peak, start),
+            "retained_bytes": _growth(current, start),
+            "rss_peak_bytes": _max(state["rss_peak"], sampler.peak),
+            "stages": state["stages"],
+        })
+
+
+@contextlib.contextmanager
+def memory_stage(name: str):
+    """Этап обработки внутри memory_profile (без профиля — ничего не делает)."""
+    state = getattr(_profile, "value", None)
+    if state is None:
+        yield
+        return
+    import tracemalloc
+    sampler = state["sampler"]
+    if state["tracing"]:
+        # Пик предыдущего отрезка сохраняем до сброса
+        state["peak"] = _max(state["peak"], _traced()[1])
+        tracemalloc.reset_peak()
+        start = _traced()[0]
+    state["rss_peak"] = _max(state["rss_peak"], sampler.peak)
+    rss_start = sampler.reset()
+    if not state["tracing"]:
+        start = rss_start
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        rss = sampler.sample()
+        if state["tracing"]:
+            current, peak = _traced()
+            state["peak"] = _max(state["peak"], peak)
+        else:
+            current, peak = rss, sampler.peak
+            state["peak"] = _max(state["peak"], peak)
+        state["rss_peak"] = _max(state["rss_peak"], sampler.peak)
+        state["stages"].append({
+            "stage": name,
+            "seconds": round(time.perf_counter() - began, 3),
+            "peak_bytes": _growth(peak, start),
+            "retained_bytes": _growth(current, start),
+            "rss_peak_bytes": sampler.peak,
+        })
+
+
+def _max(*values) -> Optional[int]:
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+def _growth(value: Optional[int], start: Optional[int]) -> Optional[int]:
+    if value is None or start is None:
+        return None
+    return max(value - start, 0)
+
+
+def record_metrics(filename: str, profile: dict, kind: str = "file"):
+    """Добавляет профиль в общую сводку (/metrics): этапы — по именам,
+    весь профиль — под именем kind ("file" — файл пакета, "base" — индекс базы)."""
+    if not profile:
+        return
+    with locked(exclusive=True):
+        metrics = _read_metrics()
+        metrics["files"] += 1
+        for item in profile.get("stages", []) + [dict(profile, stage=kind)]:
+            stage = metrics["stages"].setdefault(item["stage"], {
+                "count": 0, "peak_bytes_max": 0, "peak_bytes_total": 0,
+                "retained_bytes_max": 0, "rss_peak_bytes_max": 0,
+            })
+            stage["count"] += 1
+            stage["peak_bytes_max"] = max(stage["peak_bytes_max"], item["peak_bytes"] or 0)
+            stage["peak_bytes_total"] += item["peak_bytes"] or 0
+            stage["retained_bytes_max"] = max(stage["retained_bytes_max"], item["retained_bytes"] or 0)
+            stage["rss_peak_bytes_max"] = max(stage["rss_peak_bytes_max"], item["rss_peak_bytes"] or 0)
+        metrics["recent"] = (metrics["recent"] + [{
+            "filename": filename,
+            "kind": kind,
+            "pid": os.getpid(),
+            "at": time.time(),
+            **{k: profile[k] for k in ("mode", "seconds", "peak_bytes", "retained_bytes", "rss_peak_bytes")},
+        }])[-METRICS_RECENT:]
+        atomic_write(METRICS_FILE, json.dumps(metrics).encode("utf-8"))
+
+
+def _read_metrics() -> dict:
+    try:
+        with open(METRICS_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"files": 0, "stages": {}, "recent": []}
+
+
+def load_metrics() -> dict:
+    """Сводка профилей по этапам и последние файлы; плюс память этого процесса."""
+    with locked(exclusive=False):
+        metrics = _read_metrics()
+    metrics["process"] = {"pid": os.getpid(), "rss_bytes": current_rss(), "rss_max_bytes": max_rss()}
+    metrics["mode"] = PROFILE_MEMORY
+    return metrics
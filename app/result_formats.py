@@ -0,0 +1,212 @@
+# Форматы файлов результата: XLSX (по умолчанию), CSV, Parquet, JSON Lines
+import os
+import zipfile
+
+# Формат -> (расширение, media type для скачивания)
+RESULT_FORMATS = {
+    "xlsx": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": (".csv", "text/csv; charset=utf-8"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+    "jsonl": (".jsonl", "application/x-ndjson"),
+}
+DEFAULT_FORMAT = "xlsx"
+WRITE_CHUNK_ROWS = 50_000  # Строк в одном блоке записи CSV / Parquet / JSON Lines
+
+
+def check_format(output_format: str) -> str:
+    """Проверяет формат результата (None — формат по умолчанию)."""
+    output_format = output_format or DEFAULT_FORMAT
+    if output_format not in RESULT_FORMATS:
+        raise Exception(f"Неизвестный формат результата: {output_format}")
+    if output_format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise Exception("Формат Parquet недоступен: не установлен pyarrow")
+    return output_format
+
+
+def result_filename(source_filename: str, output_format: str) -> str:
+    """Имя файла результата с расширением формата."""
+    return os.path.splitext(source_filename)[0] + RESULT_FORMATS[output_format][0]
+
+
+class ChunkWriter:
+    """Запись результата блоками: каждый блок (DataFrame) дописывается в файл
+    и больше не хранится в памяти. Для XLSX — openpyxl write_only.
+    """
+
+    def __init__(self, path: str, output_format: str, sheet_name: str = "Sheet1", schema=None):
+        self.path = path
+        self.output_format = output_format
+        self.sheet_name = sheet_name
+        self._file = None
+        self._book = None
+        self._sheet = None
+        self._parquet = None
+        self._schema = schema  # Схема Parquet, если типы известны заранее (write_frame)
+        self._header = True
+
+    def write(self, df):
+        if self.output_format == "csv":
+            if self._file is None:
+                self._file = open(self.path, "w", encoding="utf-8", newline="")
+            df.to_csv(self._file, index=False, header=self._header)
+        elif self.output_format == "jsonl":
+            if self._file is None:
+                self._file = open(self.path, "w", encoding="utf-8")
+            if len(df):
+                self._file.write(df.to_json(orient="records", lines=True, force_ascii=False,
+                                            date_format="iso"))
+                self._file.write("\n")
+        elif self.output_format == "parquet":
+            self._write_parquet(df)
+        else:
+            self._write_xlsx(df)
+        self._header = False
+
+    def _write_parquet(self, df):
+        """Блок в Parquet с типами столбцов как есть (целые остаются целыми).
+        Если блок не помещается в схему файла (в целом столбце дробные числа,
+        в числовом — текст), схема расширяется и записанное переписывается."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        arrays = [_arrow_array(df[col], self._schema.field(i).type if self._schema else None)
+                  for i, col in enumerate(df.columns)]
+        schema = pa.schema([pa.field(str(col), arr.type) for col, arr in zip(df.columns, arrays)])
+        if self._schema is None:
+            self._schema = schema
+        elif not schema.equals(self._schema):
+            widened = pa.schema([pa.field(f.name, _widen_type(f.type, g.type))
+                                 for f, g in zip(self._schema, schema)])
+            if not widened.equals(self._schema):
+                self._schema = widened
+                if self._parquet is not None:
+                    self._rewrite_parquet()
+        if self._parquet is None:
+            self._parquet = pq.ParquetWriter(self.path, self._schema)
+        self._parquet.write_table(pa.Table.from_arrays(arrays, names=self._schema.names).cast(self._schema))
+
+    def _rewrite_parquet(self):
+        """Переписывает записанные блоки под расширенную схему (по частям)."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self._parquet.close()
+        old_path = self.path + ".old"
+        os.replace(self.path, old_path)
+        try:
+            self._parquet = pq.ParquetWriter(self.path, self._schema)
+            with pq.ParquetFile(old_path) as source:
+                for batch in source.iter_batches():
+                    self._parquet.write_table(pa.Table.from_batches([batch]).cast(self._schema))
+        finally:
+            os.remove(old_path)
+
+    def _write_xlsx(self, df):
+        if self._book is None:
+            import openpyxl
+            self._book = openpyxl.Workbook(write_only=True)
+            self._sheet = self._book.create_sheet(self.sheet_name)
+        if self._header:
+            self._sheet.append([str(c) for c in df.columns])
+        for row in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None):
+            self._sheet.append(row)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._parquet is not None:
+            self._parquet.close()
+        if self._book is not None:
+            self._book.save(self.path)
+
+
+def write_frame(df, path: str, output_format: str, sheet_name: str = "Sheet1"):
+    """Записывает DataFrame в файл результата.
+    CSV / Parquet / JSON Lines пишутся блоками по WRITE_CHUNK_ROWS строк;
+    схема Parquet берётся по всему DataFrame, поэтому блоки её не меняют.
+    """
+    if output_format == "xlsx":
+        df.to_excel(path, index=False, sheet_name=sheet_name)
+        return
+    schema = _frame_schema(df) if output_format == "parquet" else None
+    writer = ChunkWriter(path, output_format, sheet_name, schema)
+    try:
+        if not len(df):
+            writer.write(df)
+        for start in range(0, len(df), WRITE_CHUNK_ROWS):
+            writer.write(df.iloc[start:start + WRITE_CHUNK_ROWS])
+    finally:
+        writer.close()
+
+
+def write_frames(frames: dict, path: str, output_format: str):
+    """Записывает несколько листов: XLSX — книга с листами, остальные
+    форматы — ZIP с файлом на каждый лист.
+    """
+    if output_format == "xlsx":
+        import pandas as pd
+        with pd.ExcelWriter(path) as writer:
+            for name, df in frames.items():
+                df.to_excel(writer, sheet_name=name, index=False)
+        return
+    ext = RESULT_FORMATS[output_format][0]
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, df in frames.items():
+            sheet_path = f"{path}.{len(z.namelist())}{ext}"
+            try:
+                write_frame(df, sheet_path, output_format)
+                z.write(sheet_path, _safe_name(name) + ext)
+            finally:
+                if os.path.exists(sheet_path):
+                    os.remove(sheet_path)
+
+
+def _arrow_array(col, arrow_type=None):
+    """Столбец как массив Arrow: в типе схемы, если значения в него
+    помещаются, иначе в своём. Столбец со значениями разных типов (строки
+    и даты, числа и текст) — как строки."""
+    import pyarrow as pa
+    errors = (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError)
+    for candidate in ((arrow_type, None) if arrow_type is not None else (None,)):
+        try:
+            return pa.array(col, type=candidate, from_pandas=True)
+        except errors:
+            pass
+    return pa.array(col.astype("string"), type=pa.large_string(), from_pandas=True)
+
+
+def _frame_schema(df):
+    """Схема Parquet по всему DataFrame (пустые столбцы — строки)."""
+    import pyarrow as pa
+    fields = []
+    for col in df.columns:
+        arrow_type = _arrow_array(df[col]).type
+        fields.append(pa.field(str(col), pa.large_string() if pa.types.is_null(arrow_type) else arrow_type))
+    return pa.schema(fields)
+
+
+# Точность меток времени Arrow по возрастанию
+_TIME_UNITS = ("s", "ms", "us", "ns")
+
+
+def _widen_type(old, new):
+    """Тип столбца, в который помещаются значения обоих типов."""
+    import pyarrow as pa
+    if old.equals(new) or pa.types.is_null(new):
+        return old
+    if pa.types.is_null(old):
+        return new
+    if pa.types.is_integer(old) and pa.types.is_integer(new):
+        return pa.int64()
+    if (pa.types.is_integer(old) or pa.types.is_floating(old)) and \
+            (pa.types.is_integer(new) or pa.types.is_floating(new)):
+        return pa.float64()
+    if pa.types.is_timestamp(old) and pa.types.is_timestamp(new) and old.tz == new.tz:
+        return pa.timestamp(max(old.unit, new.unit, key=_TIME_UNITS.index), old.tz)
+    return pa.large_string()
+
+
+def _safe_name(name: str) -> str:
+    """Имя листа как имя файла в архиве."""
+    return "".join("_" if ch in '\\/:*?"<>|' else ch for ch in name) or "sheet"
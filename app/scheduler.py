@@ -0,0 +1,112 @@
+# Допуск пакетов к обработке по оценке памяти: общий бюджет на все worker-процессы
+import json
+import os
+import time
+
+from .excel_logic import (
+    MEMORY_PER_CELL,
+    STREAM_CHUNK_ROWS,
+    sheet_scan,
+)
+from .shared_store import SHARED_DIR, atomic_write, locked, pid_alive
+
+MEMORY_BUDGET = int(os.environ.get("EXCEL_MEMORY_BUDGET_MB", "2048")) << 20  # Бюджет на все пакеты
+JOBS_FILE = os.path.join(SHARED_DIR, "jobs.json")  # Очередь и допущенные пакеты
+ADMISSION_POLL = 0.5  # Период проверки очереди ожидающим пакетом, секунд
+FRAME_OVERHEAD = 2  # Пик при обработке листа: прочитанный лист + столбцы результата и запись
+UNSCANNED_RATIO = 20  # Память на байт файла, если книгу не удалось оценить
+
+
+def _read_jobs() -> list:
+    try:
+        with open(JOBS_FILE, encoding="utf-8") as f:
+            jobs = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+    # Пакеты завершившихся (упавших) процессов не держат бюджет
+    return [j for j in jobs if pid_alive(j["pid"])]
+
+
+def _write_jobs(jobs: list):
+    atomic_write(JOBS_FILE, json.dumps(jobs).encode("utf-8"))
+
+
+def _sheet_memory(path: str, engine, sheet: str, streaming) -> int:
+    scan = sheet_scan(path, engine, sheet)
+    if scan is None:
+        return os.path.getsize(path) * UNSCANNED_RATIO
+    if streaming or (streaming is None and scan["strategy"] == "streaming"):
+        # Потоково в памяти только блок строк
+        return min(scan["rows"], STREAM_CHUNK_ROWS) * scan["cols"] * MEMORY_PER_CELL * FRAME_OVERHEAD
+    return scan["memory_bytes"] * FRAME_OVERHEAD
+
+
+def estimate_job_memory(base: dict, base_sheet: str, files: list) -> int:
+    """Оценка пиковой памяти пакета по prescan книг.
+
+    files — [(file_info, file_config)] файлов, которые действительно будут
+    обрабатываться. Файлы идут по очереди, поэтому пик — лист базы (с
+    листом "Возврат") плюс самый тяжёлый файл пакета.
+    """
+    from .excel_logic import RETURN_SHEET
+    if not files:
+        return 0
+    base_bytes = sum(_sheet_memory(base["path"], base["engine"], sheet, False)
+                     for sheet in (base_sheet, RETURN_SHEET) if sheet in base["sheets"])
+    peak = 0
+    for file_info, file_config in files:
+        if file_config.get("all_sheets"):
+            sheets = file_info["sheets"]
+        else:
+            sheets = file_config.get("sheets") or [file_config.get("sheet")]
+        if len(sheets) > 1:
+            # Несколько листов читаются в память вместе
+            size = sum(_sheet_memory(file_info["path"], file_info["engine"], s, False) for s in sheets)
+        else:
+            size = _sheet_memory(file_info["path"], file_info["engine"], sheets[0], file_config.get("streaming"))
+        peak = max(peak, size)
+    return base_bytes + peak
+
+
+def try_admit(job_id: str, memory_bytes: int) -> bool:
+    """Ставит пакет в очередь (если его там нет) и допускает его, когда он
+    первый среди ожидающих и помещается в бюджет вместе с уже допущенными.
+    Пакет больше всего бюджета допускается, только когда других нет.
+    """
+    with locked(exclusive=True):
+        jobs = _read_jobs()
+        job = next((j for j in jobs if j["job_id"] == job_id), None)
+        if job is None:
+            job = {"job_id": job_id, "pid": os.getpid(), "memory_bytes": memory_bytes,
+                   "admitted": False, "queued_at": time.time()}
+            jobs.append(job)
+        if not job["admitted"]:
+            waiting = [j for j in jobs if not j["admitted"]]
+            used = sum(j["memory_bytes"] for j in jobs if j["admitted"])
+            if waiting[0] is job and (used == 0 or used + memory_bytes <= MEMORY_BUDGET):
+                job["admitted"] = True
+        _write_jobs(jobs)
+        return job["admitted"]
+
+
+def release(job_id: str):
+    """Убирает пакет из очереди или освобождает его бюджет."""
+    with locked(exclusive=True):
+        _write_jobs([j for j in _read_jobs() if j["job_id"] != job_id])
+
+
+def queue_status(job_id: str) -> dict:
+    """Состояние пакета: position — место среди ожидающих (0 — допущен),
+    None — пакета нет в очереди (завершён или ещё не поставлен)."""
+    with locked(exclusive=False):
+        jobs = _read_jobs()
+    waiting = [j["job_id"] for j in jobs if not j["admitted"]]
+    job = next((j for j in jobs if j["job_id"] == job_id), None)
+    return {
+        "job_id": job_id,
+        "position": None if job is None else (0 if job["admitted"] else waiting.index(job_id) + 1),
+        "waiting": len(waiting),
+        "memory_bytes": job["memory_bytes"] if job else None,
+        "used_bytes": sum(j["memory_bytes"] for j in jobs if j["admitted"]),
+        "budget_bytes": MEMORY_BUDGET,
+    }
@@ -0,0 +1,344 @@
+# Общее хранилище для нескольких worker-процессов: файлы, состояние сессии, кеши
+import contextlib
+import copy
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировок нет, поддерживается только один worker
+    fcntl = None
+
+
+# По умолчанию — своя папка пользователя во временном каталоге (см. _secure_shared_dir)
+SHARED_DIR = os.environ.get("EXCEL_SHARED_DIR") or os.path.join(
+    tempfile.gettempdir(), "excel-equipment-shared" + (f"-{os.getuid()}" if hasattr(os, "getuid") else ""))
+UPLOAD_DIR = os.path.join(SHARED_DIR, "uploads")  # Загруженные файлы
+RESULT_DIR = os.path.join(SHARED_DIR, "results")  # Архивы для скачивания
+CACHE_DIR = os.path.join(SHARED_DIR, "cache")  # Разобранные листы, индексы базы, изменения базы
+RESULT_CACHE_DIR = os.path.join(CACHE_DIR, "results")  # Готовые результаты обработки
+RESULT_CACHE_BYTES = int(os.environ.get("EXCEL_RESULT_CACHE_MB", "1024")) << 20  # Предел кеша результатов
+CACHE_BYTES = int(os.environ.get("EXCEL_CACHE_MB", "4096")) << 20  # Предел кеша листов и индексов базы
+DELTA_SUFFIX = ".delta"  # Изменения базы в кеше: нужны, пока они в журнале сессии, и не вытесняются
+CANCEL_DIR = os.path.join(SHARED_DIR, "cancel")  # Отметки отменённых пакетов
+SESSION_FILE = os.path.join(SHARED_DIR, "session.json")
+LOCK_FILE = os.path.join(SHARED_DIR, "session.lock")
+
+EMPTY_SESSION = {
+    "base_file": None,  # База данных {path, engine, filename, sheets}
+    "process_files": [],  # Массив файлов для обработки
+    "results": [],  # Массив результатов {filename, path}
+    "summary": None,  # Сводная книга последнего пакета
+    "base_config": None,  # Последние настройки базы [лист, серийник, дата, политика]
+    "base_deltas": [],  # Пути к файлам изменений базы (pickle), в порядке применения
+    "top_file": None,  # Файл "Оборудование у ТОПа"
+}
+
+
+def _secure_shared_dir():
+    """Создаёт общую папку с правами 0700 и проверяет, что она своя.
+
+    Кеш в ней — pickle, который загружается без проверки, поэтому папку,
+    созданную (или подменённую ссылкой) другим пользователем, не используем,
+    а открытую для других — закрываем.
+    """
+    os.makedirs(SHARED_DIR, mode=0o700, exist_ok=True)
+    if not hasattr(os, "getuid"):
+        return  # Windows: владельца и прав POSIX нет
+    uid = os.getuid()
+    if os.lstat(SHARED_DIR).st_uid != uid or os.stat(SHARED_DIR).st_uid != uid:
+        raise Exception(f"Общая папка {SHARED_DIR} принадлежит другому пользователю; "
+                        f"укажите свою папку в EXCEL_SHARED_DIR")
+    if os.stat(SHARED_DIR).st_mode & 0o077:
+        os.chmod(SHARED_DIR, 0o700)
+
+
+_secure_shared_dir()
+
+
+def _ensure_dirs():
+    for path in (UPLOAD_DIR, RESULT_DIR, CACHE_DIR, CANCEL_DIR):
+        os.makedirs(path, exist_ok=True)
+
+
+def atomic_write(path: str, data: bytes):
+    """Запись через временный файл + rename: читатели не видят половину файла."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def pid_alive(pid: int) -> bool:
+    """Жив ли процесс pid (другой worker того же сервера)."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextlib.contextmanager
+def locked(exclusive: bool):
+    """Блокировка общего хранилища между процессами (общая или исключительная)."""
+    _ensure_dirs()
+    with open(LOCK_FILE, "a") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_session() -> dict:
+    state = copy.deepcopy(EMPTY_SESSION)
+    try:
+        with open(SESSION_FILE, encoding="utf-8") as f:
+            state.update(json.load(f))
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    return state
+
+
+def load_session() -> dict:
+    """Снимок состояния сессии (общего для всех worker-процессов)."""
+    with locked(exclusive=False):
+        return _read_session()
+
+
+@contextlib.contextmanager
+def update_session():
+    """Изменение состояния сессии под эксклюзивной блокировкой:
+
+        with update_session() as state:
+            state["results"] = results
+    """
+    with locked(exclusive=True):
+        state = _read_session()
+        yield state
+        atomic_write(SESSION_FILE, json.dumps(state, ensure_ascii=False).encode("utf-8"))
+
+
+def _cancel_marker(job_id: str) -> str:
+    return os.path.join(CANCEL_DIR, hashlib.sha1(job_id.encode("utf-8")).hexdigest())
+
+
+def request_cancel(job_id: str):
+    """Отмечает пакет как отменённый (видно всем worker-процессам)."""
+    _ensure_dirs()
+    with open(_cancel_marker(job_id), "w"):
+        pass
+
+
+def is_cancelled(job_id: str) -> bool:
+    return os.path.exists(_cancel_marker(job_id))
+
+
+def clear_cancel(job_id: str):
+    try:
+        os.remove(_cancel_marker(job_id))
+    except FileNotFoundError:
+        pass
+
+
+_digests: dict = {}  # (путь, размер, mtime) -> sha1 содержимого
+
+
+def file_digest(path: str) -> str:
+    """SHA-1 содержимого файла (для ключей кеша), считается один раз на версию файла."""
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    if key not in _digests:
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+
+def cache_path(*parts, suffix: str = ".pkl") -> str:
+    """Путь в общем кеше по набору частей ключа."""
+    key = hashlib.sha1("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, key + suffix)
+
+
+def load_cached(path: str):
+    """Объект из общего кеша или None, если его нет (или запись повреждена)."""
+    try:
+        with open(path, "rb") as f:
+            obj = pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+    with contextlib.suppress(OSError):
+        os.utime(path)  # Отметка использования для вытеснения
+    return obj
+
+
+def store_cached(path: str, obj):
+    """Сохраняет объект в общий кеш; старые записи вытесняются, пока кеш
+    больше CACHE_BYTES (см. evict_cache)."""
+    _ensure_dirs()
+    atomic_write(path, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+    evict_cache(keep=path)
+
+
+def evict_cache(keep: str = None):
+    """Удаляет давно не использованные записи общего кеша (листы, столбцы,
+    предпросмотр, снимки индекса базы) сверх CACHE_BYTES.
+
+    Изменения базы (DELTA_SUFFIX) и кеш результатов (свой предел) не
+    трогаются; keep — только что записанная запись, она остаётся. Снимок
+    индекса — папка, время использования — у её meta.json.
+    """
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        if path == RESULT_CACHE_DIR or name.endswith((".tmp", DELTA_SUFFIX)):
+            continue
+        try:
+            if os.path.isdir(path):
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                used = os.path.getmtime(os.path.join(path, "meta.json"))
+            else:
+                size, used = os.path.getsize(path), os.path.getmtime(path)
+        except OSError:
+            continue
+        entries.append((used, size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CACHE_BYTES:
+            break
+        if path == keep:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        total -= size
+
+
+def read_sheet_cached(path: str, engine, sheet: str, columns: list = None):
+    """Лист книги через общий дисковый кеш: файл разбирается один раз на все процессы.
+    columns — читать только эти столбцы (excel_logic.read_sheet_columns).
+    """
+    from .excel_logic import _read_sheet_safe, read_sheet_columns
+    cached_file = cache_path("sheet", file_digest(path), sheet, *(columns or []))
+    df = load_cached(cached_file)
+    if df is None:
+        if columns:
+            df = read_sheet_columns(path, engine, sheet, columns)
+        else:
+            df = _read_sheet_safe(path, engine, sheet)
+        store_cached(cached_file, df)
+    return df
+
+
+def result_cache_key(*parts) -> str:
+    """Ключ кеша результата: хеши файлов и настройки обработки (словари — в порядке ключей)."""
+    text = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def has_cached_result(key: str) -> bool:
+    return os.path.exists(os.path.join(RESULT_CACHE_DIR, key + ".json"))
+
+
+def _restore_artifact(artifact: str, suffix: str) -> str:
+    _ensure_dirs()
+    out_path = os.path.join(RESULT_DIR, f"result_{os.urandom(8).hex()}{suffix}")
+    try:
+        os.link(artifact, out_path)  # Без копирования, если та же файловая система
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(artifact, out_path)
+    return out_path
+
+
+def discard_results(results: list, summary: str = None):
+    """Удаляет файлы прежних результатов сессии (state["results"] и сводку)."""
+    for path in [r["path"] for r in results or []] + [summary]:
+        if path:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+
+def load_cached_result(key: str):
+    """Сохранённый результат: (путь к копии в RESULT_DIR, статистика) или None.
+    Сохранённая детализация для сводки возвращается в stats["detail_path"]."""
+    meta_path = os.path.join(RESULT_CACHE_DIR, key + ".json")
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        out_path = _restore_artifact(os.path.join(RESULT_CACHE_DIR, key + meta["suffix"]), meta["suffix"])
+        stats = meta["stats"]
+        if meta.get("detail"):
+            stats["detail_path"] = _restore_artifact(os.path.join(RESULT_CACHE_DIR, key + ".detail"), ".detail")
+        os.utime(meta_path)  # Отметка использования для вытеснения
+    except (FileNotFoundError, KeyError, json.JSONDecodeError):
+        return None
+    return out_path, stats
+
+
+def store_cached_result(key: str, path: str, stats: dict):
+    """Сохраняет результат обработки и его статистику (с детализацией для
+    сводки из stats["detail_path"]); старые записи вытесняются, пока кеш
+    больше RESULT_CACHE_BYTES.
+    """
+    os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+    suffix = os.path.splitext(path)[1]
+    stats = dict(stats)
+    detail_path = stats.pop("detail_path", None)
+    size = os.path.getsize(path) + (os.path.getsize(detail_path) if detail_path else 0)
+    if size > RESULT_CACHE_BYTES:
+        return
+    for src, ext in ((path, suffix), (detail_path, ".detail")):
+        if src is None:
+            continue
+        fd, tmp = tempfile.mkstemp(dir=RESULT_CACHE_DIR, suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, os.path.join(RESULT_CACHE_DIR, key + ext))
+    # Метаданные пишутся последними: запись без них считается отсутствующей
+    meta = {"suffix": suffix, "stats": stats, "detail": detail_path is not None}
+    atomic_write(os.path.join(RESULT_CACHE_DIR, key + ".json"),
+                  json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+    _evict_results()
+
+
+def _evict_results():
+    """Удаляет давно не использованные результаты сверх RESULT_CACHE_BYTES."""
+    entries = {}
+    for name in os.listdir(RESULT_CACHE_DIR):
+        key, ext = os.path.splitext(name)
+        if ext == ".tmp":
+            continue
+        try:
+            st = os.stat(os.path.join(RESULT_CACHE_DIR, name))
+        except FileNotFoundError:
+            continue
+        entry = entries.setdefault(key, {"size": 0, "used": 0.0, "files": []})
+        entry["size"] += st.st_size
+        entry["files"].append(name)
+        if ext == ".json":
+            entry["used"] = st.st_mtime
+    total = sum(e["size"] for e in entries.values())
+    for key, entry in sorted(entries.items(), key=lambda kv: kv[1]["used"]):
+        if total <= RESULT_CACHE_BYTES:
+            break
+        for name in entry["files"]:
+            try:
+                os.remove(os.path.join(RESULT_CACHE_DIR, name))
+            except FileNotFoundError:
+                pass
+        total -= entry["size"]
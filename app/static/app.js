@@ -0,0 +1,770 @@
+const $ = id => document.getElementById(id);
+const API = '';
+
+// State
+let baseFile = null;
+let processFiles = [];
+let fileCounter = 0;
+let columnsBatch = null;  // Столбцы всех листов всех файлов (/columns_batch)
+
+// --- Step 1: Управление файлами ---
+$('baseFile').onchange = e => {
+  baseFile = e.target.files[0];
+  $('baseName').textContent = baseFile?.name || '';
+  checkUploadReady();
+};
+
+$('btnAddFile').onclick = () => addProcessFileInput();
+
+function addProcessFileInput() {
+  fileCounter++;
+  const id = fileCounter;
+  const div = document.createElement('div');
+  div.className = 'file-item';
+  div.id = `fileItem${id}`;
+  div.innerHTML = `
+    <div class="file-item-header">
+      <span class="file-num">Файл #${id}</span>
+      <button class="btn-remove" onclick="removeFile(${id})">✕ Удалить</button>
+    </div>
+    <input type="file" id="processFile${id}" accept=".xlsx,.xlsb">
+    <div class="file-name" id="fileName${id}"></div>
+  `;
+  $('processFilesList').appendChild(div);
+  
+  $(`processFile${id}`).onchange = e => {
+    const file = e.target.files[0];
+    $(`fileName${id}`).textContent = file?.name || '';
+    processFiles[id] = file;
+    checkUploadReady();
+  };
+}
+
+function removeFile(id) {
+  $(`fileItem${id}`).remove();
+  delete processFiles[id];
+  checkUploadReady();
+}
+
+function checkUploadReady() {
+  const hasBase = !!baseFile;
+  const hasProcess = Object.values(processFiles).some(f => f);
+  $('btnUpload').disabled = !(hasBase && hasProcess);
+}
+
+// Добавляем первый файл по умолчанию
+addProcessFileInput();
+
+$('btnUpload').onclick = async () => {
+  $('btnUpload').disabled = true;
+  showStatus('uploadStatus', 'info', '<span class="spinner"></span> Загрузка файлов...');
+  
+  const fd = new FormData();
+  fd.append('base_file', baseFile);
+  
+  const uploadIds = [];  // Позиция файла в запросе -> id поля на странице
+  Object.entries(processFiles).forEach(([id, file]) => {
+    if (file) {
+      fd.append('process_files', file);
+      uploadIds.push(id);
+    }
+  });
+  
+  try {
+    const r = await fetch(API + '/upload_multiple?stream=true', { method: 'POST', body: fd });
+    if (!r.ok) {
+      const err = await r.json();
+      throw new Error(err.detail || 'Ошибка загрузки');
+    }
+    
+    // Ответ NDJSON: статус каждого файла по мере готовности, последним — итог
+    let d = null;
+    const errors = [];
+    await readNdjson(r, ev => {
+      if (ev.event === 'file' || ev.event === 'error') {
+        const id = ev.position === null ? null : uploadIds[ev.position];
+        const target = id === null ? $('baseName') : $(`fileName${id}`);
+        target.textContent = ev.event === 'file'
+          ? `${ev.filename} — ✓ листов: ${ev.sheets.length}`
+          : `${ev.filename} — ✗ ${ev.detail}`;
+        if (ev.event === 'error') errors.push(ev.detail);
+      } else if (ev.event === 'done') {
+        d = ev;
+      }
+    });
+    if (!d) throw new Error(errors[errors.length - 1] || 'Ошибка загрузки');
+    
+    showStatus('uploadStatus', errors.length ? 'info' : 'ok',
+      `✓ Загружено: база данных + ${d.files_count} файлов` +
+      (errors.length ? ` (не прочитано: ${errors.length})` : ''));
+    
+    // Столбцы всех листов — одним запросом, дальше выбор листа не ходит на сервер
+    try {
+      const rc = await fetch(API + '/columns_batch');
+      columnsBatch = rc.ok ? await rc.json() : null;
+    } catch(e) {
+      columnsBatch = null;
+    }
+    
+    // Заполняем настройки базы
+    fillSelect('baseSheet', d.base_sheets);
+    
+    // Создаем конфигурацию для каждого файла
+    d.process_files_info.forEach((info, idx) => {
+      createFileConfig(idx, info);
+    });
+    
+    $('step2').classList.remove('hidden');
+    $('baseSheet').dispatchEvent(new Event('change'));
+  } catch(e) {
+    showStatus('uploadStatus', 'err', '✗ ' + e.message);
+    $('btnUpload').disabled = false;
+  }
+};
+
+// --- Step 2: Настройка ---
+$('baseSheet').onchange = async () => {
+  const sheet = $('baseSheet').value;
+  if (!sheet) return;
+  loadPreview('previewBase', `file_type=base&sheet=${encodeURIComponent(sheet)}`);
+  const d = await getColumns(columnsBatch?.base, `file_type=base&sheet=${encodeURIComponent(sheet)}`, sheet);
+  fillSelect('baseSerial', d.columns);
+  fillSelect('baseDate', d.columns);
+  $('baseSerial').disabled = false;
+  $('baseDate').disabled = false;
+  if (d.detected_serial) {
+    $('baseSerial').value = d.detected_serial;
+    $('hintBaseSerial').textContent = '↑ Автоопределён: ' + d.detected_serial;
+  }
+  if (d.detected_date) {
+    $('baseDate').value = d.detected_date;
+    $('hintBaseDate').textContent = '↑ Автоопределён: ' + d.detected_date;
+  }
+  checkProcessReady();
+};
+
+$('baseSerial').onchange = checkProcessReady;
+$('baseDate').onchange = checkProcessReady;
+
+function createFileConfig(idx, info) {
+  const div = document.createElement('div');
+  div.className = 'file-item';
+  div.innerHTML = `
+    <div class="file-item-header">
+      <span class="file-num">📄 ${info.filename}</span>
+    </div>
+    <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 12px;">
+      <div>
+        <label>Лист</label>
+        <select id="sheet${idx}"></select>
+        <div class="auto-hint" id="hintScan${idx}"></div>
+      </div>
+      <div>
+        <label>Серийный номер</label>
+        <select id="serial${idx}" disabled></select>
+        <div class="auto-hint" id="hintSerial${idx}"></div>
+      </div>
+    </div>
+    <div>
+      <label>Дата отражения проводки (для техрефреша)</label>
+      <select id="date${idx}" disabled>
+        <option value="">— не выбран (пропустить техрефреш) —</option>
+      </select>
+      <div class="auto-hint" id="hintDate${idx}"></div>
+    </div>
+    <div class="checkbox-group">
+      <label class="checkbox-label">
+        <input type="checkbox" id="opCompare${idx}" checked>
+        <span>Сверка с базой данных</span>
+      </label>
+      <label class="checkbox-label">
+        <input type="checkbox" id="opTechRefresh${idx}" checked>
+        <span>Анализ устаревшего оборудования</span>
+      </label>
+      <label class="checkbox-label">
+        <input type="checkbox" id="opStreaming${idx}">
+        <span>Потоковая обработка (для очень больших листов включается сама)</span>
+      </label>
+      ${info.sheets.length > 1 ? `
+        <label class="checkbox-label">
+          <input type="checkbox" id="opMultiSheet${idx}">
+          <span>Несколько листов (столбцы определяются на каждом листе)</span>
+        </label>
+      ` : ''}
+    </div>
+    <div class="preview" id="preview${idx}"></div>
+  `;
+  $('configFilesList').appendChild(div);
+  
+  fillSelect(`sheet${idx}`, info.sheets);
+  
+  $(`sheet${idx}`).onchange = async () => {
+    $(`hintScan${idx}`).textContent = scanHint(info.scan?.sheets?.[$(`sheet${idx}`).value]);
+    if ($(`sheet${idx}`).multiple) return;
+    const sheet = $(`sheet${idx}`).value;
+    if (!sheet) return;
+    loadPreview(`preview${idx}`, `file_type=process&file_idx=${idx}&sheet=${encodeURIComponent(sheet)}`);
+    const d = await getColumns(columnsBatch?.process[idx],
+      `file_type=process&file_idx=${idx}&sheet=${encodeURIComponent(sheet)}`, sheet);
+    
+    fillSelect(`serial${idx}`, d.columns);
+    fillSelect(`date${idx}`, d.columns, true);
+    $(`serial${idx}`).disabled = false;
+    $(`date${idx}`).disabled = false;
+    
+    if (d.detected_serial) {
+      $(`serial${idx}`).value = d.detected_serial;
+      $(`hintSerial${idx}`).textContent = '↑ Автоопределён: ' + d.detected_serial;
+    }
+    if (d.detected_date) {
+      $(`date${idx}`).value = d.detected_date;
+      $(`hintDate${idx}`).textContent = '↑ Автоопределён: ' + d.detected_date;
+    }
+    
+    checkProcessReady();
+  };
+  
+  $(`serial${idx}`).onchange = checkProcessReady;
+  $(`sheet${idx}`).dispatchEvent(new Event('change'));
+  
+  // Режим нескольких листов: выбираем листы списком (по умолчанию — все)
+  if ($(`opMultiSheet${idx}`)) {
+    $(`opMultiSheet${idx}`).onchange = () => {
+      const multi = $(`opMultiSheet${idx}`).checked;
+      const sel = $(`sheet${idx}`);
+      sel.multiple = multi;
+      sel.size = multi ? Math.min(info.sheets.length, 6) : 0;
+      Array.from(sel.options).forEach((o, i) => o.selected = multi || i === 0);
+      $(`date${idx}`).disabled = multi;
+      if (!multi) sel.dispatchEvent(new Event('change'));
+    };
+  }
+}
+
+function checkProcessReady() {
+  const baseReady = $('baseSerial').value && $('baseDate').value;
+  $('btnProcess').disabled = !baseReady;
+}
+
+$('btnProcess').onclick = async () => {
+  $('btnProcess').disabled = true;
+  showStatus('processStatus', 'info', '<span class="spinner"></span> Обработка файлов...');
+  
+  // Собираем конфигурацию
+  const config = {
+    base_sheet: $('baseSheet').value,
+    base_serial: $('baseSerial').value,
+    base_date: $('baseDate').value,
+    duplicate_policy: $('basePolicy').value,
+    stock_check: $('stockCheck').value,
+    output_format: $('outputFormat').value,
+    summary_detail: $('summaryDetail').checked,
+    job_id: crypto.randomUUID ? crypto.randomUUID() : String(Date.now()) + Math.random(),
+    files_config: []
+  };
+  $('btnCancel').onclick = () => {
+    $('btnCancel').disabled = true;
+    fetch(API + '/cancel?job_id=' + encodeURIComponent(config.job_id), { method: 'POST' });
+  };
+  $('btnCancel').disabled = false;
+  $('btnCancel').classList.remove('hidden');
+  
+  // Пока пакет ждёт допуска по памяти — показываем место в очереди
+  let finished = false;
+  const queueTimer = setInterval(async () => {
+    try {
+      const q = await (await fetch(API + '/queue?job_id=' + encodeURIComponent(config.job_id))).json();
+      if (!finished) showStatus('processStatus', 'info', '<span class="spinner"></span> ' + (q.position > 0
+        ? `В очереди: ${q.position}-й (ждёт освобождения памяти)` : 'Обработка файлов...'));
+    } catch(e) {}
+  }, 1000);
+  
+  const fileConfigs = document.querySelectorAll('#configFilesList .file-item');
+  fileConfigs.forEach((item, idx) => {
+    const sheets = Array.from($(`sheet${idx}`).selectedOptions).map(o => o.value);
+    const multi = $(`sheet${idx}`).multiple;
+    config.files_config.push({
+      sheet: $(`sheet${idx}`).value,
+      sheets: multi ? sheets : null,
+      all_sheets: multi && sheets.length === $(`sheet${idx}`).options.length,
+      serial_col: $(`serial${idx}`).value,
+      date_col: $(`date${idx}`).value || null,
+      compare: $(`opCompare${idx}`).checked,
+      tech_refresh: $(`opTechRefresh${idx}`).checked,
+      streaming: $(`opStreaming${idx}`).checked || null
+    });
+  });
+  
+  try {
+    const r = await fetch(API + '/process_multiple', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(config)
+    });
+    const d = await r.json();
+    finished = true;
+    if (!r.ok) throw new Error(d.detail || 'Ошибка обработки');
+    
+    const done = d.results.filter(res => !res.failed).length;
+    const failed = d.results.length - done;
+    showStatus('processStatus', d.cancelled || failed ? 'info' : 'ok',
+      `✓ Обработано файлов: ${done}` + (failed ? `, с ошибкой: ${failed}` : '') +
+      (d.cancelled ? ' (обработка отменена)' : ''));
+    
+    // Отображаем результаты
+    d.results.forEach((res, idx) => {
+      createResultItem(idx, res);
+    });
+    
+    $('downloadAllLink').href = API + '/download_all';
+    if (d.summary) {
+      $('downloadSummaryLink').href = API + '/download_summary';
+      $('downloadSummaryLink').classList.remove('hidden');
+    }
+    $('step3').classList.remove('hidden');
+  } catch(e) {
+    showStatus('processStatus', 'err', '✗ ' + e.message);
+    $('btnProcess').disabled = false;
+  } finally {
+    finished = true;
+    clearInterval(queueTimer);
+    $('btnCancel').classList.add('hidden');
+  }
+};
+
+// --- Step 3: Результаты ---
+function createResultItem(idx, result) {
+  const div = document.createElement('div');
+  div.className = 'result-item';
+  if (result.failed) {
+    div.innerHTML = `
+      <h3 style="font-size: 1rem; margin-bottom: 8px; color: #333;">${result.source_filename}</h3>
+      <div class="status status-err">✗ ${result.error}</div>
+    `;
+    $('resultsList').appendChild(div);
+    return;
+  }
+  div.innerHTML = `
+    <h3 style="font-size: 1rem; margin-bottom: 8px; color: #333;">
+      ${result.source_filename}
+    </h3>
+    <div class="result-stats">
+      <div class="stat">
+        <span class="stat-label">Строк:</span>
+        <span class="stat-value">${result.total_rows}</span>
+      </div>
+      ${result.matched !== null ? `
+        <div class="stat">
+          <span class="stat-label">На складе:</span>
+          <span class="stat-value">${result.matched}</span>
+        </div>
+      ` : ''}
+      ${result.outdated !== null ? `
+        <div class="stat">
+          <span class="stat-label">Устарело:</span>
+          <span class="stat-value">${result.outdated}</span>
+        </div>
+      ` : ''}
+      ${result.duplicate_serials ? `
+        <div class="stat">
+          <span class="stat-label">Дубликатов в базе:</span>
+          <span class="stat-value">${result.duplicate_serials}</span>
+        </div>
+      ` : ''}
+    </div>
+    ${result.sheets ? `
+      <div class="file-name">
+        ${result.sheets.map(s => `${s.sheet}: ${s.error ? s.error : `строк ${s.total_rows}` +
+          (s.matched !== null ? `, на складе ${s.matched}` : '') +
+          (s.outdated !== null ? `, устарело ${s.outdated}` : '')}`).join('<br>')}
+      </div>
+    ` : ''}
+    <a href="${API}/download_single?idx=${idx}" style="text-decoration: none;">
+      <button class="btn-primary" style="padding: 8px 20px; font-size: 0.9rem; margin-top: 8px;">
+        📥 Скачать ${result.result_filename}
+      </button>
+    </a>
+  `;
+  $('resultsList').appendChild(div);
+}
+
+// --- Helpers ---
+// Оценка размера листа из предварительного анализа книги (ответ загрузки)
+function scanHint(sheet) {
+  if (!sheet) return '';
+  const mb = Math.max(1, Math.round(sheet.memory_bytes / 1048576));
+  return `${sheet.estimated ? '≈ ' : ''}${sheet.rows.toLocaleString('ru-RU')} строк × ${sheet.cols} столбцов, ` +
+    `~${mb} МБ в памяти` + (sheet.strategy === 'streaming' ? ', будет обработан потоково' : '');
+}
+
+function showStatus(id, type, html) {
+  const el = $(id);
+  el.className = 'status status-' + type;
+  el.innerHTML = html;
+  el.classList.remove('hidden');
+}
+
+// Построчное чтение ответа NDJSON: onEvent вызывается для каждой строки
+async function readNdjson(response, onEvent) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  for (;;) {
+    const { done, value } = await reader.read();
+    buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+    const lines = buffer.split('\n');
+    buffer = lines.pop();
+    lines.filter(line => line.trim()).forEach(line => onEvent(JSON.parse(line)));
+    if (done) break;
+  }
+  if (buffer.trim()) onEvent(JSON.parse(buffer));
+}
+
+// Столбцы листа: из общего ответа /columns_batch, иначе отдельным запросом
+async function getColumns(batch, query, sheet) {
+  const cached = batch?.[sheet];
+  if (cached && !cached.error) return cached;
+  const r = await fetch(API + `/columns?${query}`);
+  return r.json();
+}
+
+// Предпросмотр листа: заголовок и первые строки
+async function loadPreview(id, query) {
+  const box = $(id);
+  box.textContent = '';
+  try {
+    const r = await fetch(API + `/preview?${query}&rows=5`);
+    const d = await r.json();
+    if (!r.ok) throw new Error(d.detail || 'Ошибка предпросмотра');
+    const table = document.createElement('table');
+    table.className = 'preview-table';
+    [d.columns, ...d.rows].forEach((row, i) => {
+      const tr = table.insertRow();
+      row.forEach(value => {
+        const cell = document.createElement(i === 0 ? 'th' : 'td');
+        cell.textContent = value ?? '';
+        tr.appendChild(cell);
+      });
+    });
+    box.appendChild(table);
+  } catch(e) {
+    box.textContent = '✗ ' + e.message;
+  }
+}
+
+function fillSelect(id, items, addEmpty) {
+  const sel = $(id);
+  sel.innerHTML = '';
+  if (addEmpty) {
+    const o = document.createElement('option');
+    o.value = '';
+    o.textContent = '— не выбран (пропустить техрефреш) —';
+    sel.appendChild(o);
+  }
+  items.forEach(item => {
+    const o = document.createElement('option');
+    o.value = item;
+    o.textContent = item;
+    sel.appendChild(o);
+  });
+}
+
+// Делаем функцию removeFile глобальной
+window.removeFile = removeFile;
+
+// ─── Переключение табов ───
+function switchTab(tabName) {
+  // Скрыть все вкладки
+  document.querySelectorAll('.tab-content').forEach(t => t.classList.remove('active'));
+  document.querySelectorAll('.tab').forEach(t => t.classList.remove('active'));
+  
+  // Показать выбранную вкладку
+  if (tabName === 'processing') {
+    $('tabProcessing').classList.add('active');
+    event.target.classList.add('active');
+  } else if (tabName === 'warehouse') {
+    $('tabWarehouse').classList.add('active');
+    event.target.classList.add('active');
+  } else if (tabName === 'top') {
+    $('tabTop').classList.add('active');
+    event.target.classList.add('active');
+  }
+}
+
+window.switchTab = switchTab;
+
+// ─── Склад: Управление файлом ───
+let warehouseFileSelected = null;
+
+$('warehouseFile').onchange = async e => {
+  warehouseFileSelected = e.target.files[0];
+  if (!warehouseFileSelected) {
+    $('warehouseFileName').textContent = '';
+    return;
+  }
+  
+  $('warehouseFileName').textContent = warehouseFileSelected.name;
+  showStatus('warehouseStatus', 'info', '<span class="spinner"></span> Загрузка базы данных...');
+  
+  try {
+    const formData = new FormData();
+    formData.append('file', warehouseFileSelected);
+    
+    const r = await fetch(API + '/warehouse/upload', {
+      method: 'POST',
+      body: formData
+    });
+    
+    if (!r.ok) {
+      const errText = await r.text();
+      throw new Error(errText);
+    }
+    
+    showStatus('warehouseStatus', 'ok', '✓ База данных загружена');
+    
+    // Загружаем данные для фильтров
+    await loadWarehouseData();
+    
+    // Показываем фильтры
+    $('warehouseFiltersSection').classList.remove('hidden');
+    
+    setTimeout(() => $('warehouseStatus').classList.add('hidden'), 2000);
+    
+  } catch (e) {
+    showStatus('warehouseStatus', 'err', '❌ Ошибка загрузки: ' + e.message);
+  }
+};
+
+// ─── Склад: Загрузка данных ───
+async function loadWarehouseData() {
+  try {
+    // Загружаем типы оборудования
+    const r = await fetch(API + '/warehouse/types');
+    if (!r.ok) {
+      const errText = await r.text();
+      throw new Error(errText);
+    }
+    const data = await r.json();
+    
+    fillSelect('warehouseType', data.types);
+    $('warehouseType').disabled = false;
+    $('btnSearchWarehouse').disabled = false;
+    
+    // Устанавливаем обработчики
+    $('warehouseType').onchange = async () => {
+      const type = $('warehouseType').value;
+      if (!type) {
+        $('warehouseModel').disabled = true;
+        fillSelect('warehouseModel', []);
+        return;
+      }
+      
+      // Загружаем модели для выбранного типа
+      const r = await fetch(API + `/warehouse/models?type=${encodeURIComponent(type)}`);
+      const d = await r.json();
+      fillSelect('warehouseModel', d.models);
+      $('warehouseModel').disabled = false;
+    };
+    
+    $('btnSearchWarehouse').onclick = searchWarehouse;
+    
+  } catch (e) {
+    showStatus('warehouseStatus', 'err', '❌ Ошибка загрузки данных склада: ' + e.message);
+  }
+}
+
+// ─── Склад: Поиск ───
+async function searchWarehouse() {
+  const type = $('warehouseType').value;
+  if (!type) {
+    showStatus('warehouseStatus', 'err', '❌ Выберите тип оборудования');
+    return;
+  }
+  
+  showStatus('warehouseStatus', 'info', '<span class="spinner"></span> Поиск...');
+  
+  try {
+    const model = $('warehouseModel').value;
+    let url = API + `/warehouse/search?type=${encodeURIComponent(type)}`;
+    if (model) url += `&model=${encodeURIComponent(model)}`;
+    
+    const r = await fetch(url);
+    if (!r.ok) throw new Error(await r.text());
+    const data = await r.json();
+    
+    displayWarehouseResults(data.items, data.total);
+    $('warehouseStatus').classList.add('hidden');
+    
+  } catch (e) {
+    showStatus('warehouseStatus', 'err', '❌ Ошибка поиска: ' + e.message);
+  }
+}
+
+// ─── Склад: Отображение результатов ───
+function displayWarehouseResults(items, total) {
+  const container = $('warehouseResults');
+  
+  if (items.length === 0) {
+    container.innerHTML = '<div class="warehouse-empty">🔍 Оборудование не найдено</div>';
+    return;
+  }
+  
+  let html = `<div class="warehouse-count">📦 Найдено: ${total} шт.</div>`;
+  html += '<table class="warehouse-table">';
+  html += '<thead><tr>';
+  html += '<th>Адрес</th>';
+  html += '<th>Корпус/Этаж</th>';
+  html += '<th>Местоположение</th>';
+  html += '<th>Тип оборудования</th>';
+  html += '<th>Марка</th>';
+  html += '<th>Модель</th>';
+  html += '<th>Серийный номер</th>';
+  html += '<th>Инвентарный номер</th>';
+  html += '</tr></thead><tbody>';
+  
+  items.forEach(item => {
+    html += '<tr>';
+    html += `<td>${item['Адрес'] || '-'}</td>`;
+    html += `<td>${item['Корпус/Этаж'] || '-'}</td>`;
+    html += `<td>${item['Местоположение'] || '-'}</td>`;
+    html += `<td>${item['Тип оборудования'] || '-'}</td>`;
+    html += `<td>${item['Марка'] || '-'}</td>`;
+    html += `<td>${item['Модель'] || '-'}</td>`;
+    html += `<td>${item['Серийный номер'] || '-'}</td>`;
+    html += `<td>${item['Инвентарный номер'] || '-'}</td>`;
+    html += '</tr>';
+  });
+  
+  html += '</tbody></table>';
+  container.innerHTML = html;
+}
+
+// ─── ТОП: Управление файлом ───
+let topFileSelected = null;
+
+$('topFile').onchange = async e => {
+  topFileSelected = e.target.files[0];
+  if (!topFileSelected) {
+    $('topFileName').textContent = '';
+    return;
+  }
+  
+  $('topFileName').textContent = topFileSelected.name;
+  showStatus('topStatus', 'info', '<span class="spinner"></span> Загрузка базы данных...');
+  
+  try {
+    const formData = new FormData();
+    formData.append('file', topFileSelected);
+    
+    const r = await fetch(API + '/top/upload', {
+      method: 'POST',
+      body: formData
+    });
+    
+    if (!r.ok) {
+      const errText = await r.text();
+      throw new Error(errText);
+    }
+    
+    showStatus('topStatus', 'ok', '✓ База данных загружена');
+    
+    // Загружаем список пользователей
+    await loadTopUsers();
+    
+    // Показываем фильтры
+    $('topFiltersSection').classList.remove('hidden');
+    
+    setTimeout(() => $('topStatus').classList.add('hidden'), 2000);
+    
+  } catch (e) {
+    showStatus('topStatus', 'err', '❌ Ошибка загрузки: ' + e.message);
+  }
+};
+
+// ─── ТОП: Загрузка пользователей ───
+async function loadTopUsers() {
+  try {
+    const r = await fetch(API + '/top/users');
+    if (!r.ok) throw new Error(await r.text());
+    const data = await r.json();
+    
+    fillSelect('topUser', data.users);
+    $('topUser').disabled = false;
+    
+    $('topUser').onchange = () => {
+      if ($('topUser').value) {
+        searchTop();
+      } else {
+        $('topResults').innerHTML = '';
+      }
+    };
+    
+  } catch (e) {
+    showStatus('topStatus', 'err', '❌ Ошибка загрузки пользователей: ' + e.message);
+  }
+}
+
+// ─── ТОП: Поиск ───
+async function searchTop() {
+  const user = $('topUser').value;
+  if (!user) {
+    showStatus('topStatus', 'err', '❌ Выберите пользователя');
+    return;
+  }
+  
+  showStatus('topStatus', 'info', '<span class="spinner"></span> Поиск...');
+  
+  try {
+    const r = await fetch(API + `/top/search?user=${encodeURIComponent(user)}`);
+    if (!r.ok) throw new Error(await r.text());
+    const data = await r.json();
+    
+    displayTopResults(data.items, data.total);
+    $('topStatus').classList.add('hidden');
+    
+  } catch (e) {
+    showStatus('topStatus', 'err', '❌ Ошибка поиска: ' + e.message);
+  }
+}
+
+// ─── ТОП: Отображение результатов ───
+function displayTopResults(items, total) {
+  const container = $('topResults');
+  
+  if (items.length === 0) {
+    container.innerHTML = '<div class="warehouse-empty">🔍 Оборудование не найдено</div>';
+    return;
+  }
+  
+  let html = `<div class="warehouse-count">📦 Найдено: ${total} шт.</div>`;
+  html += '<table class="warehouse-table">';
+  html += '<thead><tr>';
+  html += '<th>БЕ</th>';
+  html += '<th>ID актива</th>';
+  html += '<th>Название</th>';
+  html += '<th>Описание класса материала</th>';
+  html += '<th>Серийный номер</th>';
+  html += '<th>Инвентарный номер</th>';
+  html += '<th>Пользователь</th>';
+  html += '<th>ФИО пользователя</th>';
+  html += '<th>Комментарии</th>';
+  html += '</tr></thead><tbody>';
+  
+  items.forEach(item => {
+    html += '<tr>';
+    html += `<td>${item['БЕ'] || '-'}</td>`;
+    html += `<td>${item['ID актива'] || '-'}</td>`;
+    html += `<td>${item['Название'] || '-'}</td>`;
+    html += `<td>${item['Описание класса материала'] || '-'}</td>`;
+    html += `<td>${item['Серийный номер'] || '-'}</td>`;
+    html += `<td>${item['Инвентарный номер'] || '-'}</td>`;
+    html += `<td>${item['Пользователь'] || '-'}</td>`;
+    html += `<td>${item['ФИО пользователя'] || '-'}</td>`;
+    html += `<td>${item['Комментарии'] || '-'}</td>`;
+    html += '</tr>';
+  });
+  
+  html += '</tbody></table>';
+  container.innerHTML = html;
+}
+
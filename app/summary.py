@@ -0,0 +1,91 @@
+# Сводная книга пакета: итоги по файлам и группам устаревания, детализация строк
+import pickle
+
+from .excel_logic import CRITICAL_AGE_YEARS, TECH_REFRESH_YEARS, _pluralize_years
+
+SUMMARY_FILENAME = "Сводка.xlsx"
+EXCEL_MAX_ROWS = 1_048_576  # Строк на листе XLSX (с заголовком)
+
+# Группы устаревания: ключ в stats["age_buckets"] -> заголовок столбца
+AGE_BUCKETS = [
+    ("fresh", f"Не устарело (≤ {_pluralize_years(TECH_REFRESH_YEARS)})"),
+    ("outdated", f"Устарело ({TECH_REFRESH_YEARS + 1}-{_pluralize_years(CRITICAL_AGE_YEARS)})"),
+    ("critical", f"Критично (> {_pluralize_years(CRITICAL_AGE_YEARS)})"),
+    ("missing", "Не найдено в базе"),
+]
+DETAIL_COLUMNS = ["Файл", "Лист", "Серийный номер", "Передано на склад", "Оборудование устарело"]
+
+
+def write_summary(path: str, files: list, detail: bool = False):
+    """Сводная книга по статистике, собранной при обработке (результаты не перечитываются).
+
+    files — [{"filename", "stats", "error", "detail_path"}] в порядке пакета;
+    stats=None — файл не обработан. Листы: "Сводка" (строка на файл и итог),
+    "По возрасту" (строк по возрасту оборудования в каждом файле) и при
+    detail=True "Детализация" — строки всех файлов из их detail_path.
+    """
+    import openpyxl
+    book = openpyxl.Workbook(write_only=True)
+    _write_totals(book.create_sheet("Сводка"), files)
+    _write_ages(book.create_sheet("По возрасту"), files)
+    if detail:
+        _write_detail(book, files)
+    book.save(path)
+
+
+def _write_totals(sheet, files: list):
+    sheet.append(["Файл", "Строк", "Найдено на складе"] + [title for _, title in AGE_BUCKETS] + ["Ошибка"])
+    total = [0, None] + [None] * len(AGE_BUCKETS)
+    for item in files:
+        stats = item.get("stats")
+        if stats is None:
+            sheet.append([item["filename"]] + [None] * (2 + len(AGE_BUCKETS)) + [item.get("error")])
+            continue
+        buckets = stats.get("age_buckets")
+        row = [stats.get("total_rows"), stats.get("matched")] + \
+              [buckets.get(key, 0) if buckets else None for key, _ in AGE_BUCKETS]
+        total = [t if v is None else (t or 0) + v for t, v in zip(total, row)]
+        sheet.append([item["filename"]] + row + [None])
+    sheet.append(["Итого"] + total + [None])
+
+
+def _write_ages(sheet, files: list):
+    done = [item for item in files if item.get("stats") and item["stats"].get("ages")]
+    ages = sorted({int(age) for item in done for age in item["stats"]["ages"]})
+    sheet.append(["Возраст, лет"] + [item["filename"] for item in done] + ["Итого"])
+    for age in ages:
+        counts = [item["stats"]["ages"].get(str(age), 0) for item in done]
+        sheet.append([age] + counts + [sum(counts)])
+
+
+def _iter_detail(path: str):
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def _write_detail(book, files: list):
+    """Детализация по блокам из файлов collect_detail; при переполнении
+    листа строки продолжаются на следующем ("Детализация 2", ...)."""
+    number, sheet, rows = 1, None, EXCEL_MAX_ROWS
+    for item in files:
+        if item.get("stats") is None or not item.get("detail_path"):
+            continue
+        for frame in _iter_detail(item["detail_path"]):
+            frame = frame.reindex(columns=DETAIL_COLUMNS[1:])
+            frame.insert(0, "Файл", item["filename"])
+            values = frame.astype(object).where(frame.notna(), None).values.tolist()
+            while values:
+                if rows >= EXCEL_MAX_ROWS:
+                    sheet = book.create_sheet("Детализация" if number == 1 else f"Детализация {number}")
+                    sheet.append(DETAIL_COLUMNS)
+                    number, rows = number + 1, 1
+                part, values = values[:EXCEL_MAX_ROWS - rows], values[EXCEL_MAX_ROWS - rows:]
+                for row in part:
+                    sheet.append(row)
+                rows += len(part)
+    if sheet is None:
+        book.create_sheet("Детализация").append(DETAIL_COLUMNS)
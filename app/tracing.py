@@ -0,0 +1,174 @@
+# Трассировка обработки: интервалы (span) в JSON-файлы формата Chrome Trace
+# (открываются в ui.perfetto.dev или chrome://tracing)
+import contextlib
+import json
+import os
+import threading
+import time
+
+from .shared_store import SHARED_DIR, pid_alive
+
+TRACE_ENABLED = os.environ.get("EXCEL_TRACE", "0") not in ("", "0", "false", "no")
+TRACE_DIR = os.environ.get("EXCEL_TRACE_DIR") or os.path.join(SHARED_DIR, "traces")
+TRACE_FILE_BYTES = int(os.environ.get("EXCEL_TRACE_FILE_MB", "16")) << 20  # Размер файла до ротации
+TRACE_KEEP_FILES = int(os.environ.get("EXCEL_TRACE_FILES", "20"))  # Сколько файлов хранить
+
+_context = threading.local()  # Атрибуты, которые получают все span потока (job_id)
+_writer_lock = threading.Lock()
+_writer = {"file": None, "number": 0, "threads": set()}
+
+
+class _NoSpan:
+    """Span при выключенной трассировке: ничего не делает и ложен в if."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return None
+
+    def __bool__(self):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ("name", "attrs", "async_id", "start")
+
+    def __init__(self, name: str, attrs: dict, async_id):
+        self.name = name
+        self.attrs = attrs
+        self.async_id = async_id
+
+    def __enter__(self):
+        self.start = time.time_ns() // 1000
+        if self.async_id is not None:
+            self._emit("b", self.start)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs["error"] = f"{exc_type.__name__}: {exc}"
+        end = time.time_ns() // 1000
+        if self.async_id is not None:
+            self._emit("e", end)
+        else:
+            self._emit("X", self.start, end - self.start)
+        return None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def _emit(self, phase: str, ts: int, dur: int = None):
+        event = {"name": self.name, "cat": "excel", "ph": phase, "ts": ts,
+                 "pid": os.getpid(), "tid": threading.get_ident()}
+        if dur is not None:
+            event["dur"] = dur
+        if self.async_id is not None:
+            event["id"] = str(self.async_id)
+        if phase != "e":
+            event["args"] = {**getattr(_context, "value", {}), **self.attrs}
+        _write(event)
+
+
+def span(name: str, async_id=None, **attrs):
+    """Интервал трассировки:
+
+        with span("read_sheet", sheet=name) as sp:
+            df = ...
+            if sp:
+                sp.set(rows=len(df))
+
+    Атрибуты, которые дорого вычислять, задаются через sp.set() под if sp —
+    при выключенной трассировке span ничего не пишет и ложен. async_id —
+    интервал, который не вкладывается в интервалы потока (пакет в цикле
+    событий, где вперемешку идут другие запросы).
+    """
+    if not TRACE_ENABLED:
+        return _NO_SPAN
+    return _Span(name, attrs, async_id)
+
+
+@contextlib.contextmanager
+def trace_context(**attrs):
+    """Атрибуты для всех span текущего потока (например, job_id пакета)."""
+    if not TRACE_ENABLED:
+        yield
+        return
+    previous = getattr(_context, "value", {})
+    _context.value = {**previous, **attrs}
+    try:
+        yield
+    finally:
+        _context.value = previous
+
+
+def _write(event: dict):
+    """Дописывает событие в файл процесса; файл больше TRACE_FILE_BYTES
+    закрывается и начинается следующий. Файл — JSON-массив без закрывающей
+    скобки, такой формат просмотрщики принимают и у незавершённого файла."""
+    line = json.dumps(event, ensure_ascii=False, default=str)
+    with _writer_lock:
+        f = _writer["file"]
+        if f is None or f.tell() > TRACE_FILE_BYTES:
+            f = _rotate()
+        tid = event["tid"]
+        if tid not in _writer["threads"]:
+            # Имя потока — для подписи дорожки в просмотрщике
+            _writer["threads"].add(tid)
+            f.write(json.dumps({"name": "thread_name", "ph": "M", "pid": event["pid"], "tid": tid,
+                                "args": {"name": threading.current_thread().name}}) + ",\n")
+        f.write(line + ",\n")
+        f.flush()
+
+
+def _rotate():
+    if _writer["file"] is not None:
+        _writer["file"].close()
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    _writer["number"] += 1
+    name = f"trace_{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{_writer['number']}.json"
+    f = open(os.path.join(TRACE_DIR, name), "w", encoding="utf-8")
+    f.write("[\n")
+    _writer["file"] = f
+    _writer["threads"] = set()
+    _prune()
+    return f
+
+
+def _prune():
+    """Удаляет самые старые файлы трассировки сверх TRACE_KEEP_FILES.
+
+    Файлы других живых процессов не трогаем: они могут быть ещё открыты
+    на запись, и удалённый файл молча терял бы их события. Поэтому, пока
+    работают несколько процессов, файлов может быть больше TRACE_KEEP_FILES.
+    """
+    pid, current = os.getpid(), _writer["file"]
+    try:
+        paths = [os.path.join(TRACE_DIR, name) for name in os.listdir(TRACE_DIR) if name.endswith(".json")]
+        paths.sort(key=os.path.getmtime)
+    except OSError:
+        return
+    for path in paths[:-TRACE_KEEP_FILES]:
+        owner = _trace_pid(os.path.basename(path))
+        if current is not None and path == current.name:
+            continue
+        if owner is not None and owner != pid and pid_alive(owner):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _trace_pid(name: str):
+    """pid процесса из имени trace_<время>_<pid>_<номер>.json (None — не наш формат)."""
+    parts = name[:-len(".json")].split("_")
+    if len(parts) != 4 or parts[0] != "trace" or not parts[2].isdigit():
+        return None
+    return int(parts[2])
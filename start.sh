@@ -1,5 +1,7 @@
 #!/bin/bash
 # Скрипт для запуска проекта сверки оборудования на MacOS
+#   ./start.sh            — режим разработки (один процесс, автоперезагрузка)
+#   ./start.sh prod [N]   — рабочий режим: N процессов (по умолчанию $WORKERS или 4)
 
 cd "$(dirname "$0")"
 
@@ -25,4 +27,10 @@ echo "  Для остановки нажмите Ctrl+C"
 echo ""
 
 # Запуск приложения
-.venv/bin/uvicorn app.main:app --reload --port 8001
+if [ "$1" = "prod" ]; then
+  # Процессы делят загруженные файлы, состояние сессии и кеши через общую папку
+  export EXCEL_SHARED_DIR="${EXCEL_SHARED_DIR:-$PWD/.shared}"
+  .venv/bin/uvicorn app.main:app --host 127.0.0.1 --port 8001 --workers "${2:-${WORKERS:-4}}"
+else
+  .venv/bin/uvicorn app.main:app --reload --port 8001
+fi